@@ -6,12 +6,22 @@ from decimal import Decimal
 from typing import Optional
 
 import botocore.exceptions
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+from activityIndexes import activityIndexKeys
 
 DATE_FORMAT = "%Y-%m-%d"
 
+# fields a PATCH may change, everything else on the item is derived or owned by uploads/mappings
+PATCHABLE_FIELDS = {"date", "account", "description", "amount", "category"}
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
 class ActivitiesTable:
 
   class Activity:
+    __slots__ = ("user", "sk", "date", "account", "description", "amount", "category", "chksum")
     user: str
     sk: str
     date: str
@@ -93,8 +103,11 @@ class ActivitiesTable:
   def patchActivity(self, user: str, sk: str, newActivity: dict):
     if self._ddbClient is None:
       return
+    unknown = set(newActivity) - PATCHABLE_FIELDS
+    if unknown:
+      raise ValueError(f"fields can't be patched: {sorted(unknown)}")
     try:
-      # first get the existing from ddb
+      # first get the existing from ddb, the index keys depend on fields that are not patched
       response = self._ddbClient.get_item(
         TableName=self._table,
         Key={
@@ -106,21 +119,44 @@ class ActivitiesTable:
           }
         }
       )
+      currentActivity = {key: _deserializer.deserialize(val) for key, val in response['Item'].items()}
 
-      currentActivity = self.parseDDBGetItemActivity(response['Item'])
-      currentActivity = currentActivity.toDict()
-      for key in newActivity.keys():
-        oldVal = currentActivity[key] 
-        newVal = newActivity[key]
-        if oldVal != newVal:
-          currentActivity[key] = newVal
-      
-      response = self._ddbClient.put_item(
+      fields = dict(newActivity)
+      if 'amount' in fields:
+        fields['amount'] = Decimal(str(fields['amount']))
+      if 'description' in fields:
+        fields['search_term'] = fields['description'].lower() if fields['description'] else 'other'
+      if 'category' in fields:
+        # re-applying mappings starts from base_category, a manual category
+        # has to stay when no mapping matches
+        fields['base_category'] = fields['category']
+      # only the patched fields and the keys derived from them are written,
+      # so mapping results and index keys of the item are kept
+      fields.update(activityIndexKeys(user, {**currentActivity, **fields}))
+
+      names = {}
+      values = {}
+      assignments = []
+      for i, (key, val) in enumerate(fields.items()):
+        names[f'#f{i}'] = key
+        values[f':v{i}'] = _serializer.serialize(val)
+        assignments.append(f'#f{i} = :v{i}')
+      names['#sk'] = 'sk'
+      return self._ddbClient.update_item(
         TableName=self._table,
-        Item=self.unparseDDBItem(currentActivity)
+        Key={
+          'user': {
+            'S': user
+          },
+          'sk': {
+            'S': sk
+          }
+        },
+        UpdateExpression='SET ' + ', '.join(assignments),
+        ConditionExpression='attribute_exists(#sk)',
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
       )
-
-      return response
     except botocore.exceptions.ClientError as e:
       error_message = e.response["Error"]
       print(f"db error while patching activity, {error_message}")
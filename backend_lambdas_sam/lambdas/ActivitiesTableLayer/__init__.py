@@ -1 +1,11 @@
-from ActivitiesTableLayer import *
\ No newline at end of file
+from ActivitiesTableLayer import *
+from mappingMatcher import *
+from mappingCache import *
+from activityIndexes import *
+from activityMappings import *
+from descriptionIndex import *
+from uploadStore import *
+from batchWriter import *
+from contentKeys import *
+from activityRecord import *
+from monthlyInsights import *
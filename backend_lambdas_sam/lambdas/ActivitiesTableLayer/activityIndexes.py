@@ -0,0 +1,43 @@
+# global secondary indexes on the activities table and the key attributes
+# activity items carry for them. Only activity items (sk starting with the
+# date) have these attributes, so every index is sparse; items copied
+# elsewhere (e.g. soft deleted ones) must leave them out.
+
+from decimal import Decimal, ROUND_HALF_UP
+
+# review_key -> sk
+REVIEW_INDEX = "ReviewIndex"
+# account_key -> sk
+ACCOUNT_INDEX = "AccountIndex"
+# user -> amount_key
+AMOUNT_INDEX = "AmountIndex"
+
+INDEX_KEY_ATTRIBUTES = ("review_key", "account_key", "amount_key")
+
+# amounts are stored to 4 decimal places and shifted by an offset so the
+# zero padded string sorts the same way as the signed number
+AMOUNT_KEY_SCALE = 10 ** 4
+AMOUNT_KEY_OFFSET = 10 ** 19
+AMOUNT_KEY_WIDTH = 20
+
+
+def reviewKey(user: str, dirty: bool) -> str:
+  return f"{user}#{'dirty' if dirty else 'clean'}"
+
+
+def accountKey(user: str, account: str) -> str:
+  return f"{user}#{account}"
+
+
+def amountKey(amount) -> str:
+  scaled = int((Decimal(str(amount)) * AMOUNT_KEY_SCALE).to_integral_value(rounding=ROUND_HALF_UP))
+  return str(scaled + AMOUNT_KEY_OFFSET).zfill(AMOUNT_KEY_WIDTH)
+
+
+def activityIndexKeys(user: str, item: dict) -> dict:
+  """ index key attributes for an activity item (needs account, amount and dirty) """
+  return {
+    "review_key": reviewKey(user, bool(item.get("dirty", False))),
+    "account_key": accountKey(user, item.get("account") or ""),
+    "amount_key": amountKey(item.get("amount") or 0),
+  }
@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.dynamodb.conditions import Key
+
+from mappingMatcher import MappingMatcher
+from mappingCache import mapping_cache
+from activityIndexes import reviewKey
+
+
+def mappedFields(matcher: MappingMatcher, user: str, description: str, baseCategory: str) -> dict:
+  """ the mapping results that are stored on an activity item """
+  matchedMapping = matcher.match(description or "")
+  dirty = len(matchedMapping) > 0
+  return {
+    "category": matchedMapping[0]["category"] if dirty else baseCategory,
+    "dirty": dirty,
+    "predicted": [mapping["category"] for mapping in matchedMapping],
+    "review_key": reviewKey(user, dirty),
+  }
+
+
+# activities read per page while re-categorizing, and parallel item updates.
+# the deadline is checked after every round of RECATEGORIZE_WORKERS updates,
+# so a throttled table can't keep a page going past the lambda timeout
+RECATEGORIZE_PAGE_SIZE = 100
+RECATEGORIZE_WORKERS = 8
+
+_MAPPED_PROJECTION = "sk, description, category, base_category, dirty, predicted, review_key"
+
+
+def storedMappingFields(matcher: MappingMatcher, user: str, item: dict) -> dict:
+  """ mappedFields of a stored activity item, with the base_category they were derived from """
+  # items written before base_category existed still hold their unmapped category
+  baseCategory = item.get("base_category", item.get("category", item.get("description", "")))
+  return {**mappedFields(matcher, user, item.get("description", ""), baseCategory), "base_category": baseCategory}
+
+
+def _mappedUpdate(matcher: MappingMatcher, user: str, item: dict):
+  """ update_item arguments that store the mapping results of `item`, None when they are already stored """
+  fields = storedMappingFields(matcher, user, item)
+  if all(key in item and item[key] == value for key, value in fields.items()):
+    return None
+  return {
+    "Key": {
+      "user": user,
+      "sk": item["sk"]
+    },
+    "UpdateExpression": "set category = :c, base_category = :b, dirty = :d, predicted = :p, review_key = :r",
+    "ExpressionAttributeValues": {
+      ":c": fields["category"],
+      ":b": fields["base_category"],
+      ":d": fields["dirty"],
+      ":p": fields["predicted"],
+      ":r": fields["review_key"],
+    }
+  }
+
+
+def recategorizeActivities(activities_table, user: str, descriptions, matcher: MappingMatcher = None,
+                           startSk: str = None, timeLeft=None, minSeconds: float = 1.0):
+  """
+  Re-applies the user's mappings to the activities a mapping change can
+  affect: the ones whose description contains one of `descriptions` (the
+  changed mappings' old and new descriptions). Pages through the activities
+  from `startSk` on and stops once timeLeft() (seconds) is under
+  `minSeconds`, checked after every round of parallel updates and between
+  pages. Only changed items are written.
+  Returns (updated items, the sk to resume from or None when done).
+  """
+  if matcher is None:
+    matcher = mapping_cache.getMatcher(activities_table, user)
+  affected = MappingMatcher([{"description": description} for description in set(descriptions)])
+  client = activities_table.meta.client
+  params = {
+    "KeyConditionExpression": Key("user").eq(user) & Key("sk").between(startSk or "0000-00-00", "9999-99-99"),
+    "ProjectionExpression": _MAPPED_PROJECTION,
+    "Limit": RECATEGORIZE_PAGE_SIZE,
+  }
+  updated = 0
+  response = activities_table.query(**params)
+  with ThreadPoolExecutor(max_workers=RECATEGORIZE_WORKERS) as executor:
+    while True:
+      updates = [(item["sk"], _mappedUpdate(matcher, user, item)) for item in response.get("Items", [])
+                 if affected.match(item.get("description", ""))]
+      updates = [(sk, update) for sk, update in updates if update is not None]
+      for start in range(0, len(updates), RECATEGORIZE_WORKERS):
+        if start and timeLeft is not None and timeLeft() < minSeconds:
+          return updated, updates[start][0]
+        # the resource's client is thread safe, the resource isn't
+        futures = [executor.submit(client.update_item, TableName=activities_table.name, **update)
+                   for _, update in updates[start:start + RECATEGORIZE_WORKERS]]
+        for future in futures:
+          future.result()
+        updated += len(futures)
+      nextKey = response.get("LastEvaluatedKey")
+      if not nextKey:
+        return updated, None
+      if timeLeft is not None and timeLeft() < minSeconds:
+        return updated, nextKey["sk"]
+      response = activities_table.query(**params, ExclusiveStartKey=nextKey)
@@ -0,0 +1,128 @@
+import json
+import uuid
+from decimal import Decimal
+from typing import Optional
+
+from activityIndexes import accountKey, amountKey, reviewKey
+
+# one activity as it is parsed from an upload and written to the table.
+# uploads hold one of these per row, so it is slot based (no per instance
+# __dict__), the search term is derived instead of stored and the sk is
+# only generated when something reads it. toWireItem and toJson serialize
+# straight from the slots, without building the toDict() copy first.
+
+_encode = json.JSONEncoder().encode
+
+_JSON_FIELDS = ("sk", "account", "date", "description", "amount", "search_term",
+                "category", "base_category", "predicted", "dirty")
+
+
+def _wireString(value: Optional[str]) -> dict:
+  return {"NULL": True} if value is None else {"S": value}
+
+
+class ActivityRecord:
+  __slots__ = ("_sk", "account", "date", "description", "amount", "category", "base_category", "predicted", "dirty")
+
+  def __init__(self,
+               account: str,
+               date: str,
+               amount: Decimal,
+               description: str,
+               sk: Optional[str] = None,
+               category: Optional[str] = None
+               ):
+    self._sk = sk
+    self.account = account
+    self.date = date
+    self.description = description
+    self.category = category if category is not None else description
+    # category before mappings are applied, kept so mappings can be re-applied later
+    self.base_category = self.category
+    self.amount = amount
+    # shared until mappings are applied
+    self.predicted = ()
+    self.dirty = False
+
+  @property
+  def sk(self) -> str:
+    if self._sk is None:
+      self._sk = self.date + str(uuid.uuid4())
+    return self._sk
+
+  @sk.setter
+  def sk(self, sk: str):
+    self._sk = sk
+
+  @property
+  def search_term(self) -> str:
+    return self.description.lower() if self.description else 'other'
+
+  def applyMappings(self, matcher):
+    matchedMapping = matcher.match(self.description)
+    self.dirty = len(matchedMapping) > 0
+    self.category = matchedMapping[0]["category"] if len(matchedMapping) > 0 else self.base_category
+    self.predicted = [mapping["category"] for mapping in matchedMapping] if matchedMapping else ()
+
+  def toDict(self) -> dict:
+    return {
+      "sk": self.sk,
+      "account": self.account,
+      "date": self.date,
+      "description": self.description,
+      "amount": str(self.amount),
+      "search_term": self.search_term,
+      "category": self.category,
+      "base_category": self.base_category,
+      "predicted": list(self.predicted),
+      "dirty": self.dirty,
+    }
+
+  def toItem(self, user: str, chksum: str) -> dict:
+    """ the stored item, for the table resource """
+    return {
+      "user": user,
+      "sk": self.sk,
+      "account": self.account,
+      "date": self.date,
+      "description": self.description,
+      # stored as a number so amount filters and the stream compare numerically
+      "amount": self.amount,
+      "search_term": self.search_term,
+      "category": self.category,
+      "base_category": self.base_category,
+      "predicted": list(self.predicted),
+      "dirty": self.dirty,
+      "review_key": reviewKey(user, self.dirty),
+      "account_key": accountKey(user, self.account or ""),
+      "amount_key": amountKey(self.amount),
+      "chksum": chksum,
+    }
+
+  def toWireItem(self, user: str, chksum: str) -> dict:
+    """ toItem in DynamoDB's attribute value format, for the low level client """
+    return {
+      "user": {"S": user},
+      "sk": {"S": self.sk},
+      "account": _wireString(self.account),
+      "date": {"S": self.date},
+      "description": _wireString(self.description),
+      "amount": {"N": str(self.amount)},
+      "search_term": {"S": self.search_term},
+      "category": _wireString(self.category),
+      "base_category": _wireString(self.base_category),
+      "predicted": {"L": [{"S": category} for category in self.predicted]},
+      "dirty": {"BOOL": self.dirty},
+      "review_key": {"S": reviewKey(user, self.dirty)},
+      "account_key": {"S": accountKey(user, self.account or "")},
+      "amount_key": {"S": amountKey(self.amount)},
+      "chksum": {"S": chksum},
+    }
+
+  def toJson(self, **extra) -> str:
+    """ json.dumps(toDict() plus `extra`), encoded field by field """
+    values = (self.sk, self.account, self.date, self.description, str(self.amount), self.search_term,
+              self.category, self.base_category, list(self.predicted), self.dirty)
+    fields = [f'"{name}": {_encode(value)}' for name, value in zip(_JSON_FIELDS, values)]
+    fields.extend(f'{_encode(name)}: {_encode(value)}' for name, value in extra.items())
+    return "{" + ", ".join(fields) + "}"
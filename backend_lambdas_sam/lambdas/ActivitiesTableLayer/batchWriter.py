@@ -0,0 +1,295 @@
+import os
+import queue
+import random
+import threading
+import time
+
+import boto3
+import botocore.exceptions
+
+# write engine for bulk puts and deletes (uploads, delete all). items are
+# sharded by key across worker threads, each sending its own BatchWriteItem
+# calls, so the same key is always written by the same thread, in order.
+# a shared AIMD controller paces the workers once the table throttles: until
+# then writes go out as fast as the workers send them, the first throttle
+# starts pacing at half the rate reached so far, then every accepted batch
+# raises the allowed items/s a little and every throttle halves it.
+
+# BatchWriteItem accepts at most 25 requests
+BATCH_WRITE_SIZE = 25
+
+BATCH_WRITE_WORKERS = int(os.environ.get("BATCH_WRITE_WORKERS", 4))
+# items/s paced at after the first throttle when no rate was measured before it
+BATCH_WRITE_RATE = float(os.environ.get("BATCH_WRITE_RATE", 100))
+
+THROTTLING_ERRORS = (
+  "ProvisionedThroughputExceededException",
+  "ThrottlingException",
+  "RequestLimitExceeded",
+)
+
+
+_wireClients = {}
+
+
+def wireClient(activities_table):
+  """ a low level client for the table's region and endpoint, without the resource's serialization """
+  meta = activities_table.meta.client.meta
+  key = (meta.region_name, meta.endpoint_url)
+  if key not in _wireClients:
+    _wireClients[key] = boto3.client("dynamodb", region_name=meta.region_name, endpoint_url=meta.endpoint_url)
+  return _wireClients[key]
+
+
+class BatchWriteError(Exception):
+  """ items were still unprocessed after the last retry """
+
+
+class RateController:
+  """
+  Additive increase / multiplicative decrease of the items per second shared
+  by the workers. Writes are not paced until the first throttle (unless
+  `paced`), which starts pacing at `decrease` times the rate sent until then.
+  """
+
+  def __init__(self, rate: float, minRate: float = 1, maxRate: float = 10000, increase: float = 5, decrease: float = 0.5,
+               paced: bool = False):
+    self.rate = rate
+    self.minRate = minRate
+    self.maxRate = maxRate
+    self.increase = increase
+    self.decrease = decrease
+    self.paced = paced
+    self._lock = threading.Lock()
+    self._next = time.monotonic()
+    self._started = None
+    self._sent = 0
+
+  def acquire(self, items: int):
+    """ blocks until `items` more writes fit in the current rate """
+    with self._lock:
+      now = time.monotonic()
+      if not self.paced:
+        if self._started is None:
+          self._started = now
+        self._sent += items
+        return
+      start = max(now, self._next)
+      self._next = start + items / self.rate
+    if start > now:
+      time.sleep(start - now)
+
+  def onSuccess(self):
+    with self._lock:
+      self.rate = min(self.maxRate, self.rate + self.increase)
+
+  def onThrottle(self):
+    with self._lock:
+      if not self.paced:
+        self.paced = True
+        elapsed = time.monotonic() - self._started if self._started is not None else 0
+        if elapsed > 0:
+          self.rate = min(self.maxRate, self._sent / elapsed)
+        self._next = time.monotonic()
+      self.rate = max(self.minRate, self.rate * self.decrease)
+
+
+class WriteStats:
+  def __init__(self):
+    self.items = 0
+    self.batches = 0
+    self.retries = 0
+    self.throttles = 0
+    self.skipped = 0
+    self.consumedWcu = 0.0
+    self.started = time.monotonic()
+    self.seconds = 0.0
+    self._lock = threading.Lock()
+
+  def add(self, items: int = 0, batches: int = 0, retries: int = 0, throttles: int = 0, skipped: int = 0,
+          consumedWcu: float = 0.0):
+    with self._lock:
+      self.items += items
+      self.batches += batches
+      self.retries += retries
+      self.throttles += throttles
+      self.skipped += skipped
+      self.consumedWcu += consumedWcu
+
+  def report(self) -> dict:
+    return {
+      "items": self.items,
+      "batches": self.batches,
+      "seconds": round(self.seconds, 3),
+      "items_per_second": round(self.items / self.seconds, 1) if self.seconds else 0.0,
+      "retries": self.retries,
+      "throttles": self.throttles,
+      "skipped": self.skipped,
+      "consumed_wcu": self.consumedWcu,
+    }
+
+
+class ConcurrentBatchWriter:
+  """
+  Drop-in for `with table.batch_writer(overwrite_by_pkeys=[...]) as batch`.
+  Later writes to a key replace earlier unsent ones. Errors from the workers
+  are raised from put_item/delete_item or when the block exits, the write
+  report is printed and kept on `stats`.
+  With putIfAbsent puts are sent one PutItem at a time with an
+  attribute_not_exists condition, items that already exist are counted as
+  skipped instead of being overwritten.
+  With wireFormat items and keys are already in DynamoDB's attribute value
+  format (e.g. ActivityRecord.toWireItem) and skip the resource's type
+  serialization.
+  """
+
+  def __init__(self, activities_table, workers: int = None, rate: float = None,
+               pkeys=("user", "sk"), putIfAbsent: bool = False, wireFormat: bool = False,
+               maxAttempts: int = 10, backoffBase: float = 0.05, backoffCap: float = 5.0):
+    self.tableName = activities_table.name
+    # the resource's client serializes python types and is thread safe
+    self.client = wireClient(activities_table) if wireFormat else activities_table.meta.client
+    self.wireFormat = wireFormat
+    self.workers = workers or BATCH_WRITE_WORKERS
+    self.controller = RateController(rate or BATCH_WRITE_RATE)
+    self.pkeys = pkeys
+    self.putIfAbsent = putIfAbsent
+    self.maxAttempts = maxAttempts
+    self.backoffBase = backoffBase
+    self.backoffCap = backoffCap
+    self.stats = WriteStats()
+    self._buffers = [{} for _ in range(self.workers)]
+    self._queues = [queue.Queue(maxsize=2) for _ in range(self.workers)]
+    self._threads = []
+    self._error = None
+
+  def __enter__(self):
+    for shard in range(self.workers):
+      thread = threading.Thread(target=self._work, args=(self._queues[shard],), daemon=True)
+      thread.start()
+      self._threads.append(thread)
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if exc_type is None:
+      for shard in range(self.workers):
+        self._flush(shard)
+    for work in self._queues:
+      work.put(None)
+    for thread in self._threads:
+      thread.join()
+    self.stats.seconds = time.monotonic() - self.stats.started
+    print("batch write", self.stats.report())
+    if exc_type is None and self._error:
+      raise self._error
+    return False
+
+  def put_item(self, Item: dict):
+    self._add(Item, {"PutRequest": {"Item": Item}})
+
+  def delete_item(self, Key: dict):
+    self._add(Key, {"DeleteRequest": {"Key": Key}})
+
+  def _add(self, item: dict, request: dict):
+    if self._error:
+      raise self._error
+    if self.wireFormat:
+      key = tuple(item[name]["S"] for name in self.pkeys)
+    else:
+      key = tuple(item[name] for name in self.pkeys)
+    shard = hash(key) % self.workers
+    buffer = self._buffers[shard]
+    buffer.pop(key, None)
+    buffer[key] = request
+    if len(buffer) >= BATCH_WRITE_SIZE:
+      self._flush(shard)
+
+  def _flush(self, shard: int):
+    if self._buffers[shard]:
+      # blocks while the worker is behind, so a streamed upload is never buffered whole
+      self._queues[shard].put(list(self._buffers[shard].values()))
+      self._buffers[shard] = {}
+
+  def _work(self, work: queue.Queue):
+    while True:
+      requests = work.get()
+      if requests is None:
+        return
+      if self._error:
+        # keep draining so the producer never blocks on a failed shard
+        continue
+      try:
+        self._write(requests)
+      except Exception as error:
+        self._error = error
+
+  def _backoff(self, attempt: int):
+    # full jitter
+    time.sleep(random.uniform(0, min(self.backoffCap, self.backoffBase * 2 ** attempt)))
+
+  def _write(self, requests: list):
+    if not self.putIfAbsent:
+      return self._writeBatch(requests)
+    deletes = [request for request in requests if "DeleteRequest" in request]
+    if deletes:
+      self._writeBatch(deletes)
+    for request in requests:
+      if "PutRequest" in request:
+        self._putIfAbsent(request["PutRequest"]["Item"])
+    self.stats.add(batches=1)
+    self.controller.onSuccess()
+
+  def _putIfAbsent(self, item: dict):
+    for attempt in range(self.maxAttempts):
+      self.controller.acquire(1)
+      try:
+        response = self.client.put_item(
+          TableName=self.tableName,
+          Item=item,
+          ConditionExpression="attribute_not_exists(#sk)",
+          ExpressionAttributeNames={"#sk": self.pkeys[-1]},
+          ReturnConsumedCapacity="TOTAL",
+        )
+      except botocore.exceptions.ClientError as error:
+        code = error.response["Error"]["Code"]
+        if code == "ConditionalCheckFailedException":
+          self.stats.add(skipped=1)
+          return
+        if code not in THROTTLING_ERRORS:
+          raise
+        self.controller.onThrottle()
+        self.stats.add(retries=1, throttles=1)
+        self._backoff(attempt)
+        continue
+      self.stats.add(items=1, consumedWcu=response.get("ConsumedCapacity", {}).get("CapacityUnits", 0))
+      return
+    raise BatchWriteError(f"item unprocessed after {self.maxAttempts} attempts")
+
+  def _writeBatch(self, requests: list):
+    sent = len(requests)
+    for attempt in range(self.maxAttempts):
+      self.controller.acquire(len(requests))
+      try:
+        response = self.client.batch_write_item(
+          RequestItems={self.tableName: requests},
+          ReturnConsumedCapacity="TOTAL",
+        )
+      except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] not in THROTTLING_ERRORS:
+          raise
+        self.controller.onThrottle()
+        self.stats.add(retries=1, throttles=1)
+        self._backoff(attempt)
+        continue
+      consumed = sum(capacity.get("CapacityUnits", 0) for capacity in response.get("ConsumedCapacity", []))
+      requests = response.get("UnprocessedItems", {}).get(self.tableName, [])
+      self.stats.add(items=sent - len(requests), batches=1, consumedWcu=consumed)
+      if not requests:
+        self.controller.onSuccess()
+        return
+      # unprocessed items mean the table is over its capacity
+      self.controller.onThrottle()
+      self.stats.add(retries=1, throttles=1)
+      sent = len(requests)
+      self._backoff(attempt)
+    raise BatchWriteError(f"{len(requests)} items unprocessed after {self.maxAttempts} attempts")
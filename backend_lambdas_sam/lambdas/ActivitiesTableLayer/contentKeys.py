@@ -0,0 +1,56 @@
+import hashlib
+import re
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+
+# activity sort keys derived from the row itself instead of a random uuid:
+#   sk = "{date}#{hash of account, date, amount, description, occurrence}"
+# occurrence counts identical rows within one file, so two coffees on the
+# same day stay two activities while the same statement ingested twice
+# (or two overlapping statements) produce the same keys. ingestion writes
+# them with attribute_not_exists puts, so rows that are already stored,
+# including any edits made to them since, are left alone.
+
+_CONTENT_SK_RE = re.compile(r"^\d{4}-\d{2}-\d{2}#[0-9a-f]{32}$")
+
+# moving an activity to a new sk (scripts/migrate_content_sks.py) shows up on
+# the stream as an INSERT and a REMOVE. the copy is written with MOVED_FROM
+# and the original gets MOVED_TO before it is deleted, so the stream can
+# leave the move out of insights and related activities.
+MOVED_FROM = "moved_from"
+MOVED_TO = "moved_to"
+
+RELATED_ACTIVITY_PREFIX = "related_activity#"
+
+
+def _amountText(amount) -> str:
+  # 20.47, "20.470" and Decimal("20.47") hash the same
+  return format(Decimal(str(amount)).normalize(), "f")
+
+
+def contentSk(account: str, date: str, amount, description: str, occurrence: int = 0) -> str:
+  content = "\x1f".join([account or "", date, _amountText(amount), description or "", str(occurrence)])
+  return f"{date}#{hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()}"
+
+
+def isContentSk(sk: str) -> bool:
+  return bool(_CONTENT_SK_RE.match(sk))
+
+
+class OccurrenceCounter:
+  """ hands out content sks for the rows of one file, numbering identical rows in order """
+
+  def __init__(self):
+    self._seen = defaultdict(int)
+
+  def sk(self, account: str, date: str, amount, description: str) -> str:
+    first = contentSk(account, date, amount, description)
+    occurrence = self._seen[first]
+    self._seen[first] += 1
+    return first if occurrence == 0 else contentSk(account, date, amount, description, occurrence)
+
+
+def relatedActivitySk(activity: str, related: str, kind: str) -> str:
+  """ sk of the related_activity item linking `activity` to `related`, the same for the same link """
+  return RELATED_ACTIVITY_PREFIX + str(uuid.uuid5(uuid.NAMESPACE_URL, f"{activity}|{related}|{kind}"))
@@ -0,0 +1,122 @@
+import re
+import time
+import random
+
+from boto3.dynamodb.conditions import Key
+
+# inverted index of normalized description tokens. every (token, activity)
+# pair is one small item in the user's partition:
+#   sk = "token#{token}#{activity sk}"
+# so a token's posting list is a keys-only begins_with query, and a prefix of
+# a token (typeahead) is the same query without the trailing "#".
+# maintained by the activitiesStreams lambda, read by getActivities(description=...)
+TOKEN_SK_PREFIX = "token#"
+
+# batch_get_item accepts at most 100 keys per request
+BATCH_GET_SIZE = 100
+
+
+class BatchGetError(Exception):
+  """ keys were still unprocessed after the last retry """
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(description: str) -> list:
+  """ unique lowercase alphanumeric tokens, in the order they appear """
+  return list(dict.fromkeys(_TOKEN_RE.findall((description or "").lower())))
+
+
+def tokenSk(token: str, sk: str) -> str:
+  return f"{TOKEN_SK_PREFIX}{token}#{sk}"
+
+
+def activitySk(token_sk: str) -> str:
+  # tokens never contain "#", activity sks can
+  return token_sk.split("#", 2)[2]
+
+
+def indexActivity(batch, user: str, sk: str, oldDescription: str = None, newDescription: str = None):
+  """
+  Writes the token items that changed between the old and new description
+  of an activity. Pass no old description for a new activity and no new
+  description for a deleted one. `batch` is a table or a batch_writer.
+  """
+  oldTokens = set(tokenize(oldDescription))
+  newTokens = set(tokenize(newDescription))
+  for token in oldTokens - newTokens:
+    batch.delete_item(Key={"user": user, "sk": tokenSk(token, sk)})
+  for token in newTokens - oldTokens:
+    batch.put_item(Item={"user": user, "sk": tokenSk(token, sk)})
+
+
+def _postingList(activities_table, user: str, skCondition) -> set:
+  params = {
+    "KeyConditionExpression": Key("user").eq(user) & skCondition,
+    "ProjectionExpression": "sk",
+  }
+  response = activities_table.query(**params)
+  sks = {activitySk(item["sk"]) for item in response.get("Items", [])}
+  while response.get("LastEvaluatedKey"):
+    response = activities_table.query(**params, ExclusiveStartKey=response["LastEvaluatedKey"])
+    sks.update(activitySk(item["sk"]) for item in response.get("Items", []))
+  return sks
+
+
+def searchActivitySks(activities_table, user: str, text: str, low: str = "", high: str = "~"):
+  """
+  Candidate activity sks between `low` and `high` for a search, newest first.
+  Every token but the last must be in the description, the last token is
+  matched as a prefix so partially typed words match. When there are whole
+  tokens only their (date bounded) posting lists are read and the prefix is
+  left to descriptionMatches on the fetched items.
+  Returns None when `text` has no searchable tokens.
+  """
+  tokens = tokenize(text)
+  if not tokens:
+    return None
+  if len(tokens) == 1:
+    # a prefix can't be bounded by date in the key condition
+    postings = _postingList(activities_table, user, Key("sk").begins_with(TOKEN_SK_PREFIX + tokens[0]))
+    return sorted((sk for sk in postings if low <= sk <= high), reverse=True)
+  matches = None
+  for token in tokens[:-1]:
+    postings = _postingList(activities_table, user, Key("sk").between(tokenSk(token, low), tokenSk(token, high)))
+    matches = postings if matches is None else matches & postings
+    if not matches:
+      return []
+  return sorted(matches, reverse=True)
+
+
+def descriptionMatches(text: str, description: str) -> bool:
+  """ same matching rules as searchActivitySks, for a fetched activity """
+  tokens = tokenize(text)
+  descriptionTokens = tokenize(description)
+  return all(token in descriptionTokens for token in tokens[:-1]) \
+      and any(token.startswith(tokens[-1]) for token in descriptionTokens)
+
+
+def batchGetActivities(activities_table, user: str, sks: list,
+                       maxAttempts: int = 10, backoffBase: float = 0.05, backoffCap: float = 5.0) -> list:
+  """ fetches the activities for `sks` with batch_get_item, in the order of `sks` """
+  found = {}
+  client = activities_table.meta.client
+  for start in range(0, len(sks), BATCH_GET_SIZE):
+    request = {
+      activities_table.name: {
+        "Keys": [{"user": user, "sk": sk} for sk in sks[start:start + BATCH_GET_SIZE]]
+      }
+    }
+    for attempt in range(maxAttempts):
+      response = client.batch_get_item(RequestItems=request)
+      for item in response.get("Responses", {}).get(activities_table.name, []):
+        found[item["sk"]] = item
+      request = response.get("UnprocessedKeys")
+      if not request:
+        break
+      # unprocessed keys mean the table is throttled, back off with full jitter
+      time.sleep(random.uniform(0, min(backoffCap, backoffBase * 2 ** attempt)))
+    else:
+      keys = len(request[activities_table.name]["Keys"])
+      raise BatchGetError(f"{keys} keys unprocessed after {maxAttempts} attempts")
+  return [found[sk] for sk in sks if sk in found]
@@ -0,0 +1,115 @@
+import os
+import time
+from collections import OrderedDict
+
+from boto3.dynamodb.conditions import Key
+
+from mappingMatcher import MappingMatcher
+
+# per user counter item, bumped every time a mapping# item is written or deleted
+MAPPINGS_VERSION_SK = "version#mappings"
+
+MAPPING_CACHE_SIZE = int(os.environ.get("MAPPING_CACHE_SIZE", 64))
+MAPPING_CACHE_TTL_SECONDS = int(os.environ.get("MAPPING_CACHE_TTL_SECONDS", 300))
+
+
+def getMappingsVersion(activities_table, user: str) -> int:
+  response = activities_table.get_item(
+    Key={
+      "user": user,
+      "sk": MAPPINGS_VERSION_SK
+    },
+    ProjectionExpression="#v",
+    ExpressionAttributeNames={"#v": "version"},
+    ConsistentRead=True
+  )
+  return int(response.get("Item", {}).get("version", 0))
+
+
+def bumpMappingsVersion(activities_table, user: str):
+  # call this after the mapping# item is written so readers never cache
+  # new mappings under an old version for longer than one request
+  activities_table.update_item(
+    Key={
+      "user": user,
+      "sk": MAPPINGS_VERSION_SK
+    },
+    UpdateExpression="ADD #v :one",
+    ExpressionAttributeNames={"#v": "version"},
+    ExpressionAttributeValues={":one": 1}
+  )
+
+
+def queryAllMappings(activities_table, user: str) -> list:
+  params = {
+    "KeyConditionExpression": Key("user").eq(user) & Key("sk").begins_with("mapping#")
+  }
+  response = activities_table.query(**params)
+  all_mappings = response.get("Items", [])
+  while response.get("LastEvaluatedKey"):
+    response = activities_table.query(
+      **params,
+      ExclusiveStartKey=response["LastEvaluatedKey"]
+    )
+    all_mappings.extend(response.get("Items", []))
+  return all_mappings
+
+
+class MappingCache:
+  """
+  In-process cache of each user's mappings and their compiled matcher.
+  Lives at module level so it is reused by warm invocations, an entry is
+  only trusted while the user's mappings version item is unchanged.
+  """
+
+  def __init__(self, maxUsers: int = MAPPING_CACHE_SIZE, ttlSeconds: int = MAPPING_CACHE_TTL_SECONDS):
+    self.maxUsers = maxUsers
+    self.ttlSeconds = ttlSeconds
+    self._entries = OrderedDict()
+    self.stats = {
+      "hits": 0,
+      "misses": 0,
+    }
+
+  def clear(self):
+    self._entries.clear()
+    for stat in self.stats:
+      self.stats[stat] = 0
+
+  def invalidate(self, activities_table, user: str):
+    self._entries.pop((activities_table.name, user), None)
+
+  def _getEntry(self, activities_table, user: str) -> dict:
+    cacheKey = (activities_table.name, user)
+    version = getMappingsVersion(activities_table, user)
+    entry = self._entries.get(cacheKey)
+    if entry is not None and entry["version"] == version \
+        and time.monotonic() - entry["fetched_at"] < self.ttlSeconds:
+      self._entries.move_to_end(cacheKey)
+      self.stats["hits"] += 1
+      return entry
+
+    self.stats["misses"] += 1
+    entry = {
+      "version": version,
+      "fetched_at": time.monotonic(),
+      "mappings": queryAllMappings(activities_table, user),
+      "matcher": None,
+    }
+    self._entries[cacheKey] = entry
+    self._entries.move_to_end(cacheKey)
+    while len(self._entries) > self.maxUsers:
+      self._entries.popitem(last=False)
+    return entry
+
+  def getMappings(self, activities_table, user: str) -> list:
+    return self._getEntry(activities_table, user)["mappings"]
+
+  def getMatcher(self, activities_table, user: str) -> MappingMatcher:
+    entry = self._getEntry(activities_table, user)
+    if entry["matcher"] is None:
+      entry["matcher"] = MappingMatcher(entry["mappings"])
+    return entry["matcher"]
+
+
+mapping_cache = MappingCache()
@@ -0,0 +1,88 @@
+from collections import deque
+from typing import Dict, List, Tuple
+
+# descriptions repeat a lot (same store every week), so match results are
+# memoized per description, up to this many distinct descriptions
+MATCH_MEMO_SIZE = 10000
+# below this many mappings a plain substring scan is faster than walking the automaton
+LINEAR_SCAN_MAX_MAPPINGS = 16
+
+
+class MappingMatcher:
+  """
+  Aho-Corasick automaton over the descriptions of a user's mappings.
+
+  match() returns the same mappings, in the same order, as
+  [m for m in mappings if m["description"] in description]
+  but scans the description once instead of once per mapping.
+  """
+
+  def __init__(self, mappings: list):
+    self.mappings = list(mappings)
+    # node 0 is the root, each node has goto transitions, a failure link
+    # and the indices of every mapping that ends at it (including via failure links)
+    self._goto: List[Dict[str, int]] = [{}]
+    self._fail: List[int] = [0]
+    self._out: List[Tuple[int, ...]] = [()]
+    self._memo: Dict[str, Tuple[int, ...]] = {}
+
+    if len(self.mappings) <= LINEAR_SCAN_MAX_MAPPINGS:
+      return
+
+    for index, mapping in enumerate(self.mappings):
+      node = 0
+      for char in mapping["description"]:
+        nextNode = self._goto[node].get(char)
+        if nextNode is None:
+          nextNode = len(self._goto)
+          self._goto.append({})
+          self._fail.append(0)
+          self._out.append(())
+          self._goto[node][char] = nextNode
+        node = nextNode
+      self._out[node] += (index,)
+
+    # breadth first so failure targets are always finished before their users
+    queue = deque(self._goto[0].values())
+    while queue:
+      node = queue.popleft()
+      for char, child in self._goto[node].items():
+        fail = self._fail[node]
+        while fail and char not in self._goto[fail]:
+          fail = self._fail[fail]
+        self._fail[child] = self._goto[fail].get(char, 0)
+        self._out[child] += self._out[self._fail[child]]
+        queue.append(child)
+
+  def __len__(self):
+    return len(self.mappings)
+
+  def _matchIndices(self, description: str) -> Tuple[int, ...]:
+    found = self._memo.get(description)
+    if found is not None:
+      return found
+
+    # mappings with an empty description match everything
+    matched = set(self._out[0])
+    goto = self._goto
+    fail = self._fail
+    out = self._out
+    node = 0
+    for char in description:
+      while node and char not in goto[node]:
+        node = fail[node]
+      node = goto[node].get(char, 0)
+      if out[node]:
+        matched.update(out[node])
+
+    found = tuple(sorted(matched))
+    if len(self._memo) >= MATCH_MEMO_SIZE:
+      self._memo.clear()
+    self._memo[description] = found
+    return found
+
+  def match(self, description: str) -> list:
+    """ returns the mappings whose description is a substring of description, in mapping order """
+    if len(self.mappings) <= LINEAR_SCAN_MAX_MAPPINGS:
+      return [mapping for mapping in self.mappings if mapping["description"] in description]
+    return [self.mappings[index] for index in self._matchIndices(description)]
@@ -0,0 +1,217 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import botocore.exceptions
+
+# insights#{month} items hold the month's total per category in a
+# `categories` map. the stream adds its deltas with one ADD per item, so
+# there is no read and concurrent shards can't overwrite each other's
+# totals. the ADD goes out with a marker per stream event, so redelivered
+# events are not counted again. items written before were a JSON string, convertInsights (and
+# scripts/migrate_insights_map.py) turns them into the map.
+
+INSIGHTS_PREFIX = "insights#"
+
+# categories per UpdateItem, keeps the update expression well under its 4KB limit
+INSIGHTS_UPDATE_SIZE = 50
+
+INSIGHTS_WORKERS = 8
+
+# totals of activities without a category. DynamoDB rejects an empty
+# expression attribute name, and a statement can leave the category empty
+UNCATEGORIZED = "uncategorized"
+
+# stream#{eventID} markers of the events already added, kept past the
+# stream's 24 hour retention and then removed by the table's TTL
+STREAM_EVENT_PREFIX = "stream#"
+STREAM_EVENT_TTL_SECONDS = 2 * 24 * 3600
+
+# an event touches at most two categories, so its deltas fit one update;
+# the markers and the update are one transaction (at most 100 items)
+INSIGHTS_EVENTS_PER_TRANSACTION = INSIGHTS_UPDATE_SIZE // 2
+
+
+def insightsSk(month: str) -> str:
+  return INSIGHTS_PREFIX + month
+
+
+def categoriesMap(categories) -> dict:
+  """ the categories of an insights item, as stored now (map) or before (JSON string) """
+  if isinstance(categories, str):
+    return json.loads(categories, parse_float=Decimal, parse_int=Decimal)
+  return dict(categories or {})
+
+
+def insightsCategories(deltas: dict) -> dict:
+  """ `deltas` with the empty or missing categories added up under UNCATEGORIZED """
+  categories = {}
+  for category, amount in deltas.items():
+    category = category or UNCATEGORIZED
+    categories[category] = categories.get(category, 0) + amount
+  return categories
+
+
+def _conditionFailed(error) -> bool:
+  return error.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
+
+def convertInsights(activities_table, user: str, sk: str, categories: str) -> bool:
+  """
+  Rewrites a JSON string `categories` as a map. Only applies if the item
+  still holds that string, returns False if something changed it first.
+  """
+  try:
+    activities_table.meta.client.update_item(
+      TableName=activities_table.name,
+      Key={"user": user, "sk": sk},
+      UpdateExpression="SET #categories = :map",
+      ConditionExpression="#categories = :string",
+      ExpressionAttributeNames={"#categories": "categories"},
+      ExpressionAttributeValues={":map": categoriesMap(categories), ":string": categories},
+    )
+  except botocore.exceptions.ClientError as error:
+    if not _conditionFailed(error):
+      raise
+    return False
+  return True
+
+
+def _addParams(tableName: str, user: str, month: str, deltas: dict) -> dict:
+  names = {"#categories": "categories", "#date": "date"}
+  values = {":month": month, ":map": "M"}
+  adds = []
+  for i, (category, amount) in enumerate(insightsCategories(deltas).items()):
+    names[f"#c{i}"] = category
+    values[f":v{i}"] = amount
+    adds.append(f"#categories.#c{i} :v{i}")
+  return {
+    "TableName": tableName,
+    "Key": {"user": user, "sk": insightsSk(month)},
+    "UpdateExpression": "SET #date = if_not_exists(#date, :month) ADD " + ", ".join(adds),
+    # nested ADD needs the map to exist already
+    "ConditionExpression": "attribute_type(#categories, :map)",
+    "ExpressionAttributeNames": names,
+    "ExpressionAttributeValues": values,
+  }
+
+
+def _ensureMap(activities_table, user: str, month: str):
+  """ creates the month's empty categories map, or converts a JSON string one """
+  response = activities_table.meta.client.update_item(
+    TableName=activities_table.name,
+    Key={"user": user, "sk": insightsSk(month)},
+    UpdateExpression="SET #categories = if_not_exists(#categories, :empty), #date = if_not_exists(#date, :month)",
+    ExpressionAttributeNames={"#categories": "categories", "#date": "date"},
+    ExpressionAttributeValues={":empty": {}, ":month": month},
+    ReturnValues="ALL_NEW",
+  )
+  categories = response["Attributes"]["categories"]
+  if isinstance(categories, str):
+    convertInsights(activities_table, user, insightsSk(month), categories)
+
+
+def addInsights(activities_table, user: str, month: str, deltas: dict, attempts: int = 3):
+  """ adds `deltas` (category -> amount) to the month's category totals """
+  client = activities_table.meta.client
+  categories = list(deltas.items())
+  for start in range(0, len(categories), INSIGHTS_UPDATE_SIZE):
+    chunk = dict(categories[start:start + INSIGHTS_UPDATE_SIZE])
+    for _ in range(attempts):
+      try:
+        client.update_item(**_addParams(activities_table.name, user, month, chunk))
+        break
+      except botocore.exceptions.ClientError as error:
+        if not _conditionFailed(error):
+          raise
+      _ensureMap(activities_table, user, month)
+    else:
+      raise RuntimeError(f"could not update insights of {user} for {month}")
+
+
+def streamEventSk(eventId: str) -> str:
+  return STREAM_EVENT_PREFIX + eventId
+
+
+def _sumDeltas(events: list) -> dict:
+  deltas = {}
+  for _, eventDeltas in events:
+    for category, amount in eventDeltas.items():
+      deltas[category] = deltas.get(category, 0) + amount
+  return deltas
+
+
+def _addEventsOnce(activities_table, user: str, month: str, events: list, attempts: int):
+  client = activities_table.meta.client
+  expires = int(time.time()) + STREAM_EVENT_TTL_SECONDS
+  for _ in range(attempts):
+    if not events:
+      return
+    markers = [{"Put": {
+      "TableName": activities_table.name,
+      "Item": {"user": user, "sk": streamEventSk(eventId), "ttl": expires},
+      "ConditionExpression": "attribute_not_exists(#sk)",
+      "ExpressionAttributeNames": {"#sk": "sk"},
+    }} for eventId, _ in events]
+    update = {"Update": _addParams(activities_table.name, user, month, _sumDeltas(events))}
+    try:
+      client.transact_write_items(TransactItems=[update] + markers)
+      return
+    except botocore.exceptions.ClientError as error:
+      if error.response["Error"]["Code"] != "TransactionCanceledException":
+        raise
+      reasons = [reason.get("Code") for reason in error.response.get("CancellationReasons", [])]
+    if len(reasons) != len(markers) + 1 or any(code not in ("None", "ConditionalCheckFailed", None) for code in reasons):
+      # conflicts with another transaction on the same item, just try again
+      continue
+    # events whose marker exists were added by an earlier delivery of the batch
+    events = [event for event, code in zip(events, reasons[1:]) if code != "ConditionalCheckFailed"]
+    if reasons[0] == "ConditionalCheckFailed":
+      _ensureMap(activities_table, user, month)
+  raise RuntimeError(f"could not update insights of {user} for {month}")
+
+
+def addInsightsOnce(activities_table, user: str, month: str, events: list, attempts: int = 5):
+  """
+  Adds the deltas of stream events, a list of (eventID, category -> amount),
+  to the month's category totals, each event at most once. Every event
+  writes a stream#{eventID} marker in the same transaction as its deltas,
+  events that already have one are left out, so a retried batch can't
+  count them twice. Markers expire after STREAM_EVENT_TTL_SECONDS.
+  """
+  for start in range(0, len(events), INSIGHTS_EVENTS_PER_TRANSACTION):
+    _addEventsOnce(activities_table, user, month, events[start:start + INSIGHTS_EVENTS_PER_TRANSACTION], attempts)
+
+
+def addAllInsights(activities_table, events: dict, workers: int = INSIGHTS_WORKERS) -> set:
+  """
+  addInsightsOnce for every user -> month -> [(eventID, deltas)] in `events`,
+  months in parallel. Returns the (user, month) pairs that failed.
+  """
+  updates = [(user, month, monthEvents)
+             for user, months in events.items()
+             for month, monthEvents in months.items() if monthEvents]
+  failed = set()
+  if not updates:
+    return failed
+  # addInsightsOnce only goes through the resource's client, which is thread safe
+  with ThreadPoolExecutor(max_workers=min(workers, len(updates))) as executor:
+    futures = {executor.submit(addInsightsOnce, activities_table, *update): update[:2] for update in updates}
+    for future, key in futures.items():
+      try:
+        future.result()
+      except Exception as error:
+        print("failed to update insights", key, error)
+        failed.add(key)
+  return failed
+
+
+def putInsights(activities_table, user: str, month: str, categories: dict):
+  """ replaces the month's category totals, for full recomputes """
+  activities_table.update_item(
+    Key={"user": user, "sk": insightsSk(month)},
+    UpdateExpression="SET #categories = :categories, #date = if_not_exists(#date, :month)",
+    ExpressionAttributeNames={"#categories": "categories", "#date": "date"},
+    ExpressionAttributeValues={":categories": insightsCategories(categories), ":month": month},
+  )
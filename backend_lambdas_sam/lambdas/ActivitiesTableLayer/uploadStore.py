@@ -0,0 +1,100 @@
+import gzip
+import io
+import os
+
+import botocore.exceptions
+
+# raw uploads are stored gzip compressed under a key derived from their
+# checksum, so the same file is only ever stored once per user and format
+
+# characters compressed at a time, so the body is never encoded as a whole
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+def uploadKey(user: str, file_format: str, chksum: str) -> str:
+  return f"{user}/{file_format or 'json'}/{chksum}.csv.gz"
+
+
+def compressUpload(body: str) -> bytes:
+  buffer = io.BytesIO()
+  # mtime is fixed so the same body always compresses to the same bytes
+  with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as compressed:
+    for start in range(0, len(body), UPLOAD_CHUNK_SIZE):
+      compressed.write(body[start:start + UPLOAD_CHUNK_SIZE].encode("utf-8"))
+  return buffer.getvalue()
+
+
+class GzipStream(io.RawIOBase):
+  """ readable gzip of the byte `chunks`, compressed as it is read so the file is never held whole """
+
+  def __init__(self, chunks):
+    self._chunks = iter(chunks)
+    self._sink = io.BytesIO()
+    # the same mtime as compressUpload, the same content compresses to the same bytes
+    self._gzip = gzip.GzipFile(fileobj=self._sink, mode="wb", mtime=0)
+    self._pending = bytearray()
+    self._done = False
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer) -> int:
+    while len(self._pending) < len(buffer) and not self._done:
+      chunk = next(self._chunks, None)
+      if chunk is None:
+        self._gzip.close()
+        self._done = True
+      else:
+        self._gzip.write(chunk)
+      self._pending += self._sink.getvalue()
+      self._sink.seek(0)
+      self._sink.truncate()
+    size = min(len(buffer), len(self._pending))
+    buffer[:size] = self._pending[:size]
+    del self._pending[:size]
+    return size
+
+
+def storeUpload(s3, user: str, file_format: str, body: str, chksum: str) -> str:
+  """ stores the upload unless an object with the same content exists, returns its key """
+  s3_key = uploadKey(user, file_format, chksum)
+  try:
+    s3.Object(os.environ.get("ACTIVITIES_BUCKET", ""), s3_key).put(
+      Body=compressUpload(body),
+      ContentType="text/csv",
+      ContentEncoding="gzip",
+      IfNoneMatch="*",
+    )
+    print(f"stored upload, key={s3_key}")
+  except botocore.exceptions.ClientError as error:
+    # PreconditionFailed: already stored, ConditionalRequestConflict: being stored right now
+    if error.response["Error"]["Code"] not in ("PreconditionFailed", "ConditionalRequestConflict"):
+      raise
+    print(f"upload already stored, key={s3_key}")
+  return s3_key
+
+
+def readUpload(s3, s3_key: str) -> str:
+  """ contents of a stored upload (the file attribute of a chksum# item) """
+  response = s3.Object(os.environ.get("ACTIVITIES_BUCKET", ""), s3_key).get()
+  data = response["Body"].read()
+  # uploads stored before compression are plain csv
+  if "gzip" in response.get("ContentEncoding", "") or s3_key.endswith(".gz"):
+    data = gzip.decompress(data)
+  return data.decode("utf-8")
+
+
+def storeUploadObject(s3, bucket: str, source_key: str, user: str, file_format: str, chksum: str) -> str:
+  """
+  Stores the (plain csv) object at source_key the way storeUpload stores a
+  body, streamed through gzip. Returns the stored key.
+  """
+  s3_key = uploadKey(user, file_format, chksum)
+  body = s3.Object(bucket, source_key).get()["Body"]
+  # a repeat of the same content rewrites the same bytes
+  s3.Object(bucket, s3_key).upload_fileobj(
+    GzipStream(body.iter_chunks()),
+    ExtraArgs={"ContentType": "text/csv", "ContentEncoding": "gzip"},
+  )
+  print(f"stored upload, key={s3_key}")
+  return s3_key
@@ -3,10 +3,9 @@ import os
 import boto3
 
 from auth_layer import get_user_id
-from getActivities import getActivitiesForCategory, getActivities, getRelatedActivities, getEmptyDescriptionActivities
-from postActivities import postActivities
-from deleteActivities import delete_activities
-from patchActivity import patchActivity
+
+# route modules are imported inside lambda_handler so a cold start only
+# pays for the route that is being called (e.g. GET never loads csv/hashlib)
 
 activities_table = None
 
@@ -23,9 +22,6 @@ def lambda_handler(event, _):
         table_name = os.environ.get("ACTIVITIES_TABLE", "")
         activities_table = dynamodb.Table(table_name)
 
-    if not s3:
-        s3 = boto3.resource("s3")
-
     user_id = get_user_id(event)
     if not user_id:
         return {
@@ -36,10 +32,28 @@ def lambda_handler(event, _):
     print(event)
     method = event.get("routeKey", "").split(" ")[0]
     if method == "POST":
+        if not s3:
+            s3 = boto3.resource("s3")
         params = event.get("queryStringParameters", {})
         file_format = params.get("format")
+        if params.get("type", "") == "upload":
+            # large files: returns a presigned url, the file is ingested from S3
+            from uploadJobs import createUploadJob
+            return createUploadJob(user_id, file_format, activities_table, s3)
+        from postActivities import postActivities, MAX_DUPLICATE_DAYS
         body = event["body"]
         preview = params.get("type", "") == "preview"
+        # flag rows up to this many days apart as duplicates (0 = same day only)
+        try:
+            duplicate_days = int(params.get("duplicateDays", 0))
+        except ValueError:
+            duplicate_days = -1
+        if duplicate_days < 0:
+            return {
+                "statusCode": 400,
+                "body": "duplicateDays must be a non-negative number of days",
+            }
+        duplicate_days = min(duplicate_days, MAX_DUPLICATE_DAYS)
         print("processing POST request", preview)
 
         return postActivities(
@@ -48,11 +62,19 @@ def lambda_handler(event, _):
             body,
             activities_table,
             s3,
-            preview)
+            preview,
+            duplicate_days)
     elif method == "GET":
         params = event.get("queryStringParameters", {})
         print("processing GET request")
 
+        job_id = params.get("job", "")
+        if job_id:
+            from uploadJobs import getUploadJob
+            return getUploadJob(user_id, job_id, activities_table)
+
+        from getActivities import getActivitiesForCategory, getActivities, getRelatedActivities, getEmptyDescriptionActivities
+
         check_related = params.get("related", False)
         if check_related:
             return getRelatedActivities(
@@ -62,8 +84,9 @@ def lambda_handler(event, _):
 
         size = int(params.get("size", 0))
         next_date = params.get("nextDate", "")
+        cursor = params.get("cursor", "")
         description = params.get("description", "")
-        order_by_amount = params.get("orderByAmount", False)
+        order_by_amount = params.get("orderByAmount", "false") == "true"
         account = params.get("account", "")
         amount_max = params.get("amountMax", None)
         amount_min = params.get("amountMin", None)
@@ -83,7 +106,9 @@ def lambda_handler(event, _):
             return getEmptyDescriptionActivities(
                 user_id,
                 size,
-                activities_table)
+                activities_table,
+                start_date,
+                end_date)
 
         category = params.get("category", "")
         if category:
@@ -107,13 +132,18 @@ def lambda_handler(event, _):
             account,
             amount_max,
             amount_min,
-            is_dirty)
+            is_dirty,
+            start_date,
+            end_date,
+            cursor)
     elif method == "DELETE":
+        from deleteActivities import delete_activities
         params = event.get("queryStringParameters", {})
         sk = params.get("sk", "")
         print("processing DELETE request")
         return delete_activities(user_id, sk, activities_table)
     elif method == "PATCH":
+        from patchActivity import patchActivity
         params = event.get("queryStringParameters", {})
         sk = params.get("sk", "")
         body = event["body"]
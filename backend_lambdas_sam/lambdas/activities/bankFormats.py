@@ -0,0 +1,218 @@
+import csv
+import re
+import sys
+import datetime
+from decimal import Decimal
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+from libs import Activity, mask_account_number
+
+# csv statement formats. each bank is a declarative FormatSpec, compiled once
+# at import into a converter from a csv row to an Activity, so supporting a
+# new bank is one registerFormat call. when an upload has no format it is
+# sniffed from its first line (see sniffFormat).
+
+_ZERO = Decimal(0)
+
+
+class UnknownFormatError(ValueError):
+    pass
+
+
+class FormatSpec:
+    """
+    Column layout of one bank's csv export. Column arguments are 0 based
+    indices into the row.
+    amount: debit column, or the only amount column. expenses are stored
+            positive, so negateAmount flips a column that has them negative.
+    credit: optional column read (and negated) when the amount column is empty.
+    skipZeroAmount: rows with an empty or "0" amount are skipped.
+    account: column index, or a constant account name. maskAccount keeps
+             the last 4 characters, accountType appends "-{that column}".
+    category: column with the bank's category, the description otherwise.
+    headerRows: leading rows that are never activities.
+    header / firstRow: how sniffFormat recognizes the format, by its header
+             column names or by a regex its first (data) line matches.
+    """
+
+    def __init__(self,
+                 name: str,
+                 date: int,
+                 dateLayout: str,
+                 amount: int,
+                 description: int,
+                 credit: Optional[int] = None,
+                 negateAmount: bool = False,
+                 skipZeroAmount: bool = False,
+                 account: Union[int, str] = "",
+                 maskAccount: bool = False,
+                 accountType: Optional[int] = None,
+                 category: Optional[int] = None,
+                 headerRows: int = 0,
+                 header: Sequence[str] = (),
+                 firstRow: Optional[str] = None,
+                 ):
+        self.name = name
+        self.date = date
+        self.dateLayout = dateLayout
+        self.amount = amount
+        self.description = description
+        self.credit = credit
+        self.negateAmount = negateAmount
+        self.skipZeroAmount = skipZeroAmount
+        self.account = account
+        self.maskAccount = maskAccount
+        self.accountType = accountType
+        self.category = category
+        self.headerRows = headerRows
+        self.header = list(header)
+        self.firstRow = re.compile(firstRow) if firstRow else None
+        self.convert: Callable[[List[str]], Optional[Activity]] = compileConverter(self)
+
+
+def compileDate(layout: str) -> Callable[[str], str]:
+    """
+    Parser from `layout` (strptime style, e.g. "%m/%d/%Y") to "YYYY-MM-DD".
+    Fixed width dates are sliced, others split on the separator, and results
+    are cached since a statement only spans a few hundred distinct days.
+    Impossible dates (02/30) raise ValueError.
+    """
+    fields = layout.replace("%", "")
+    separator = fields[1]
+    order = fields.split(separator)
+    if sorted(order) != ["Y", "d", "m"]:
+        raise ValueError(f"unsupported date layout {layout}")
+    year, month, day = order.index("Y"), order.index("m"), order.index("d")
+
+    def check(text: str, y: int, m: int, d: int) -> str:
+        try:
+            datetime.date(y, m, d)
+        except ValueError:
+            raise ValueError(f"date {text!r} does not match {layout}") from None
+        return f"{y:04d}-{m:02d}-{d:02d}"
+
+    if order == ["Y", "m", "d"]:
+        def parse(text: str) -> str:
+            if len(text) != 10 or text[4] != separator or text[7] != separator:
+                raise ValueError(f"date {text!r} does not match {layout}")
+            return check(text, int(text[:4]), int(text[5:7]), int(text[8:]))
+    else:
+        def parse(text: str) -> str:
+            parts = text.split(separator)
+            if len(parts) != 3:
+                raise ValueError(f"date {text!r} does not match {layout}")
+            return check(text, int(parts[year]), int(parts[month]), int(parts[day]))
+    return lru_cache(maxsize=4096)(parse)
+
+
+def compileConverter(spec: FormatSpec) -> Callable[[List[str]], Optional[Activity]]:
+    parseDate = compileDate(spec.dateLayout)
+    dateColumn = spec.date
+    descriptionColumn = spec.description
+    amountColumn = spec.amount
+    creditColumn = spec.credit
+    categoryColumn = spec.category
+    negate = spec.negateAmount
+    skipZero = spec.skipZeroAmount
+    # the credit column is often left off when it is empty
+    required = [dateColumn, descriptionColumn, amountColumn]
+    required += [column for column in (spec.account, spec.accountType, categoryColumn) if isinstance(column, int)]
+    minColumns = max(required) + 1
+
+    if isinstance(spec.account, str):
+        def account(row): return spec.account
+    else:
+        accountColumn, typeColumn = spec.account, spec.accountType
+        mask = mask_account_number if spec.maskAccount else (lambda value: value)
+        # an upload has a handful of accounts, every row shares the same strings
+        if typeColumn is None:
+            def account(row): return sys.intern(mask(row[accountColumn]))
+        else:
+            def account(row): return sys.intern(f"{mask(row[accountColumn])}-{row[typeColumn]}")
+
+    def convert(row: List[str]) -> Optional[Activity]:
+        if len(row) < minColumns:
+            return None
+        text = row[amountColumn]
+        if skipZero and (not text or text == "0"):
+            print("skipping row" + ','.join(row))
+            return None
+        if text or creditColumn is None:
+            amount = Decimal(text)
+            if negate:
+                amount = _ZERO - amount
+        else:
+            amount = _ZERO - Decimal(row[creditColumn] if creditColumn < len(row) else "")
+        return Activity(
+            account=account(row),
+            date=parseDate(row[dateColumn]),
+            # merchants and categories repeat across rows
+            description=sys.intern(row[descriptionColumn]),
+            category=sys.intern(row[categoryColumn]) if categoryColumn is not None else None,
+            amount=amount,
+        )
+    return convert
+
+
+FORMATS: Dict[str, FormatSpec] = {}
+
+
+def registerFormat(spec: FormatSpec) -> FormatSpec:
+    FORMATS[spec.name] = spec
+    return spec
+
+
+def sniffFormat(firstLine: str) -> Optional[str]:
+    """ name of the format whose header (or first row) `firstLine` is, None if nothing matches """
+    firstLine = firstLine.lstrip("\ufeff")
+    columns = [column.strip() for column in next(csv.reader([firstLine]), [])]
+    for spec in FORMATS.values():
+        if spec.header and columns[:len(spec.header)] == spec.header:
+            return spec.name
+        if spec.firstRow and spec.firstRow.match(firstLine):
+            return spec.name
+    return None
+
+
+registerFormat(FormatSpec(
+    name="rbc",
+    header=["Account Type", "Account Number", "Transaction Date", "Cheque Number", "Description 1", "Description 2", "CAD$", "USD$"],
+    headerRows=1,
+    date=2,
+    dateLayout="%m/%d/%Y",
+    account=1,
+    maskAccount=True,
+    accountType=0,
+    category=4,
+    description=5,
+    # rbc uses negative values for expenses, rows without a CAD amount are skipped
+    amount=6,
+    negateAmount=True,
+    skipZeroAmount=True,
+))
+
+registerFormat(FormatSpec(
+    name="cap1",
+    header=["Transaction Date", "Posted Date", "Card No.", "Description", "Category", "Debit", "Credit"],
+    headerRows=1,
+    date=0,
+    dateLayout="%Y-%m-%d",
+    account=2,
+    description=3,
+    category=4,
+    amount=5,
+    credit=6,
+))
+
+registerFormat(FormatSpec(
+    name="td",
+    # no header, rows start with a m/d/y date
+    firstRow=r"\d{1,2}/\d{1,2}/\d{4},",
+    date=0,
+    dateLayout="%m/%d/%Y",
+    account="td",
+    description=1,
+    amount=2,
+    credit=3,
+))
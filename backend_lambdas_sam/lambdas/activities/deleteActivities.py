@@ -2,6 +2,8 @@ import json
 
 import botocore
 from boto3.dynamodb.conditions import Key
+from batchWriter import ConcurrentBatchWriter, BatchWriteError
+from activityIndexes import INDEX_KEY_ATTRIBUTES
 
 def delete_activities(user: str, sk: str, activities_table):
     # deletes all activites for a user, or a specific activity if sk is provided
@@ -18,20 +20,22 @@ def delete_activities(user: str, sk: str, activities_table):
             row = response.get("Attributes", {})
 
             # now soft delete the row by adding 'deleted#' in front
-            # of it's sk
+            # of it's sk, without the index keys so it drops out of the indexes
             activities_table.put_item(Item={
-                **row,
+                **{key: value for key, value in row.items() if key not in INDEX_KEY_ATTRIBUTES},
                 "sk": f"deleted#{sk}"
             })
             count = 1
         else:
             print("deleting all activities")
-            all_activities = activities_table.query(
-                KeyConditionExpression=Key('user').eq(user) & Key(
-                    'sk').between("0000-00-00", "9999-99-99")
-            )
-            while True:
-                with activities_table.batch_writer() as batch:
+            params = {
+                "KeyConditionExpression": Key('user').eq(user) & Key(
+                    'sk').between("0000-00-00", "9999-99-99"),
+                "ProjectionExpression": "sk",
+            }
+            all_activities = activities_table.query(**params)
+            with ConcurrentBatchWriter(activities_table) as batch:
+                while True:
                     for each in all_activities['Items']:
                         batch.delete_item(
                             Key={
@@ -40,14 +44,13 @@ def delete_activities(user: str, sk: str, activities_table):
                             }
                         )
                         count += 1
-                if 'LastEvaluatedKey' in all_activities:
-                    all_activities = activities_table.query(
-                        KeyConditionExpression=Key('user').eq(user) & Key(
-                            'sk').between("0000-00-00", "9999-99-99"),
-                        ExclusiveStartKey=all_activities['LastEvaluatedKey']
-                    )
-                else:
-                    break
+                    if 'LastEvaluatedKey' in all_activities:
+                        all_activities = activities_table.query(
+                            **params,
+                            ExclusiveStartKey=all_activities['LastEvaluatedKey']
+                        )
+                    else:
+                        break
         return {
             "statusCode": 200,
             "body": json.dumps({
@@ -55,7 +58,7 @@ def delete_activities(user: str, sk: str, activities_table):
                 "data": "success"
             })
         }
-    except botocore.exceptions.ClientError as error:
+    except (botocore.exceptions.ClientError, BatchWriteError) as error:
         print(error)
         return {
             "statusCode": 500,
@@ -1,11 +1,134 @@
 import re
 import json
+import heapq
+import base64
+import binascii
+from decimal import Decimal
 from typing import Optional
 from boto3.dynamodb.conditions import Key, Attr
 import botocore
 from functools import reduce
 from datetime import timedelta, datetime
-from libs import getMappings, applyMappings
+from libs import getMappings, mapActivity
+from mappingMatcher import MappingMatcher
+from mappingCache import mapping_cache
+from activityIndexes import REVIEW_INDEX, ACCOUNT_INDEX, AMOUNT_INDEX, reviewKey, accountKey, amountKey
+from descriptionIndex import BATCH_GET_SIZE, BatchGetError, searchActivitySks, descriptionMatches, batchGetActivities
+
+
+DEFAULT_START_DATE = "0000-00-00"
+DEFAULT_END_DATE = "9999-99-99"
+
+
+def skDateRange(startDate: str, endDate: str):
+    # activity sks are the date followed by an id, "~" sorts after every id
+    # character so the whole end date is included
+    return startDate or DEFAULT_START_DATE, (endDate or DEFAULT_END_DATE) + "~"
+
+
+def encodeCursor(lastKey: dict, startDate: str, endDate: str) -> str:
+    """ opaque cursor holding the full start key and the date range of the query """
+    return base64.urlsafe_b64encode(json.dumps({
+        "key": lastKey,
+        "startDate": startDate,
+        "endDate": endDate,
+    }).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decodeCursor(cursor: str) -> Optional[dict]:
+    try:
+        # padding is stripped so the cursor can go in a query string as is
+        decoded = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        return None
+    if not isinstance(decoded, dict) or not isinstance(decoded.get("key"), dict):
+        return None
+    return decoded
+
+
+def _pageKey(lastKey: dict, startDate: str, endDate: str) -> dict:
+    # "sk" is what existing clients send back as nextDate, the cursor
+    # carries everything needed to continue the same query
+    if not lastKey:
+        return {}
+    return {
+        **lastKey,
+        "cursor": encodeCursor(lastKey, startDate, endDate)
+    }
+
+
+def _exclusiveStartKey(user: str, startKey: str, indexName: Optional[str], indexKey: Optional[dict], activities_table):
+    # clients only send back the sk of the last item, the index key of that
+    # item is derived from the request or, for the amount index, read back
+    exclusiveStartKey = {
+        "user": user,
+        "sk": startKey
+    }
+    if indexName == AMOUNT_INDEX:
+        item = activities_table.get_item(
+            Key=exclusiveStartKey,
+            ProjectionExpression="amount_key"
+        ).get("Item", {})
+        exclusiveStartKey["amount_key"] = item.get("amount_key", "")
+    elif indexKey:
+        exclusiveStartKey.update(indexKey)
+    return exclusiveStartKey
+
+
+def _amountPage(user: str, items: list, size: int, exclusiveStartKey: Optional[dict]):
+    # same order and cursor as the amount index: largest amount_key first, then sk
+    def position(item):
+        return item.get("amount_key") or amountKey(item["amount"]), item["sk"]
+    if exclusiveStartKey:
+        start = (exclusiveStartKey.get("amount_key", ""), exclusiveStartKey.get("sk", ""))
+        items = [item for item in items if position(item) < start]
+    if size <= 0 or len(items) <= size:
+        return sorted(items, key=position, reverse=True), {}
+    page = heapq.nlargest(size, items, key=position)
+    amount_key, sk = position(page[-1])
+    return page, {"user": user, "sk": sk, "amount_key": amount_key}
+
+
+def _searchActivities(
+        user: str,
+        sks: list,
+        size: int,
+        activities_table,
+        startKey: Optional[str],
+        orderByAmount: bool,
+        matches,
+        startDate: str,
+        endDate: str):
+    # sks come from the description index newest first, only fetch as many
+    # items as it takes to fill the page
+    matcher = mapping_cache.getMatcher(activities_table, user)
+    if startKey:
+        sks = [sk for sk in sks if sk < startKey]
+    # ordering by amount needs every match
+    pageSize = 0 if orderByAmount else size
+    fetchSize = min(pageSize, BATCH_GET_SIZE) if pageSize > 0 else BATCH_GET_SIZE
+    allData = []
+    lastKey = {}
+    for start in range(0, len(sks), fetchSize):
+        for item in batchGetActivities(activities_table, user, sks[start:start + fetchSize]):
+            item = mapActivity(matcher, item)
+            if matches(item):
+                allData.append(item)
+        if pageSize > 0 and len(allData) >= pageSize:
+            allData = allData[:pageSize]
+            if allData[-1]["sk"] != sks[-1]:
+                lastKey = {"user": user, "sk": allData[-1]["sk"]}
+            break
+    if orderByAmount:
+        allData = heapq.nlargest(size if size > 0 else len(allData), allData, key=lambda x: Decimal(x["amount"]))
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "data": allData,
+            "count": len(allData),
+            "LastEvaluatedKey": _pageKey(lastKey, startDate, endDate)
+        })
+    }
 
 
 def getActivities(
@@ -18,41 +141,111 @@ def getActivities(
         account: Optional[str] = None,
         amountMax: Optional[int] = None,
         amountMin: Optional[int] = None,
-        isDirty: Optional[bool] = None):
-    try:
-        query_params = {
-            "KeyConditionExpression": Key('user').eq(user) & Key('sk').between("0000-00-00", "9999-99-99"),
-            "ScanIndexForward": False
-        }
-        if startKey:
-            query_params["ExclusiveStartKey"] = {
-                "user": user,
-                "sk": startKey
+        isDirty: Optional[bool] = None,
+        startDate: str = DEFAULT_START_DATE,
+        endDate: str = DEFAULT_END_DATE,
+        cursor: Optional[str] = None):
+    exclusiveStartKey = None
+    if cursor:
+        decoded = decodeCursor(cursor)
+        if decoded is None:
+            return {
+                "statusCode": 400,
+                "body": "invalid cursor"
             }
-        filter_exps = []
-        noLimit = False
+        # the cursor's range wins so a page never continues a different query
+        exclusiveStartKey = decoded["key"]
+        startKey = exclusiveStartKey.get("sk")
+        startDate = decoded.get("startDate", startDate)
+        endDate = decoded.get("endDate", endDate)
+    startDate = startDate or DEFAULT_START_DATE
+    endDate = endDate or DEFAULT_END_DATE
+    dateBounded = startDate != DEFAULT_START_DATE or endDate != DEFAULT_END_DATE
+    try:
+        skCondition = Key('sk').between(*skDateRange(startDate, endDate))
+        amountCondition = None
+        if amountMin and amountMax:
+            amountCondition = ("between", amountKey(amountMin), amountKey(amountMax))
+        elif amountMin:
+            amountCondition = ("gte", amountKey(amountMin))
+        elif amountMax:
+            amountCondition = ("lte", amountKey(amountMax))
+
+        if description:
+            sks = searchActivitySks(activities_table, user, description, *skDateRange(startDate, endDate))
+            if sks is not None:
+                # the remaining conditions are checked on the fetched items
+                checks = [lambda item: descriptionMatches(description, item.get("description", ""))]
+                if account:
+                    checks.append(lambda item: item.get("account") == account)
+                if isDirty is not None:
+                    checks.append(lambda item: item["dirty"] == isDirty)
+                if amountCondition:
+                    low = amountCondition[1] if amountCondition[0] in ("between", "gte") else None
+                    high = amountCondition[-1] if amountCondition[0] in ("between", "lte") else None
+                    checks.append(lambda item: (low is None or amountKey(item["amount"]) >= low)
+                                  and (high is None or amountKey(item["amount"]) <= high))
+
+                def matches(item):
+                    return all(check(item) for check in checks)
+                return _searchActivities(
+                    user, sks, size, activities_table, startKey, orderByAmount, matches, startDate, endDate)
 
-        mappings = getMappings(user, activities_table)
+        # pick the index that turns the most selective condition into a key
+        # condition, everything else becomes a FilterExpression. the amount
+        # index returns items in amount order, so it only serves queries
+        # ordered by amount, an amount range alone stays in date order. a
+        # date range is usually more selective than an amount range, so it
+        # only serves those over the whole history
+        indexName = None
+        indexKey = None
+        filter_exps = []
+        # a bounded date range ordered by amount is read whole and sorted here
+        sortByAmount = orderByAmount and dateBounded
+        if not dateBounded and orderByAmount:
+            indexName = AMOUNT_INDEX
+            keyCondition = Key('user').eq(user)
+            if amountCondition:
+                keyCondition = keyCondition & getattr(Key('amount_key'), amountCondition[0])(*amountCondition[1:])
+        elif account:
+            indexName = ACCOUNT_INDEX
+            indexKey = {"account_key": accountKey(user, account)}
+            keyCondition = Key('account_key').eq(indexKey["account_key"]) & skCondition
+        elif isDirty is not None:
+            # dirty flag is stored at ingest, so the review index only holds matching activities
+            indexName = REVIEW_INDEX
+            indexKey = {"review_key": reviewKey(user, isDirty)}
+            keyCondition = Key('review_key').eq(indexKey["review_key"]) & skCondition
+        else:
+            keyCondition = Key('user').eq(user) & skCondition
 
+        if dateBounded and indexName == AMOUNT_INDEX:
+            filter_exps.append(Attr('sk').between(*skDateRange(startDate, endDate)))
+        if account and indexName != ACCOUNT_INDEX:
+            filter_exps.append(Attr('account').eq(account))
+        if isDirty is not None and indexName != REVIEW_INDEX:
+            filter_exps.append(Attr('dirty').eq(isDirty))
+        if amountCondition and indexName != AMOUNT_INDEX:
+            filter_exps.append(getattr(Attr('amount_key'), amountCondition[0])(*amountCondition[1:]))
         if description:
             filter_exps.append(
                 Attr('search_term').contains(description.lower()))
-            noLimit = True
 
-        if account:
-            filter_exps.append(Attr('account').eq(account))
-            noLimit = True
+        query_params = {
+            "KeyConditionExpression": keyCondition,
+            "ScanIndexForward": False
+        }
+        if indexName:
+            query_params["IndexName"] = indexName
+        if startKey and not exclusiveStartKey:
+            exclusiveStartKey = _exclusiveStartKey(
+                user, startKey, AMOUNT_INDEX if sortByAmount else indexName, indexKey, activities_table)
+        if exclusiveStartKey and not sortByAmount:
+            query_params["ExclusiveStartKey"] = exclusiveStartKey
+        # filtered reads fetch every page so the client gets all matches
+        noLimit = len(filter_exps) > 0 or sortByAmount
 
-        if amountMax:
-            filter_exps.append(Attr('amount').lte(int(amountMax)))
-            noLimit = True
-
-        if amountMin:
-            filter_exps.append(Attr('amount').gte(int(amountMin)))
-            noLimit = True
-        
-        if isDirty is not None:
-            noLimit = True
+        matcher = mapping_cache.getMatcher(activities_table, user)
 
         if filter_exps:
             query_params["FilterExpression"] = reduce(
@@ -69,9 +262,9 @@ def getActivities(
         lastKey = data.get("LastEvaluatedKey", {})
 
         while lastKey and noLimit:
+            query_params["ExclusiveStartKey"] = lastKey
             data = activities_table.query(
-                **query_params,
-                ExclusiveStartKey=lastKey
+                **query_params
             )
             items.extend(data.get("Items", []))
             lastKey = data.get("LastEvaluatedKey", {})
@@ -79,21 +272,21 @@ def getActivities(
         date_regex = re.compile(r"^\d{4}-\d{2}-\d{2}")
         # TODO: redo lastevaluatedkey to be date instead of sk
 
-        allData = [{
-            **applyMappings(mappings, item),
-            "amount": str(item["amount"]),
-        } for item in items if date_regex.match(item["sk"])]
+        allData = [mapActivity(matcher, item) for item in items if date_regex.match(item["sk"])]
         if isDirty is not None:
             allData = [item for item in allData if item["dirty"] == isDirty]
+        lastKey = data.get("LastEvaluatedKey", {})
+        if sortByAmount:
+            allData, lastKey = _amountPage(user, allData, size, exclusiveStartKey)
         return {
             "statusCode": 200,
             "body": json.dumps({
                 "data": allData,
                 "count": len(allData),
-                "LastEvaluatedKey": data.get("LastEvaluatedKey", {})
+                "LastEvaluatedKey": _pageKey(lastKey, startDate, endDate)
             })
         }
-    except botocore.exceptions.ClientError as error:
+    except (botocore.exceptions.ClientError, BatchGetError) as error:
         print(error)
         return {
             "statusCode": 500,
@@ -128,27 +321,26 @@ def getActivitiesForCategory(
 
     category_activities = activities_table.query(
         KeyConditionExpression=Key('user').eq(user_id) & Key(
-            'sk').between(startDate, endDate),
+            'sk').between(*skDateRange(startDate, endDate)),
         FilterExpression=filterExps,
     )
     allItems = category_activities.get("Items", [])
     while category_activities.get("LastEvaluatedKey"):
         category_activities = activities_table.query(
             KeyConditionExpression=Key('user').eq(user_id) & Key(
-                'sk').between(startDate, endDate),
+                'sk').between(*skDateRange(startDate, endDate)),
             FilterExpression=filterExps,
             ExclusiveStartKey=category_activities["LastEvaluatedKey"]
         )
         allItems.extend(category_activities.get("Items", []))
 
-    sortedItems = sorted(allItems, key=lambda x: x["amount"], reverse=True)
+    # only the top `limit` are returned, no need to sort everything
+    sortedItems = heapq.nlargest(limit, allItems, key=lambda x: Decimal(x["amount"]))
+    matcher = MappingMatcher(mappings)
     return {
         "statusCode": 200,
         "body": json.dumps({
-            "data": [{
-                **applyMappings(mappings, item),
-                "amount": str(item["amount"]),
-            } for item in sortedItems[:limit]],
+            "data": [mapActivity(matcher, item) for item in sortedItems[:limit]],
             "count": len(allItems)
         })
     }
@@ -228,10 +420,15 @@ def getRelatedActivities(user: str, sk: str, activities_table):
         }
 
 
-def getEmptyDescriptionActivities(user_id, size, activities_table):
+def getEmptyDescriptionActivities(
+        user_id,
+        size,
+        activities_table,
+        startDate: str = DEFAULT_START_DATE,
+        endDate: str = DEFAULT_END_DATE):
     empty_description_activities = activities_table.query(
         KeyConditionExpression=Key('user').eq(user_id) & Key(
-            'sk').between("0000-00-00", "9999-99-99"),
+            'sk').between(*skDateRange(startDate, endDate)),
         FilterExpression=Attr('description').eq(''),
         Limit=size if size else 10
     )
@@ -0,0 +1,156 @@
+import os
+import csv
+import time
+import hashlib
+import itertools
+from datetime import datetime
+from urllib.parse import unquote_plus
+
+import boto3
+import botocore
+
+from mappingCache import mapping_cache
+from uploadStore import storeUploadObject
+from bankFormats import UnknownFormatError, sniffFormat
+from postActivities import isIngested, iterItemsFromRows, writeActivities, putChecksum
+from uploadJobs import (
+        JOB_WAITING,
+        JOB_PROCESSING,
+        JOB_DONE,
+        JOB_DUPLICATE,
+        JOB_FAILED,
+        JOB_TIMEOUT_SECONDS,
+        AUTO_FORMAT,
+        jobSk,
+        parseIncomingKey,
+        updateJob,
+)
+
+# ingests files uploaded through a presigned url (see uploadJobs), triggered
+# by the S3 ObjectCreated event. the file is streamed from S3 twice: once for
+# the checksum so a repeat upload is rejected before anything is written, and
+# once to parse and write the rows, so it is never held in memory. once the
+# job is done the file leaves the upload prefix (ingested files are stored
+# gzipped under uploadKey first), so a second PUT to the same presigned url
+# can't replace the stored file or start the job again. files of failed jobs
+# are kept under the upload prefix
+
+activities_table = None
+
+s3 = None
+
+# rows written between two progress updates on the job item
+PROGRESS_EVERY = int(os.environ.get("INGEST_PROGRESS_EVERY", 1000))
+
+
+def _objectChecksum(s3_object) -> str:
+    # same digest as fileChecksum for the same utf-8 file
+    chksum = hashlib.md5()
+    for chunk in s3_object.get()["Body"].iter_chunks():
+        chksum.update(chunk)
+    return chksum.hexdigest()
+
+
+def _iterObjectLines(s3_object):
+    for line in s3_object.get()["Body"].iter_lines():
+        yield line.decode("utf-8")
+
+
+def _jobIngested(activities_table, user: str, job_id: str) -> bool:
+    job = activities_table.get_item(Key={"user": user, "sk": jobSk(job_id)}).get("Item")
+    return bool(job) and job.get("status") in (JOB_DONE, JOB_DUPLICATE)
+
+
+def ingestUpload(activities_table, s3, bucket: str, s3_key: str, timeout_seconds: int = JOB_TIMEOUT_SECONDS):
+    upload = parseIncomingKey(s3_key)
+    if not upload:
+        print("not an upload, skipping", s3_key)
+        return
+    user, file_format, job_id = upload["user"], upload["file_format"], upload["job_id"]
+    try:
+        # S3 delivers events at least once, only the first one starts the job
+        activities_table.update_item(
+            Key={"user": user, "sk": jobSk(job_id)},
+            UpdateExpression="set #s = :processing, #d = :deadline",
+            ConditionExpression="#s = :waiting",
+            ExpressionAttributeNames={"#s": "status", "#d": "deadline"},
+            ExpressionAttributeValues={
+                ":processing": JOB_PROCESSING,
+                ":waiting": JOB_WAITING,
+                ":deadline": int(time.time()) + timeout_seconds,
+            })
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        print("no waiting upload job found, skipping", s3_key)
+        # the presigned url was used again after the job finished
+        if _jobIngested(activities_table, user, job_id):
+            s3.Object(bucket, s3_key).delete()
+        return
+
+    try:
+        s3_object = s3.Object(bucket, s3_key)
+        chksum = _objectChecksum(s3_object)
+        if isIngested(activities_table, user, chksum):
+            print("skipping duplicate file", s3_key)
+            updateJob(activities_table, user, job_id, status=JOB_DUPLICATE, checksum=chksum)
+            s3_object.delete()
+            return
+
+        lines = _iterObjectLines(s3_object)
+        if file_format == AUTO_FORMAT:
+            firstLine = next(lines, "")
+            file_format = sniffFormat(firstLine)
+            if not file_format:
+                raise UnknownFormatError("unable to detect the file format")
+            lines = itertools.chain([firstLine], lines)
+
+        matcher = mapping_cache.getMatcher(activities_table, user)
+        rows = csv.reader(lines, delimiter=",")
+        dates = writeActivities(
+            activities_table,
+            user,
+            iterItemsFromRows(rows, file_format),
+            matcher,
+            chksum,
+            lambda written: updateJob(activities_table, user, job_id, rows_written=written),
+            PROGRESS_EVERY)
+        stored_key = storeUploadObject(s3, bucket, s3_key, user, file_format, chksum)
+        putChecksum(activities_table, user, chksum, stored_key, dates)
+        updateJob(
+            activities_table,
+            user,
+            job_id,
+            status=JOB_DONE,
+            checksum=chksum,
+            start_date=dates.start_date,
+            end_date=dates.end_date,
+            finished=datetime.now().isoformat())
+        s3_object.delete()
+    except Exception as error:
+        # not re-raised: the job is marked failed instead, which the client
+        # polls, and a retried event would find it no longer waiting. rows
+        # written before the error stay and so does the file, the user
+        # re-uploads and ingestion skips the rows that are already stored
+        print(error)
+        updateJob(activities_table, user, job_id, status=JOB_FAILED, error=str(error))
+
+
+def lambda_handler(event, context):
+    global activities_table
+    global s3
+    if not activities_table:
+        dynamodb = boto3.resource("dynamodb")
+        table_name = os.environ.get("ACTIVITIES_TABLE", "")
+        activities_table = dynamodb.Table(table_name)
+    if not s3:
+        s3 = boto3.resource("s3")
+
+    for record in event.get("Records", []):
+        bucket = record["s3"]["bucket"]["name"]
+        # keys in S3 events are url encoded
+        s3_key = unquote_plus(record["s3"]["object"]["key"])
+        print("ingesting upload", bucket, s3_key)
+        # the job expires when this invocation is out of time
+        timeout_seconds = context.get_remaining_time_in_millis() // 1000 if context else JOB_TIMEOUT_SECONDS
+        ingestUpload(activities_table, s3, bucket, s3_key, timeout_seconds)
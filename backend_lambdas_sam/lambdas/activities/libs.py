@@ -1,79 +1,64 @@
-from typing import List, Optional
-import uuid
+from typing import Iterable, List, Optional
+from collections import defaultdict
+import re
 from datetime import datetime
 from decimal import Decimal
 
-from boto3.dynamodb.conditions import Key, Attr
-
-class Activity:
-
-    sk: str
-    account: str
-    date: str
-    description: str
-    predicted: List[str]
-    dirty: bool
-    def __init__(self,
-                 account: str,
-                 date: str,
-                 amount: Decimal,
-                 description: str,
-                 sk: Optional[str] = None,
-                 category: Optional[str] = None
-                 ):
-        self.sk = date + str(uuid.uuid4()) if sk is None else sk
-        self.account = account
-        self.date = date
-        self.description = description
-        self.category = category if category is not None else description
-        self.amount = amount
-        self.search_term = description.lower() if description else 'other'
-        self.predicted = []
-        self.dirty = False
-        
-    def toDict(self):
-        # TODO: implement properly
-        return {
-                "sk": self.sk,
-                "account": self.account,
-                "date": self.date,
-                "description": self.description,
-                "amount": str(self.amount),
-                "search_term": self.search_term,
-                "category": self.category,
-                "predicted": self.predicted,
-                "dirty": self.dirty,
-                }
-
-    def applyMappings(self, mappings: list):
-        matchedMapping = [mapping for mapping in mappings if mapping["description"] in self.description]
-        self.dirty = len(matchedMapping) > 0
-        self.category = matchedMapping[0]["category"] if len(matchedMapping) > 0 else self.category
-        self.predicted = [mapping["category"] for mapping in matchedMapping]
+from mappingMatcher import MappingMatcher
+from mappingCache import mapping_cache
+from activityRecord import ActivityRecord
+
+# slot based, shared with the other lambdas through the layer
+Activity = ActivityRecord
+
 
 def isDuplicate(activity: Activity, another: Activity):
     return activity.date == another.date and activity.amount == another.amount and activity.description == another.description 
 
 
-def serialize_rbc_activity(row) -> Optional[Activity]:
-    if len(row) < 7:
-        return None
-
-    if not row[6] or row[6] == "0":
-        print("skipping row" + ','.join(row))
-        return None
-
-    date_str = datetime.strptime(
-        row[2], "%m/%d/%Y").strftime("%Y-%m-%d")
-    amount = 0 - Decimal(row[6])
-    activity = Activity(
-        account=f"{mask_account_number(row[1])}-{row[0]}",
-        date=date_str,
-        description=row[5],
-        category=row[4],  # in the future we should get this
-        amount=amount  # rbc uses negative val for expense
-    )
-    return activity
+def normalizeDescription(description: str) -> str:
+    # "SAFEWAY #4931" and "Safeway 4931" compare equal in fuzzy mode
+    return " ".join(re.findall(r"[a-z0-9]+", (description or "").lower()))
+
+
+class DuplicateIndex:
+    """
+    Existing activities hashed on (date, amount, description), built once per
+    upload so every uploaded row is a dict lookup instead of a scan.
+    With fuzzyDays > 0 rows also match activities with the same amount and
+    normalized description up to fuzzyDays apart. Those are hashed by
+    (amount, date bucket) with buckets fuzzyDays wide, so a row only compares
+    against the activities in its own and the two neighbouring buckets.
+    """
+
+    def __init__(self, activities: Iterable[Activity], fuzzyDays: int = 0):
+        self.fuzzyDays = fuzzyDays
+        self._exact = defaultdict(list)
+        self._buckets = defaultdict(list)
+        for activity in activities:
+            self._exact[(activity.date, activity.amount, activity.description)].append(activity.sk)
+            if fuzzyDays > 0:
+                day = self._day(activity.date)
+                self._buckets[(activity.amount, day // fuzzyDays)].append(
+                    (day, normalizeDescription(activity.description), activity.sk))
+
+    @staticmethod
+    def _day(date: str) -> int:
+        return datetime.fromisoformat(date).toordinal()
+
+    def find(self, activity: Activity) -> List[str]:
+        """ sks of the existing activities that `activity` duplicates """
+        found = list(self._exact.get((activity.date, activity.amount, activity.description), []))
+        if self.fuzzyDays <= 0:
+            return found
+        day = self._day(activity.date)
+        description = normalizeDescription(activity.description)
+        bucket = day // self.fuzzyDays
+        for neighbour in (bucket - 1, bucket, bucket + 1):
+            for otherDay, otherDescription, sk in self._buckets.get((activity.amount, neighbour), []):
+                if abs(otherDay - day) <= self.fuzzyDays and otherDescription == description and sk not in found:
+                    found.append(sk)
+        return found
 
 
 def mask_account_number(account: str):
@@ -81,22 +66,6 @@ def mask_account_number(account: str):
     return account[-4:] if len(account) > 4 else account
 
 
-def serialize_cap1_activity(row) -> Optional[Activity]:
-    if len(row) < 6:
-        return None
-
-    date_str = datetime.strptime(
-        row[0], "%Y-%m-%d").strftime("%Y-%m-%d")
-    amount = Decimal(row[5]) if row[5] else 0 - Decimal(row[6])
-    activity = Activity(
-        account=row[2],
-        date=date_str,
-        description=row[3],
-        category=row[4],  # in the future we should get this
-        amount=amount  # rbc uses negative val for expense
-    )
-    return activity
-
 def serialize_default_activity(row) -> Optional[Activity]:
     date_str = row['date']
     return Activity(
@@ -107,50 +76,24 @@ def serialize_default_activity(row) -> Optional[Activity]:
         amount=Decimal(row['amount'])  # rbc uses negative val for expense
     )
 
-def serialize_td_activity(row) -> Optional[Activity]:
-    date_str = datetime.strptime(
-        row[0], "%m/%d/%Y").strftime("%Y-%m-%d")
-    description = row[1]
-    amount = Decimal(row[2]) if row[2] else 0 - Decimal(row[3])
-    return Activity(
-        date=date_str,
-        account='td',
-        description=description,
-        amount=amount  # rbc uses negative val for expense
-    )
-
-
 def getMappings(user: str, activities_table, categories=None):
-    params = {
-        "KeyConditionExpression": Key('user').eq(user) & Key('sk').begins_with("mapping#")
-    }
+    # served from the warm container cache, see mappingCache
+    all_mappings = mapping_cache.getMappings(activities_table, user)
     if categories:
-        params["FilterExpression"] = Attr('category').is_in(categories)
-    response = activities_table.query(
-        **params
-    )
-    all_mappings = response.get("Items", [])
-
-    while response.get("LastEvaluatedKey"):
-        response = activities_table.query(
-            KeyConditionExpression=Key("user").eq(
-                user) & Key("sk").begins_with("mapping#"),
-            ExclusiveStartKey=response["LastEvaluatedKey"]
-        )
-        all_mappings.extend(response.get("Items", []))
-
+        return [mapping for mapping in all_mappings if mapping.get("category") in categories]
     return all_mappings
 
 
-def applyMappings(mappings: list, item: dict):
+def mapActivity(matcher: MappingMatcher, item: dict) -> dict:
+    """ applies mappings to a queried item in place and makes its amount json ready """
     itemDesc = item.get("description", "")
-    # if category is not set, use description
-    itemCategory = item.get("category", itemDesc)
-
-    matchedMapping = [mapping for mapping in mappings if mapping["description"] in itemDesc]
-    return {
-        **item,
-        "dirty": len(matchedMapping) > 0,
-        "category": matchedMapping[0]["category"] if len(matchedMapping) > 0 else itemCategory,
-        "predicted": [mapping["category"] for mapping in matchedMapping]
-    }
+    matchedMapping = matcher.match(itemDesc)
+    if matchedMapping:
+        item["category"] = matchedMapping[0]["category"]
+    elif "category" not in item:
+        # if category is not set, use description
+        item["category"] = itemDesc
+    item["dirty"] = len(matchedMapping) > 0
+    item["predicted"] = [mapping["category"] for mapping in matchedMapping]
+    item["amount"] = str(item["amount"])
+    return item
@@ -2,117 +2,225 @@
 from decimal import Decimal
 import os
 import json
-from typing import List, Tuple
-import uuid
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 import hashlib
 import csv
-from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
 
 from boto3.dynamodb.conditions import Key
 import botocore
 
 from libs import (
         Activity,
-        isDuplicate,
-        serialize_rbc_activity,
-        serialize_cap1_activity,
-        serialize_td_activity,
+        DuplicateIndex,
         serialize_default_activity,
-        getMappings,
 )
+from bankFormats import FORMATS, UnknownFormatError, sniffFormat
+from mappingCache import mapping_cache
+from uploadStore import storeUpload
+from batchWriter import ConcurrentBatchWriter, BatchWriteError
+from contentKeys import OccurrenceCounter
 
 
-def uploadToS3(user: str, file_format: str, body, activities_table, s3):
-    # upload to s3
-    s3_key = f"{user}/{file_format}/{datetime.today().strftime('%Y-%m-%d')}{uuid.uuid4()}.csv"
-    print(f"uploading to s3 bucket, key={s3_key}")
-    s3.Object(
-        os.environ.get("ACTIVITIES_BUCKET", ""),
-        s3_key
-    ).put(Body=body)
+# bytes hashed at a time, so the checksum never needs an encoded copy of the whole body
+CHECKSUM_CHUNK_SIZE = 1 << 20
 
-    chksum = hashlib.md5(body.encode('utf-8')).hexdigest()
+
+def fileChecksum(body: str) -> str:
+    chksum = hashlib.md5()
+    for start in range(0, len(body), CHECKSUM_CHUNK_SIZE):
+        chksum.update(body[start:start + CHECKSUM_CHUNK_SIZE].encode('utf-8'))
+    return chksum.hexdigest()
+
+
+def isIngested(activities_table, user: str, chksum: str) -> bool:
     chksum_entry = activities_table.get_item(
-        Key={'user': user, 'sk': f"chksum#{chksum}"})
-    if 'Item' in chksum_entry:
-        print('skipping duplicate file')
-        return {
-            'statusCode': 200,
-            'body': json.dumps('skipping duplicate file')
-        }
-    return s3_key, chksum
+        Key={'user': user, 'sk': f"chksum#{chksum}"},
+        ProjectionExpression="sk")
+    return 'Item' in chksum_entry
 
 
-def getItemsFromBody(body, file_format: str) -> Tuple[List[Activity], str, str]:
-    all_activities = []
+def iterLines(body: str) -> Iterator[str]:
+    # yields one line at a time, body.splitlines() would hold a second copy of the whole file
+    start = 0
+    length = len(body)
+    while start < length:
+        end = body.find("\n", start)
+        if end == -1:
+            end = length
+        line = body[start:end]
+        yield line[:-1] if line.endswith("\r") else line
+        start = end + 1
+
+
+def iterItemsFromBody(body, file_format: str) -> Iterator[Activity]:
+    """ parses the upload one row at a time, nothing is kept after a row is yielded """
     if file_format:
         # parse the csv
-        all_activities = csv.reader(body.splitlines(), delimiter=',')
-    else:
-        bodyParsed = json.loads(body)
-        all_activities = bodyParsed.get('data', [])
+        return iterItemsFromRows(csv.reader(iterLines(body), delimiter=','), file_format)
+    bodyParsed = json.loads(body)
+    return iterItemsFromRows(bodyParsed.get('data', []), file_format)
 
-    firstRow = not file_format is None
 
-    items = []
-
-    start_date = date.max.strftime("%Y-%m-%d")
-    end_date = date.min.strftime("%Y-%m-%d")
+def iterItemsFromRows(all_activities: Iterable, file_format: str) -> Iterator[Activity]:
+    """ `file_format` is a registered bank format, or None for json rows """
+    if file_format:
+        bankFormat = FORMATS[file_format]
+        convert = bankFormat.convert
+        all_activities = iter(all_activities)
+        # skips header rows
+        for _ in range(bankFormat.headerRows):
+            next(all_activities, None)
+    else:
+        convert = serialize_default_activity
 
     for row in all_activities:
-        # skips first header row
-        if (file_format == "cap1" or file_format == "rbc") and firstRow:
-            firstRow = False
-            continue
-        # format and store them in dynamodb
-        item = None
-        if file_format == "cap1":
-            item = serialize_cap1_activity(row)
-        elif file_format == "rbc":
-            item = serialize_rbc_activity(row)
-        elif file_format == "td":
-            item = serialize_td_activity(row)
-        elif not file_format:
-            item = serialize_default_activity(row)
+        item = convert(row)
         if item:
-            # first update first and last dates
-            if item.date < start_date:
-                start_date = item.date
-            if item.date > end_date:
-                end_date = item.date
-            # iterate through mappings and override category if there is a match
-            items.append(item)
+            yield item
         else:
             print("item not processed", row)
-    return items, start_date, end_date
 
 
-# fetches items between start_date and end_date from the database to compare
-def getExistingItems(activities_table, user: str, start_date: str, end_date: str) -> List[Activity]:
-    query_params = {
-        "KeyConditionExpression": Key('user').eq(user) & Key('sk').between(start_date, end_date),
+def resolveFormat(body, file_format: Optional[str]) -> Optional[str]:
+    """
+    The bank format of an upload, sniffed from its first line when none is
+    given. None for json uploads.
+    """
+    if file_format:
+        if file_format not in FORMATS:
+            raise UnknownFormatError(f"unknown format {file_format}")
+        return file_format
+    if body.lstrip()[:1] in ("{", ""):
+        return None
+    sniffed = sniffFormat(next(iterLines(body), ""))
+    if not sniffed:
+        raise UnknownFormatError("unable to detect the file format, pass format")
+    return sniffed
+
+
+class DateRange:
+    """ first and last activity date, tracked while items stream through """
+
+    def __init__(self):
+        self.start_date = date.max.strftime("%Y-%m-%d")
+        self.end_date = date.min.strftime("%Y-%m-%d")
+
+    def track(self, items: Iterable[Activity]) -> Iterator[Activity]:
+        for item in items:
+            if item.date < self.start_date:
+                self.start_date = item.date
+            if item.date > self.end_date:
+                self.end_date = item.date
+            yield item
+
+
+def getItemsFromBody(body, file_format: str) -> Tuple[List[Activity], str, str]:
+    dates = DateRange()
+    items = list(dates.track(iterItemsFromBody(body, file_format)))
+    return items, dates.start_date, dates.end_date
+
+
+# duplicateDays widens the existing items read by twice this, larger values are clamped
+MAX_DUPLICATE_DAYS = 31
+
+# existing items are fetched one month per query, this many at a time
+EXISTING_ITEMS_WORKERS = int(os.environ.get("EXISTING_ITEMS_WORKERS", 8))
+
+
+def monthShards(start_date: str, end_date: str) -> List[Tuple[str, str]]:
+    """ [start_date, end_date] split into sk ranges of at most a calendar month, newest first """
+    shards = []
+    month = start_date[:7]
+    while month <= end_date[:7]:
+        # sks carry an id after the date, "~" sorts after it so the last day is included
+        shards.append((max(start_date, f"{month}-01"), min(end_date, f"{month}-31") + "~"))
+        year, mon = int(month[:4]), int(month[5:7])
+        month = f"{year + mon // 12:04d}-{mon % 12 + 1:02d}"
+    return list(reversed(shards))
+
+
+def _queryShard(client, table_name: str, user: str, low: str, high: str) -> list:
+    # the low level client is thread safe, the table resource is not
+    params = {
+        "TableName": table_name,
+        "KeyConditionExpression": Key('user').eq(user) & Key('sk').between(low, high),
+        # only what duplicate detection needs
+        "ProjectionExpression": "sk, #d, amount, description, account",
+        "ExpressionAttributeNames": {"#d": "date"},
         "ScanIndexForward": False
     }
-    data = activities_table.query(
-        **query_params
-    )
+    data = client.query(**params)
+    items = data.get("Items", [])
+    while data.get("LastEvaluatedKey"):
+        data = client.query(**params, ExclusiveStartKey=data["LastEvaluatedKey"])
+        items.extend(data.get("Items", []))
+    return items
+
+
+# fetches items between start_date and end_date from the database to compare
+def getExistingItems(activities_table, user: str, start_date: str, end_date: str) -> List[Activity]:
+    shards = monthShards(start_date, end_date)
+    if not shards:
+        return []
+    client = activities_table.meta.client
+    with ThreadPoolExecutor(max_workers=min(EXISTING_ITEMS_WORKERS, len(shards))) as executor:
+        pages = list(executor.map(
+            lambda shard: _queryShard(client, activities_table.name, user, *shard), shards))
 
     return [Activity(
             sk=item["sk"],
-            account=item["account"],
+            account=item.get("account", ""),
             date=item["date"],
             amount=Decimal(item["amount"]),
-            description=item["description"],
-            category=item["category"],
-        ) for item in data.get("Items", [])]
+            description=item.get("description", ""),
+        ) for page in pages for item in page]
 
 
-# finds potential duplicates between existing items and current item
-def findDuplicates(curr_item: Activity, items: List[Activity]) -> List[str]:
-    return [item.sk for item in items if isDuplicate(item, curr_item)]
+def writeActivities(activities_table, user: str, items: Iterable[Activity], matcher, chksum: str,
+                    progress: Optional[Callable[[int], None]] = None,
+                    progressEvery: int = 1000) -> DateRange:
+    """
+    Maps and writes activities as they come, returns their date range.
+    Sort keys are derived from the rows (see contentKeys) and written only if
+    absent, so ingesting rows that are already stored changes nothing.
+    `progress` is called with the number of rows written every `progressEvery` rows.
+    """
+    dates = DateRange()
+    occurrences = OccurrenceCounter()
+    written = 0
+    with ConcurrentBatchWriter(activities_table, putIfAbsent=True, wireFormat=True) as batch:
+        for item in dates.track(items):
+            item.sk = occurrences.sk(item.account, item.date, item.amount, item.description)
+            item.applyMappings(matcher)
+            batch.put_item(Item=item.toWireItem(user, chksum))
+            written += 1
+            if progress and written % progressEvery == 0:
+                progress(written)
+    if progress:
+        progress(written)
+    if batch.stats.skipped:
+        print(f"{batch.stats.skipped} rows already stored")
+    return dates
 
 
-def postActivities(user: str, file_format: str, body, activities_table, s3, preview: bool):
+def putChecksum(activities_table, user: str, chksum: str, s3_key: str, dates: DateRange):
+    # marks the file as ingested, repeat uploads are rejected from here on
+    activities_table.put_item(
+        Item={
+            'sk': f"chksum#{chksum}",
+            'user': user,
+            'date': datetime.now().strftime("%Y-%m-%d"),
+            'checksum': chksum,
+            'file': s3_key,
+            'start_date': dates.start_date,
+            'end_date': dates.end_date
+        }
+    )
+
+
+def postActivities(user: str, file_format: str, body, activities_table, s3, preview: bool, duplicateDays: int = 0):
     try:
         if not body:
             return {
@@ -120,22 +228,37 @@ def postActivities(user: str, file_format: str, body, activities_table, s3, prev
                 "body": "missing body content or input format",
             }
 
-        items, start_date, end_date = getItemsFromBody(body, file_format)
+        file_format = resolveFormat(body, file_format)
 
-        # get the items from the same range that we already have
-        existing_items = getExistingItems(activities_table, user, start_date, end_date)
+        if not preview:
+            # repeat uploads are rejected before any parsing, S3 or other table work
+            chksum = fileChecksum(body)
+            if isIngested(activities_table, user, chksum):
+                print('skipping duplicate file')
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps('skipping duplicate file')
+                }
 
-        def compare_date(item: dict):
-            return item.get("date", "")
+        # mapping results are stored with the item so isDirty can be served by an index
+        matcher = mapping_cache.getMatcher(activities_table, user)
 
         if preview:
-            mappings = getMappings(user, activities_table)
+            items, start_date, end_date = getItemsFromBody(body, file_format)
+
+            # get the items from the same range that we already have, fuzzy
+            # matches can be up to duplicateDays outside of it
+            if duplicateDays > 0 and items:
+                start_date = (datetime.strptime(start_date, "%Y-%m-%d") - timedelta(days=duplicateDays)).strftime("%Y-%m-%d")
+                end_date = (datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=duplicateDays)).strftime("%Y-%m-%d")
+            existing_items = getExistingItems(activities_table, user, start_date, end_date)
+            duplicates = DuplicateIndex(existing_items, duplicateDays)
+
             for item in items:
-                item.applyMappings(mappings)
-            allItems = sorted([{
-                **(item.toDict()),
-                "duplicate_to": findDuplicates(item, existing_items)
-            } for item in items], key=compare_date, reverse=True)
+                item.applyMappings(matcher)
+            items.sort(key=lambda item: item.date, reverse=True)
+            # serialized straight from the activities, no per row dicts
+            allItems = ", ".join(item.toJson(duplicate_to=duplicates.find(item)) for item in items)
             return {
                 "statusCode": 200,
                 'headers': {
@@ -143,39 +266,19 @@ def postActivities(user: str, file_format: str, body, activities_table, s3, prev
                     'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
                     'Access-Control-Allow-Methods': 'OPTIONS,GET,POST'
                 },
-                "body": json.dumps({
-                    "data": {
-                        "items": allItems
-                    }
-                }),
+                "body": '{"data": {"items": [' + allItems + ']}}',
             }
 
-        chksum, s3_key = uploadToS3(
-            user, file_format, body, activities_table, s3)
-
-        with activities_table.batch_writer() as batch:
-            for item in items:
-                print(f"debug - writing item as batch {item.toDict()}")
-                batch.put_item(
-                    Item={
-                        **(item.toDict()),
-                        'user': user,
-                        'chksum': chksum,
-                    }
-                )
-            # store the checksum
-            batch.put_item(
-                Item={
-                    'sk': f"chksum#{chksum}",
-                    'user': user,
-                    'date': datetime.now().strftime("%Y-%m-%d"),
-                    'checksum': chksum,
-                    'file': s3_key,
-                    'start_date': start_date,
-                    'end_date': end_date
-                }
-            )
-            # TODO: also put in a notification item for the user, so they can see the file was processed
+        # the raw file is stored while the rows are parsed and written,
+        # the checksum item goes last so a failed upload can be retried,
+        # rows that made it in the first time are skipped on the retry
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            s3_upload = executor.submit(storeUpload, s3, user, file_format, body, chksum)
+            dates = writeActivities(
+                activities_table, user, iterItemsFromBody(body, file_format), matcher, chksum)
+            s3_key = s3_upload.result()
+        putChecksum(activities_table, user, chksum, s3_key, dates)
+        # TODO: also put in a notification item for the user, so they can see the file was processed
         return {
             "statusCode": 200,
             'headers': {
@@ -190,7 +293,7 @@ def postActivities(user: str, file_format: str, body, activities_table, s3, prev
             }),
         }
 
-    except botocore.exceptions.ClientError as error:
+    except (botocore.exceptions.ClientError, BatchWriteError) as error:
         print(error)
         return {
             "statusCode": 500,
@@ -202,3 +305,8 @@ def postActivities(user: str, file_format: str, body, activities_table, s3, prev
             "statusCode": 500,
             "body": "missing header or request params"
         }
+    except UnknownFormatError as error:
+        return {
+            "statusCode": 400,
+            "body": str(error)
+        }
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import uuid
+from datetime import datetime
+from typing import Optional
+
+import botocore
+
+from bankFormats import FORMATS
+
+# large files skip the API body: the client PUTs the file to a presigned url
+# under UPLOAD_PREFIX, the ingestWorker lambda picks it up from the S3 event
+# and records its progress on the job# item the client polls
+UPLOAD_PREFIX = "uploads/"
+UPLOAD_URL_EXPIRES_SECONDS = int(os.environ.get("UPLOAD_URL_EXPIRES_SECONDS", 900))
+
+JOB_WAITING = "waiting_for_upload"
+JOB_PROCESSING = "processing"
+JOB_DONE = "done"
+JOB_DUPLICATE = "duplicate"
+JOB_FAILED = "failed"
+
+# key segment of uploads without a format, the worker sniffs it from the file
+AUTO_FORMAT = "auto"
+
+# a processing job records when its worker is out of time (deadline, epoch
+# seconds). a worker killed at its timeout can't mark the job failed, so a
+# job still processing past its deadline is reported failed instead
+JOB_TIMEOUT_SECONDS = int(os.environ.get("INGEST_TIMEOUT_SECONDS", 900))
+JOB_TIMED_OUT = "the upload took too long to process, upload it again"
+
+
+def jobSk(job_id: str) -> str:
+    return f"job#{job_id}"
+
+
+def incomingKey(user: str, file_format: str, job_id: str) -> str:
+    return f"{UPLOAD_PREFIX}{user}/{file_format}/{job_id}.csv"
+
+
+def parseIncomingKey(s3_key: str) -> Optional[dict]:
+    """ user, format and job id of an uploaded file, None for keys outside of the upload prefix """
+    if not s3_key.startswith(UPLOAD_PREFIX):
+        return None
+    parts = s3_key[len(UPLOAD_PREFIX):].rsplit("/", 2)
+    if len(parts) != 3 or not parts[2].endswith(".csv"):
+        return None
+    return {
+        "user": parts[0],
+        "file_format": parts[1],
+        "job_id": parts[2][:-len(".csv")],
+    }
+
+
+def createUploadJob(user: str, file_format: str, activities_table, s3):
+    if file_format and file_format not in FORMATS:
+        return {
+            "statusCode": 400,
+            "body": f"unknown format {file_format}",
+        }
+    file_format = file_format or AUTO_FORMAT
+    job_id = uuid.uuid4().hex
+    s3_key = incomingKey(user, file_format, job_id)
+    try:
+        activities_table.put_item(
+            Item={
+                "user": user,
+                "sk": jobSk(job_id),
+                "status": JOB_WAITING,
+                "format": file_format,
+                "file": s3_key,
+                "rows_written": 0,
+                "created": datetime.now().isoformat(),
+            }
+        )
+        upload_url = s3.meta.client.generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": os.environ.get("ACTIVITIES_BUCKET", ""),
+                "Key": s3_key,
+            },
+            ExpiresIn=UPLOAD_URL_EXPIRES_SECONDS
+        )
+    except botocore.exceptions.ClientError as error:
+        print(error)
+        return {
+            "statusCode": 500,
+            "body": "client error happened while creating the upload, see logs"
+        }
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "data": {
+                "job_id": job_id,
+                "upload_url": upload_url,
+                "expires_in": UPLOAD_URL_EXPIRES_SECONDS,
+            }
+        }),
+    }
+
+
+def getUploadJob(user: str, job_id: str, activities_table):
+    try:
+        response = activities_table.get_item(
+            Key={
+                "user": user,
+                "sk": jobSk(job_id)
+            }
+        )
+    except botocore.exceptions.ClientError as error:
+        print(error)
+        return {
+            "statusCode": 500,
+            "body": "client error happened while fetching data, see logs"
+        }
+    if "Item" not in response:
+        return {
+            "statusCode": 404,
+            "body": "no upload job found"
+        }
+    job = response["Item"]
+    if job.get("status") == JOB_PROCESSING and time.time() > job.get("deadline", float("inf")):
+        job = expireJob(activities_table, user, job_id) or job
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "data": {
+                **{key: value for key, value in job.items() if key not in ("user", "sk")},
+                "job_id": job_id,
+                "rows_written": int(job.get("rows_written", 0)),
+                **({"deadline": int(job["deadline"])} if "deadline" in job else {}),
+            }
+        }),
+    }
+
+
+def updateJob(activities_table, user: str, job_id: str, **fields):
+    activities_table.update_item(
+        Key={
+            "user": user,
+            "sk": jobSk(job_id)
+        },
+        UpdateExpression="set " + ", ".join(f"#{key} = :{key}" for key in fields),
+        ExpressionAttributeNames={f"#{key}": key for key in fields},
+        ExpressionAttributeValues={f":{key}": value for key, value in fields.items()},
+    )
+
+
+def expireJob(activities_table, user: str, job_id: str) -> Optional[dict]:
+    """ marks a job that is still processing as failed, returns the job or None if its worker finished meanwhile """
+    try:
+        return activities_table.update_item(
+            Key={
+                "user": user,
+                "sk": jobSk(job_id)
+            },
+            UpdateExpression="set #s = :failed, #e = :error",
+            ConditionExpression="#s = :processing",
+            ExpressionAttributeNames={"#s": "status", "#e": "error"},
+            ExpressionAttributeValues={":failed": JOB_FAILED, ":error": JOB_TIMED_OUT, ":processing": JOB_PROCESSING},
+            ReturnValues="ALL_NEW",
+        )["Attributes"]
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return None
@@ -1,11 +1,19 @@
 import os
+import time
 import boto3
-import simplejson as json
-import uuid
-from boto3.dynamodb.conditions import Key, Attr
+from collections import defaultdict
+from boto3.dynamodb.conditions import Key
 from decimal import Decimal
 from datetime import datetime, timedelta
 
+from activityMappings import recategorizeActivities
+from batchWriter import ConcurrentBatchWriter
+from contentKeys import MOVED_FROM, MOVED_TO, relatedActivitySk
+from descriptionIndex import indexActivity
+from mappingCache import queryAllMappings
+from mappingMatcher import MappingMatcher
+from monthlyInsights import addAllInsights
+
 # first set up activity table
 table = None
 
@@ -16,8 +24,13 @@ def check_record_type(record, event_type, sk_prefix):
     return record["eventName"] == event_type and record["dynamodb"]["Keys"]["sk"]["S"].startswith(sk_prefix)
 
 
+def is_move(record):
+    # the INSERT and REMOVE of an activity moved to a new sk, see contentKeys.MOVED_FROM
+    return (MOVED_FROM in record["dynamodb"].get("NewImage", {}) and record["eventName"] == "INSERT") or \
+        (MOVED_TO in record["dynamodb"].get("OldImage", {}) and record["eventName"] == "REMOVE")
+
+
 def process_new_activity(record, existing_mapping):
-    global table
     # try to sum changes up by category and then update insights
     user_id = record["dynamodb"]["Keys"]["user"]["S"]
     category = record["dynamodb"]["NewImage"]["category"]["S"]
@@ -34,24 +47,6 @@ def process_new_activity(record, existing_mapping):
         per_month_mapping[category] = Decimal(0)
     per_month_mapping[category] += amount
 
-    try:
-        related_activities = find_related_activities(record)
-        print(len(related_activities))
-        for activity in related_activities:
-            item = {
-                "user": user_id,
-                "sk": "related_activity#" + str(uuid.uuid4()),
-                "related": activity["activity"]["sk"],
-                "activity": record["dynamodb"]["Keys"]["sk"]["S"],
-                "opposite": activity.get("opposite", False),
-                "duplicate": activity.get("duplicate", False)
-            }
-            print("inserting related activity", item)
-            # for insights we're using batch writer
-            table.put_item(Item=item)
-    except Exception as e:
-        print("error", e)
-
 
 def process_modified_activity(record, existing_mapping):
     # try to sum changes up by category and then update insights
@@ -97,53 +92,222 @@ def process_deleted_activity(record, existing_mapping):
 
 
 def process_activity_insights(records):
-    insights = {}
-    for record in records:
-        if check_record_type(record, "INSERT", "20"):
-            print("processing new activity", record)
-            process_new_activity(record, insights)
-        elif check_record_type(record, "MODIFY", "20"):
-            print("processing modified activity", record)
-            process_modified_activity(
-                record, insights)
-        elif check_record_type(record, "REMOVE", "20"):
-            print("processing deleted activity", record)
-            process_deleted_activity(record, insights)
-    return insights
+    """
+    Insights deltas of every activity record, user -> month -> [(eventID, category -> amount)],
+    the indexes of the records behind every (user, month), and the indexes
+    of the records that could not be read. A record without an eventID
+    can't be counted once, so it fails as well.
+    """
+    insights = defaultdict(lambda: defaultdict(list))
+    sources = defaultdict(list)
+    failed = set()
+    for index, record in enumerate(records):
+        record_mapping = {}
+        try:
+            if is_move(record):
+                # the activity's amount and category stay in the same month
+                continue
+            if check_record_type(record, "INSERT", "20"):
+                print("processing new activity", record)
+                process_new_activity(record, record_mapping)
+            elif check_record_type(record, "MODIFY", "20"):
+                print("processing modified activity", record)
+                process_modified_activity(
+                    record, record_mapping)
+            elif check_record_type(record, "REMOVE", "20"):
+                print("processing deleted activity", record)
+                process_deleted_activity(record, record_mapping)
+            if record_mapping and not record.get("eventID"):
+                raise ValueError("record has no eventID")
+        except Exception as e:
+            print("failed to read activity record", index, e)
+            failed.add(index)
+            continue
+        for user_id, per_user_mapping in record_mapping.items():
+            for month, per_month_mapping in per_user_mapping.items():
+                insights[user_id][month].append((record["eventID"], per_month_mapping))
+                sources[(user_id, month)].append(index)
+    return insights, sources, failed
 
 
-RELATED_ACTIVITY_TIMEDELTA = 7
+def image_description(record, image):
+    return record["dynamodb"].get(image, {}).get("description", {}).get("S", "")
 
 
-def find_related_activities(record):
+def process_description_index(records):
     global table
-    user_id = record["dynamodb"]["Keys"]["user"]["S"]
-    sk = record["dynamodb"]["Keys"]["sk"]["S"]
-    amount = Decimal(record["dynamodb"]["NewImage"]["amount"]["N"])
+    # keeps the description token index in sync with the activities
+    with table.batch_writer(overwrite_by_pkeys=["user", "sk"]) as batch:
+        for record in records:
+            user_id = record["dynamodb"]["Keys"]["user"]["S"]
+            sk = record["dynamodb"]["Keys"]["sk"]["S"]
+            if check_record_type(record, "INSERT", "20"):
+                indexActivity(batch, user_id, sk,
+                              newDescription=image_description(record, "NewImage"))
+            elif check_record_type(record, "MODIFY", "20"):
+                indexActivity(batch, user_id, sk,
+                              image_description(record, "OldImage"),
+                              image_description(record, "NewImage"))
+            elif check_record_type(record, "REMOVE", "20"):
+                indexActivity(batch, user_id, sk,
+                              oldDescription=image_description(record, "OldImage"))
+
+
+RELATED_ACTIVITY_TIMEDELTA = 7
+
+
+def related_window(record):
+    # activities within RELATED_ACTIVITY_TIMEDELTA days of the new one
     date = datetime.strptime(
         record["dynamodb"]["NewImage"]["date"]["S"], "%Y-%m-%d")
     begin_find_date = (date - timedelta(days=RELATED_ACTIVITY_TIMEDELTA)).strftime(
         "%Y-%m-%d")
     end_find_date = (date + timedelta(days=RELATED_ACTIVITY_TIMEDELTA)).strftime(
         "%Y-%m-%d")
-    duplicate_responses = table.query(
-        KeyConditionExpression=Key("user").eq(
-            user_id) & Key("sk").between(begin_find_date, end_find_date),
-        FilterExpression=Attr("amount").eq(amount)
-    )
-
-    opposite_responses = table.query(
-        KeyConditionExpression=Key("user").eq(
-            user_id) & Key("sk").between(begin_find_date, end_find_date),
-        FilterExpression=Attr("amount").eq(-amount)
-    )
-    return [{
-        "activity": x,
-        "duplicate": True
-    } for x in duplicate_responses["Items"] if x["sk"] != sk] + [{
-        "activity": x,
-        "opposite": True
-    } for x in opposite_responses["Items"] if x["sk"] != sk]
+    # activity sks are the date followed by an id, "~" sorts after every id
+    # character so activities on the last day are in the window
+    return begin_find_date, end_find_date + "~"
+
+
+def merge_windows(windows):
+    merged = []
+    for begin, end in sorted(windows):
+        if merged and begin <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((begin, end))
+    return merged
+
+
+def activities_by_amount(user_id, windows):
+    """ amount -> sks of the user's activities in the (merged) windows, one paged query per window """
+    global table
+    by_amount = defaultdict(list)
+    for begin, end in merge_windows(windows):
+        params = {
+            "KeyConditionExpression": Key("user").eq(user_id) & Key("sk").between(begin, end),
+            "ProjectionExpression": "sk, amount",
+        }
+        response = table.query(**params)
+        items = response["Items"]
+        while response.get("LastEvaluatedKey"):
+            response = table.query(**params, ExclusiveStartKey=response["LastEvaluatedKey"])
+            items.extend(response["Items"])
+        for item in items:
+            if "amount" in item:
+                by_amount[item["amount"]].append(item["sk"])
+    return by_amount
+
+
+def find_related_activities(records):
+    """
+    Related activities of every new activity in the batch: the user's other
+    activities in its date window with the same amount (duplicate) or the
+    opposite amount (opposite). Returns the related_activity# items to write.
+    """
+    new_activities = defaultdict(list)
+    for record in records:
+        # a moved activity keeps its links, the move repoints them
+        if check_record_type(record, "INSERT", "20") and not is_move(record):
+            new_activities[record["dynamodb"]["Keys"]["user"]["S"]].append(record)
+    related = []
+    for user_id, user_records in new_activities.items():
+        windows = [related_window(record) for record in user_records]
+        by_amount = activities_by_amount(user_id, windows)
+        for record, (begin, end) in zip(user_records, windows):
+            sk = record["dynamodb"]["Keys"]["sk"]["S"]
+            amount = Decimal(record["dynamodb"]["NewImage"]["amount"]["N"])
+            for kind, match in [("duplicate", amount), ("opposite", -amount)]:
+                for related_sk in by_amount.get(match, ()):
+                    if related_sk != sk and begin <= related_sk <= end:
+                        related.append({
+                            "user": user_id,
+                            # the same link gets the same sk when a batch is retried
+                            "sk": relatedActivitySk(sk, related_sk, kind),
+                            "related": related_sk,
+                            "activity": sk,
+                            "opposite": kind == "opposite",
+                            "duplicate": kind == "duplicate",
+                        })
+    return related
+
+
+def process_related_activities(records):
+    global table
+    related_activities = find_related_activities(records)
+    print("inserting related activities", len(related_activities))
+    with ConcurrentBatchWriter(table) as batch:
+        for item in related_activities:
+            batch.put_item(Item=item)
+    return related_activities
+
+
+RECATEGORIZE_PREFIX = "recategorize#"
+# a checkpoint outlives the stream record it belongs to
+RECATEGORIZE_CHECKPOINT_TTL_SECONDS = 2 * 24 * 3600
+
+
+def mapping_descriptions(record):
+    # a mapping change can re-categorize activities matching its old or new description
+    return {
+        record["dynamodb"][image]["description"]["S"]
+        for image in ["OldImage", "NewImage"]
+        if "description" in record["dynamodb"].get(image, {})
+    }
+
+
+def process_mapping_changes(records, context):
+    """
+    Re-categorizes the activities that a mapping INSERT/MODIFY/REMOVE can
+    affect. The category changes come back through the stream as activity
+    MODIFY records, which move the insights of just the changed months.
+    A mapping that runs out of time is checkpointed under
+    recategorize#{eventID} and returned as failed, so its retry resumes there.
+    """
+    global table
+    time_left = None
+    if hasattr(context, "get_remaining_time_in_millis"):
+        def time_left():
+            return context.get_remaining_time_in_millis() / 1000
+    matchers = {}
+    failed = set()
+    for index, record in enumerate(records):
+        if not record["dynamodb"]["Keys"]["sk"]["S"].startswith("mapping#"):
+            continue
+        user_id = record["dynamodb"]["Keys"]["user"]["S"]
+        try:
+            if not record.get("eventID"):
+                # the checkpoint is kept per eventID
+                raise ValueError("record has no eventID")
+            checkpoint_key = {"user": user_id, "sk": RECATEGORIZE_PREFIX + record["eventID"]}
+            if user_id not in matchers:
+                # read the mappings as they are now, the cached version may not be bumped yet
+                matchers[user_id] = MappingMatcher(queryAllMappings(table, user_id))
+            checkpoint = table.get_item(Key=checkpoint_key, ConsistentRead=True).get("Item")
+            updated, next_sk = recategorizeActivities(
+                table, user_id, mapping_descriptions(record), matchers[user_id],
+                startSk=checkpoint["next"] if checkpoint else None, timeLeft=time_left)
+            print("re-categorized activities", user_id, updated)
+            if next_sk:
+                table.put_item(Item={**checkpoint_key, "next": next_sk,
+                                     "ttl": int(time.time()) + RECATEGORIZE_CHECKPOINT_TTL_SECONDS})
+                failed.add(index)
+            elif checkpoint:
+                table.delete_item(Key=checkpoint_key)
+        except Exception as e:
+            print("failed to re-categorize activities", user_id, e)
+            failed.add(index)
+    return failed
+
+
+def batch_item_failures(records, failed):
+    # lambda retries the batch from the lowest reported sequence number on
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": records[index]["dynamodb"].get("SequenceNumber")}
+            for index in sorted(failed)
+        ]
+    }
 
 
 def lambda_handler(event, context):
@@ -151,71 +315,29 @@ def lambda_handler(event, context):
     if not table:
         dynamodb = boto3.resource("dynamodb")
         table = dynamodb.Table(os.environ.get("ACTIVITIES_TABLE", ""))
-    # handle stream update events
-    records = event.get("Records", None)
-    if records is None:
-        return {
-            "statusCode": 200,
-            "body": json.dumps("No records found")
-        }
+    # handle stream update events. every step can run again for records
+    # that were already processed: index and related activity writes are
+    # puts of the same items, re-categorizing only writes what differs and
+    # insights deltas are added once per eventID
+    records = event.get("Records") or []
+    failed = set()
     try:
-        # initialize mapping: user -> month -> category -> amount
-        insights_activity_mapping = process_activity_insights(
-            records)
-        if not insights_activity_mapping:
-            return {
-                "statusCode": 200,
-                "body": json.dumps("No insights found")
-            }
-        print("updating insights", insights_activity_mapping)
-        for user_id, per_user_mapping in insights_activity_mapping.items():
-            for month, per_month_mapping in per_user_mapping.items():
-                # first get existing mappings
-                response = table.get_item(
-                    Key={
-                        "user": user_id,
-                        "sk": f"insights#{month}"
-                    }
-                )
-                # merge existing mappings with new mappings
-                if "Item" in response:
-                    existing_mapping = json.loads(
-                        response["Item"]["categories"], parse_float=Decimal)
-                    for category, amount in per_month_mapping.items():
-                        if category in existing_mapping:
-                            existing_mapping[category] += amount
-                        else:
-                            existing_mapping[category] = amount
-                    per_month_mapping = existing_mapping
-                    # update insights
-                    table.update_item(
-                        Key={
-                            "user": user_id,
-                            "sk": f"insights#{month}"
-                        },
-                        UpdateExpression="set categories = :a",
-                        ExpressionAttributeValues={
-                            ":a": json.dumps(per_month_mapping)
-                        }
-                    )
-                else:
-                    # create insights
-                    table.put_item(
-                        Item={
-                            "user": user_id,
-                            "sk": f"insights#{month}",
-                            "categories": json.dumps(per_month_mapping),
-                            "date": month
-                        }
-                    )
+        process_description_index(records)
     except Exception as e:
-        print(e)
-        return {
-            "statusCode": 500,
-            "body": "failed to update activity insights",
-            "error": str(e)
-        }
-    return {
-        "statusCode": 200,
-        "body": "successfully updated activity insights",
-    }
+        print("failed to update the description index", e)
+        failed.update(range(len(records)))
+    try:
+        process_related_activities(records)
+    except Exception as e:
+        print("failed to find related activities", e)
+        failed.update(index for index, record in enumerate(records)
+                      if check_record_type(record, "INSERT", "20"))
+    failed.update(process_mapping_changes(records, context))
+    insights_activity_events, sources, unreadable = process_activity_insights(records)
+    failed.update(unreadable)
+    if insights_activity_events:
+        print("updating insights", insights_activity_events)
+        # one ADD per user-month, no read, months in parallel
+        for key in addAllInsights(table, insights_activity_events):
+            failed.update(sources[key])
+    return batch_item_failures(records, failed)
@@ -6,6 +6,8 @@ import boto3
 from boto3.dynamodb.conditions import Key
 import botocore
 from auth_layer import get_user_id
+from mappingMatcher import MappingMatcher
+from mappingCache import mapping_cache
 
 activities_table = None
 
@@ -54,28 +56,12 @@ def getSumNegatives(items):
             result -= Decimal(item["amount"])
     return result
 
-def getAllMappings(user: str):
-    global activities_table
-    response = activities_table.query(
-        KeyConditionExpression=Key("user").eq(user) & Key("sk").begins_with("mapping#"),
-    )
-    all_mappings = response.get("Items", [])
-
-    while response.get("LastEvaluatedKey"):
-        response = activities_table.query(
-            KeyConditionExpression=Key("user").eq(user) & Key("sk").begins_with("mapping#"),
-            ExclusiveStartKey=response["LastEvaluatedKey"]
-        )
-        all_mappings.extend(response.get("Items", []))
-
-    return all_mappings
-
-def applyMappings(mappings: list, item: dict):
+def applyMappings(matcher: MappingMatcher, item: dict):
     itemDesc = item.get("description", "")
     itemCategory = item.get("category", itemDesc) # if category is not set, use description
     return {
         **item,
-        "category": next((mapping["category"] for mapping in mappings if mapping["description"] in itemDesc), itemCategory)
+        "category": next((mapping["category"] for mapping in matcher.match(itemDesc)), itemCategory)
     }
 
 # starting_date and ending_date are in the format YYYY-MM-DD
@@ -134,10 +120,7 @@ def get_new(
             items.extend(more_response.get("Items", []))
 
         # then get all mappings
-        response = activities_table.query(
-            KeyConditionExpression=Key("user").eq(user_id) & Key("sk").begins_with("mapping#"),
-        )
-        mappings = getAllMappings(user_id)
+        matcher = mapping_cache.getMatcher(activities_table, user_id)
 
         return {
             "statusCode": 200,
@@ -146,7 +129,7 @@ def get_new(
                     "start_date": period_start.strftime("%Y-%m-%d"),
                     "end_date": period_end.strftime("%Y-%m-%d"),
                     "categories": get_grouped_by_categories(
-                        [applyMappings(mappings, item) for item in items if item["date"] >= period_start.strftime("%Y-%m-%d") and item["date"] <= period_end.strftime("%Y-%m-%d")],
+                        [applyMappings(matcher, item) for item in items if item["date"] >= period_start.strftime("%Y-%m-%d") and item["date"] <= period_end.strftime("%Y-%m-%d")],
                         all_categories,
                         categories,
                         True
@@ -1,22 +1,123 @@
 # this is the base layer that includes
 # authentication, database connection, and
 import os
-import requests
+import time
+import hashlib
+from collections import OrderedDict
 import jwt
 from jwt.exceptions import InvalidSignatureError
-from jwt.algorithms import RSAAlgorithm
-from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
 
 VERIFY_TOKEN_ERROR_TEXT = "Token verification failed."
 
-def verify_token_with_jwks(token, jwks_url, audiences):
-    """ Get the JSON Web Key Set from the provided URL """
+# how long a fetched key set is trusted before it is fetched again
+JWKS_CACHE_TTL_SECONDS = int(os.environ.get("JWKS_CACHE_TTL_SECONDS", 3600))
+# minimum time between refetches triggered by an unknown kid, so
+# tokens with made up kids can't make us hammer the jwks endpoint
+JWKS_REFETCH_INTERVAL_SECONDS = int(os.environ.get("JWKS_REFETCH_INTERVAL_SECONDS", 60))
+
+# module level so it survives between warm invocations
+_jwks_cache = {
+    "url": None,
+    "keys": {},
+    "fetched_at": 0.0,
+    "last_fetch_attempt": 0.0,
+}
+
+jwks_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "fetches": 0,
+}
+
+# verified tokens, keyed by sha256 of the token, least recently used first
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 256))
+_token_cache = OrderedDict()
+
+token_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "expired": 0,
+    "evicted": 0,
+}
+
+
+def _fetch_jwks(jwks_url):
+    """ Fetches the JSON Web Key Set and parses the public keys, indexed by kid """
+    # only needed once per container, so keep them out of the cold start
+    import requests
+    from jwt.algorithms import RSAAlgorithm
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+
+    now = time.monotonic()
+    _jwks_cache["last_fetch_attempt"] = now
+    jwks_cache_stats["fetches"] += 1
     jwks = requests.get(jwks_url, timeout=3).json()
 
-    # Extract the public key from the JSON Web Key Set
-    key = RSAAlgorithm.from_jwk(jwks["keys"][0])
-    if isinstance(key, RSAPrivateKey):
+    keys = {}
+    for jwk in jwks.get("keys", []):
+        key = RSAAlgorithm.from_jwk(jwk)
+        if isinstance(key, RSAPrivateKey):
+            raise ValueError(VERIFY_TOKEN_ERROR_TEXT)
+        keys[jwk.get("kid")] = key
+
+    _jwks_cache["url"] = jwks_url
+    _jwks_cache["keys"] = keys
+    _jwks_cache["fetched_at"] = now
+
+    # tokens signed with a key that was rotated out must be verified again
+    for token_hash, entry in list(_token_cache.items()):
+        if entry["kid"] not in keys:
+            del _token_cache[token_hash]
+            token_cache_stats["evicted"] += 1
+    return keys
+
+
+def clear_jwks_cache():
+    _jwks_cache["url"] = None
+    _jwks_cache["keys"] = {}
+    _jwks_cache["fetched_at"] = 0.0
+    _jwks_cache["last_fetch_attempt"] = 0.0
+    for stat in jwks_cache_stats:
+        jwks_cache_stats[stat] = 0
+
+
+def clear_token_cache():
+    _token_cache.clear()
+    for stat in token_cache_stats:
+        token_cache_stats[stat] = 0
+
+
+def get_signing_key(token, jwks_url):
+    """ Returns the public key for the token's kid, fetching the key set only when needed """
+    kid = jwt.get_unverified_header(token).get("kid")
+    now = time.monotonic()
+
+    keys = _jwks_cache["keys"]
+    if _jwks_cache["url"] != jwks_url or now - _jwks_cache["fetched_at"] > JWKS_CACHE_TTL_SECONDS:
+        jwks_cache_stats["misses"] += 1
+        keys = _fetch_jwks(jwks_url)
+    elif kid in keys or (kid is None and keys):
+        jwks_cache_stats["hits"] += 1
+    else:
+        jwks_cache_stats["misses"] += 1
+        # unknown kid, keys may have been rotated
+        if now - _jwks_cache["last_fetch_attempt"] < JWKS_REFETCH_INTERVAL_SECONDS:
+            raise ValueError(VERIFY_TOKEN_ERROR_TEXT)
+        keys = _fetch_jwks(jwks_url)
+
+    if kid is None:
+        # tokens without kid fall back to the first key in the set
+        key = next(iter(keys.values()), None)
+    else:
+        key = keys.get(kid)
+    if key is None:
         raise ValueError(VERIFY_TOKEN_ERROR_TEXT)
+    return key
+
+
+def verify_token_with_jwks(token, jwks_url, audiences):
+    """ Verifies the token against the cached JSON Web Key Set from the provided URL """
+    key = get_signing_key(token, jwks_url)
 
     try:
         # Verify the token using the extracted public key
@@ -30,6 +131,36 @@ def verify_token_with_jwks(token, jwks_url, audiences):
         raise ValueError(VERIFY_TOKEN_ERROR_TEXT) from exc
 
 
+def verify_token_cached(token, jwks_url, audiences):
+    """ Returns the user id (sub) of the token, only checking the signature on a cache miss """
+    token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    entry = _token_cache.get(token_hash)
+    if entry is not None and entry["audiences"] == audiences:
+        if time.time() < entry["exp"]:
+            _token_cache.move_to_end(token_hash)
+            token_cache_stats["hits"] += 1
+            return entry["sub"]
+        del _token_cache[token_hash]
+        token_cache_stats["expired"] += 1
+    token_cache_stats["misses"] += 1
+
+    decoded = verify_token_with_jwks(token, jwks_url, audiences)
+    sub = decoded.get("sub", "")
+    # tokens without exp never expire on their own, so don't keep them around
+    if TOKEN_CACHE_SIZE > 0 and "exp" in decoded:
+        _token_cache[token_hash] = {
+            "sub": sub,
+            "exp": decoded["exp"],
+            "kid": jwt.get_unverified_header(token).get("kid"),
+            "audiences": audiences,
+        }
+        _token_cache.move_to_end(token_hash)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+            token_cache_stats["evicted"] += 1
+    return sub
+
+
 def get_user_id(event):
     """ for lambda http api event, get user id from authorization token in header"""
     token = event.get("headers", {}).get("authorization", "")
@@ -45,8 +176,7 @@ def get_user_id(event):
             f"https://{api_url}/{stage}"
         ]
 
-        decoded = verify_token_with_jwks(token, jwks_url, audiences)
-        return decoded.get("sub", "")
+        return verify_token_cached(token, jwks_url, audiences)
     except Exception as exc:
         print("Error while verifying token", exc)
         return ""
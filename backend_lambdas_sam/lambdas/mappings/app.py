@@ -5,6 +5,7 @@ from datetime import datetime
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 from auth_layer import get_user_id
+from mappingCache import bumpMappingsVersion
 
 table = None
 
@@ -52,6 +53,9 @@ def post(user, description, category, priority):
                     "created_at": datetime.strftime(datetime.now(), MAPPING_TIMESTAMP_FORMAT)
                 }
             )
+        # invalidates cached mappings in the other lambdas. the activities
+        # stream re-categorizes the activities the mapping affects
+        bumpMappingsVersion(table, user)
         return {
             "statusCode": 201,
             "body": "success",
@@ -154,7 +158,7 @@ def delete(user, id):
             }
         )
         print(response)
-        # TODO: update the activities rows here
+        bumpMappingsVersion(table, user)
         return {
             "statusCode": 200,
             "body": "success",
@@ -2,12 +2,86 @@ import simplejson as json
 import boto3
 import re
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.conditions import Attr
+
+from monthlyInsights import putInsights
 
 table = None
 # this lambda is meant to be invoked manually, to check if
 
+# parallel scan segments, each scanned by its own thread
+SCAN_SEGMENTS = int(os.environ.get("SCAN_SEGMENTS", 8))
+# stop scanning once this many mappings and activities were read, across all
+# segments. items the filter drops (token#, stream#, ...) don't count
+MAX_ROWS = int(os.environ.get("MAX_ROWS", 10000))
+
+
+class RowBudget:
+    """ items the scan may still read, shared by the segment threads """
+
+    def __init__(self, max_rows):
+        self.remaining = max_rows
+        self._lock = threading.Lock()
+
+    def take(self, rows):
+        with self._lock:
+            self.remaining -= rows
+            return self.remaining > 0
+
+
+def scan_segment(segment, total_segments, budget, page_size=None):
+    """
+    Mappings and activities of one scan segment, user -> {"mappings": [...], "activities": [...]}.
+    Also returns whether the segment was read to the end.
+    """
+    # the resource's client is thread safe, the resource isn't
+    params = {
+        "TableName": table.name,
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "FilterExpression": Attr('sk').begins_with('mapping#') | Attr('sk').begins_with('20'),
+    }
+    if page_size:
+        params["Limit"] = page_size
+    by_user = {}
+    while True:
+        response = table.meta.client.scan(**params)
+        for item in response['Items']:
+            user = by_user.setdefault(item['user'], {"mappings": [], "activities": []})
+            user["mappings" if item['sk'].startswith('mapping#') else "activities"].append(item)
+        next_key = response.get('LastEvaluatedKey')
+        if not next_key:
+            return by_user, True
+        if not budget.take(response['Count']):
+            return by_user, False
+        params["ExclusiveStartKey"] = next_key
+
+
+def scan_table(total_segments=None, max_rows=None, page_size=None):
+    """
+    One parallel scan for every user's mappings and activities, partitioned
+    by user. Returns them and whether the whole table was read.
+    """
+    total_segments = total_segments or SCAN_SEGMENTS
+    budget = RowBudget(max_rows or MAX_ROWS)
+    by_user = {}
+    complete = True
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        futures = [executor.submit(scan_segment, segment, total_segments, budget, page_size)
+                   for segment in range(total_segments)]
+        for future in futures:
+            segment_users, segment_complete = future.result()
+            complete = complete and segment_complete
+            for user, items in segment_users.items():
+                merged = by_user.setdefault(user, {"mappings": [], "activities": []})
+                merged["mappings"].extend(items["mappings"])
+                merged["activities"].extend(items["activities"])
+    return by_user, complete
+
+
 def lambda_handler(event, context):
     global table
     # This function fetches all mappings and activities items and checks if activities item matches the mapping
@@ -15,48 +89,22 @@ def lambda_handler(event, context):
         dynamodb = boto3.resource('dynamodb')
         table = dynamodb.Table(os.environ.get("ACTIVITIES_TABLE", ""))
     try:
-        response = table.scan(
-            FilterExpression=Attr('sk').begins_with('mapping#')
-        )
-        all_mappings = response['Items']
-        nextKey = response.get('LastEvaluatedKey')
-        processed_rows = 0
-        while nextKey and processed_rows < os.environ.get("MAX_ROWS", 10000):
-            response = table.scan(
-                FilterExpression=Attr('sk').begins_with('mapping#'),
-                ExclusiveStartKey=nextKey
-            )
-            all_mappings.extend(response['Items'])
-            nextKey = response.get('LastEvaluatedKey')
-            processed_rows += len(response['Items'])
-        if nextKey:
-            print("max rows reached, stopping")
+        by_user, complete = scan_table()
+        if not complete:
+            # partial totals would overwrite the ones the stream keeps up to date
+            print("max rows reached, stopping without updating anything")
+            return {
+                'statusCode': 200,
+                'body': json.dumps('max rows reached, nothing updated')
+            }
         user_mappings = {}
-        for item in all_mappings:
-            user = item['user']
-            if user not in user_mappings:
-                user_mappings[user] = [item]
-            else:
-                user_mappings[user].append(item)
-        # then we fetch all activities items
-        response = table.scan(
-            FilterExpression=Attr('sk').begins_with('20')
-        )
-        activities = response['Items']
-        nextKey = response.get('LastEvaluatedKey')
-        processed_rows = 0
+        activities = []
+        for user, items in by_user.items():
+            if items["mappings"]:
+                # the scan returns them in no particular order
+                user_mappings[user] = sorted(items["mappings"], key=lambda mapping: mapping['sk'])
+            activities.extend(items["activities"])
         user_insights_dict = {}
-        while nextKey and processed_rows < os.environ.get("MAX_ROWS", 10000):
-            response = table.scan(
-                FilterExpression=Attr('sk').begins_with('20'),
-                ExclusiveStartKey=nextKey
-            )
-            activities.extend(response['Items'])
-            nextKey = response.get('LastEvaluatedKey')
-            processed_rows += len(response['Items'])
-        if nextKey:
-            print("max rows reached, stopping")
-
         for activity in activities:
             user = activity['user']
             if user in user_mappings:
@@ -92,31 +140,7 @@ def lambda_handler(event, context):
         # then we update the insights table
         for user in user_insights_dict:
             for month in user_insights_dict[user]:
-                # first check if item exists
-                response = table.query(
-                    KeyConditionExpression=Key('user').eq(user) & Key('sk').eq('insights#' + month)
-                )
-                if len(response['Items']) == 0:
-                    # create item
-                    table.put_item(
-                        Item={
-                            'user': user,
-                            'sk': 'insights#' + month,
-                            'categories': json.dumps(user_insights_dict[user][month])
-                        }
-                    )
-                else:
-                    # update item
-                    table.update_item(
-                        Key={
-                            'user': user,
-                            'sk': 'insights#' + month
-                        },
-                        UpdateExpression="set categories = :c",
-                        ExpressionAttributeValues={
-                            ':c': json.dumps(user_insights_dict[user][month])
-                        },
-                    )
+                putInsights(table, user, month, user_insights_dict[user][month])
         return {
             'statusCode': 200,
             'body': json.dumps('Hello from Lambda!')
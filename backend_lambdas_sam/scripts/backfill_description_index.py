@@ -0,0 +1,47 @@
+import argparse
+import os
+import sys
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambdas", "ActivitiesTableLayer"))
+
+from descriptionIndex import indexActivity  # noqa: E402
+
+# one time migration: the description token index is maintained by the
+# activities stream, activities written before it was deployed have no
+# token items. this scans the table and writes them.
+#
+# usage: python scripts/backfill_description_index.py --table <activities table name>
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--table", required=True)
+  parser.add_argument("--dry-run", action="store_true")
+  args = parser.parse_args()
+
+  table = boto3.resource("dynamodb").Table(args.table)
+  params = {
+    "FilterExpression": Attr("sk").begins_with("1") | Attr("sk").begins_with("2"),
+    "ProjectionExpression": "#u, sk, description",
+    "ExpressionAttributeNames": {"#u": "user"},
+  }
+  indexed = 0
+  response = table.scan(**params)
+  with table.batch_writer(overwrite_by_pkeys=["user", "sk"]) as batch:
+    while True:
+      for item in response["Items"]:
+        indexed += 1
+        if not args.dry_run:
+          # token items are idempotent puts, rerunning is safe
+          indexActivity(batch, item["user"], item["sk"], newDescription=item.get("description", ""))
+      if not response.get("LastEvaluatedKey"):
+        break
+      response = table.scan(**params, ExclusiveStartKey=response["LastEvaluatedKey"])
+  print(f"{'would index' if args.dry_run else 'indexed'} {indexed} activities")
+
+
+if __name__ == "__main__":
+  __main__()
@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambdas", "ActivitiesTableLayer"))
+
+from activityIndexes import INDEX_KEY_ATTRIBUTES, activityIndexKeys  # noqa: E402
+from activityMappings import storedMappingFields  # noqa: E402
+from mappingCache import mapping_cache  # noqa: E402
+
+# one time migration: activity items written before the secondary indexes
+# existed have no index key attributes, so they are invisible to the
+# indexes. items written before mappings were stored on activities have no
+# base_category/dirty/predicted either, and review_key depends on dirty.
+# this scans the table, applies the user's mappings to every activity and
+# sets the attributes that are missing or out of date. soft deleted copies
+# (deleted#) used to keep their index keys and show up in the indexes, their
+# keys are removed.
+#
+# usage: python scripts/backfill_index_keys.py --table <activities table name>
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--table", required=True)
+  parser.add_argument("--dry-run", action="store_true")
+  args = parser.parse_args()
+
+  table = boto3.resource("dynamodb").Table(args.table)
+  params = {
+    "FilterExpression": Attr("sk").begins_with("1") | Attr("sk").begins_with("2") | Attr("sk").begins_with("deleted#"),
+  }
+  updated = 0
+  response = table.scan(**params)
+  while True:
+    for item in response["Items"]:
+      if item["sk"].startswith("deleted#"):
+        stale = [key for key in INDEX_KEY_ATTRIBUTES if key in item]
+        if stale:
+          updated += 1
+          if not args.dry_run:
+            table.update_item(Key={"user": item["user"], "sk": item["sk"]}, UpdateExpression="remove " + ", ".join(stale))
+        continue
+      user = item["user"]
+      fields = storedMappingFields(mapping_cache.getMatcher(table, user), user, item)
+      fields.update(activityIndexKeys(user, {**item, **fields}))
+      missing = {key: value for key, value in fields.items() if key not in item or item[key] != value}
+      if not missing:
+        continue
+      updated += 1
+      if args.dry_run:
+        continue
+      table.update_item(
+        Key={"user": item["user"], "sk": item["sk"]},
+        UpdateExpression="set " + ", ".join(f"#{key} = :{key}" for key in missing),
+        ExpressionAttributeNames={f"#{key}": key for key in missing},
+        ExpressionAttributeValues={f":{key}": value for key, value in missing.items()},
+      )
+    if not response.get("LastEvaluatedKey"):
+      break
+    response = table.scan(**params, ExclusiveStartKey=response["LastEvaluatedKey"])
+  print(f"{'would update' if args.dry_run else 'updated'} {updated} items")
+
+
+if __name__ == "__main__":
+  __main__()
@@ -0,0 +1,79 @@
+import argparse
+import time
+
+from benchmark_helpers import add_lambda_paths, mock_activities_table
+
+add_lambda_paths("activities")
+
+from tests.helpers import QueryCountingTable  # noqa: E402
+from activityIndexes import activityIndexKeys  # noqa: E402
+from getActivities import getActivities  # noqa: E402
+from boto3.dynamodb.conditions import Key, Attr  # noqa: E402
+
+# shows that an account filtered page reads scale with the page size, not
+# with the size of the user's history. compares the previous approach (query
+# the whole partition with an account FilterExpression) with the account index.
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_account_index.py
+
+USER = "benchmark-user"
+ACCOUNTS = ["chequing", "visa", "mastercard", "savings"]
+
+
+def fill_history(table, size: int):
+  with table.batch_writer() as batch:
+    for i in range(size):
+      item = {
+        "user": USER,
+        "sk": f"20{10 + i % 14:02d}-{1 + i % 12:02d}-{1 + i % 28:02d}#{i:07d}",
+        "date": f"20{10 + i % 14:02d}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+        "description": f"activity {i}",
+        "category": "benchmark",
+        "amount": 10,
+        "account": ACCOUNTS[i % len(ACCOUNTS)],
+      }
+      batch.put_item(Item={**item, **activityIndexKeys(USER, item)})
+
+
+def filter_expression_page(table, account: str, size: int):
+  # what getActivities did before: no Limit, page through everything, filter
+  params = {
+    "KeyConditionExpression": Key("user").eq(USER) & Key("sk").between("0000-00-00", "9999-99-99"),
+    "FilterExpression": Attr("account").eq(account),
+    "ScanIndexForward": False,
+  }
+  response = table.query(**params)
+  items = response["Items"]
+  while response.get("LastEvaluatedKey"):
+    response = table.query(**params, ExclusiveStartKey=response["LastEvaluatedKey"])
+    items.extend(response["Items"])
+  return items[:size]
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--page-size", type=int, default=25)
+  args = parser.parse_args()
+
+  print(f"{'history':>10}{'filter reads':>15}{'filter ms':>12}{'index reads':>14}{'index ms':>11}")
+  for history in [1000, 5000, 20000]:
+    with mock_activities_table() as table:
+      fill_history(table, history)
+      counting = QueryCountingTable(table)
+
+      start = time.perf_counter()
+      filter_expression_page(counting, "visa", args.page_size)
+      filter_ms = (time.perf_counter() - start) * 1000
+      filter_reads = counting.scanned_count
+
+      counting.scanned_count = 0
+      start = time.perf_counter()
+      getActivities(USER, args.page_size, counting, account="visa")
+      index_ms = (time.perf_counter() - start) * 1000
+      index_reads = counting.scanned_count
+
+      print(f"{history:>10}{filter_reads:>15}{filter_ms:>12.1f}{index_reads:>14}{index_ms:>11.1f}")
+
+
+if __name__ == "__main__":
+  __main__()
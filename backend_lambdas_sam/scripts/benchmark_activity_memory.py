@@ -0,0 +1,130 @@
+import argparse
+import csv
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+from benchmark_helpers import add_lambda_paths
+
+add_lambda_paths("activities")
+
+from boto3.dynamodb.types import TypeSerializer  # noqa: E402
+
+from activityIndexes import activityIndexKeys  # noqa: E402
+from bankFormats import FORMATS  # noqa: E402
+from benchmark_ingest_stream import synthetic_row  # noqa: E402
+from mappingMatcher import MappingMatcher  # noqa: E402
+
+# bytes per activity (tracemalloc) of an upload's activities kept in a list,
+# like the preview does, for the previous dict backed Activity and the slot
+# based ActivityRecord built from the same csv rows. also the time per row to
+# get the DynamoDB wire format item: {**toDict(), ...} through the resource's
+# TypeSerializer before, toWireItem after.
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_activity_memory.py [--rows 100000]
+
+
+class DictActivity:
+  # libs.Activity before it moved to the layer
+  def __init__(self, account, date, amount, description, sk=None, category=None):
+    self.sk = date + str(uuid.uuid4()) if sk is None else sk
+    self.account = account
+    self.date = date
+    self.description = description
+    self.category = category if category is not None else description
+    self.base_category = self.category
+    self.amount = amount
+    self.search_term = description.lower() if description else 'other'
+    self.predicted = []
+    self.dirty = False
+
+  def toDict(self):
+    return {
+      "sk": self.sk,
+      "account": self.account,
+      "date": self.date,
+      "description": self.description,
+      "amount": str(self.amount),
+      "search_term": self.search_term,
+      "category": self.category,
+      "base_category": self.base_category,
+      "predicted": self.predicted,
+      "dirty": self.dirty,
+    }
+
+  def applyMappings(self, matcher):
+    matchedMapping = matcher.match(self.description)
+    self.dirty = len(matchedMapping) > 0
+    self.category = matchedMapping[0]["category"] if len(matchedMapping) > 0 else self.base_category
+    self.predicted = [mapping["category"] for mapping in matchedMapping]
+
+
+def dict_cap1(row):
+  return DictActivity(
+    account=row[2],
+    date=datetime.strptime(row[0], "%Y-%m-%d").strftime("%Y-%m-%d"),
+    description=row[3],
+    category=row[4],
+    amount=Decimal(row[5]) if row[5] else 0 - Decimal(row[6]),
+  )
+
+
+def dict_item(activity):
+  itemDict = activity.toDict()
+  return {**itemDict, **activityIndexKeys("user", itemDict), "amount": activity.amount, "user": "user", "chksum": "chksum"}
+
+
+def measure(build, rows) -> float:
+  tracemalloc.start()
+  held = build(rows)
+  current, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del held
+  return current / len(rows)
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--rows", type=int, default=100000)
+  args = parser.parse_args()
+
+  matcher = MappingMatcher([{"description": "MERCHANT #1", "category": "mapped"}])
+  convert = FORMATS["cap1"].convert
+  rows = list(csv.reader(synthetic_row("cap1", i) for i in range(args.rows)))
+
+  def dict_held(rows):
+    activities = [dict_cap1(row) for row in rows]
+    for activity in activities:
+      activity.applyMappings(matcher)
+    return activities
+
+  def slot_held(rows):
+    activities = [convert(row) for row in rows]
+    for activity in activities:
+      activity.sk = activity.date + str(uuid.uuid4())
+      activity.applyMappings(matcher)
+    return activities
+
+  before, after = measure(dict_held, rows), measure(slot_held, rows)
+  print(f"{'rows':>8}{'dict bytes/row':>16}{'slots bytes/row':>17}{'saved':>8}")
+  print(f"{len(rows):>8}{before:>16.0f}{after:>17.0f}{1 - after / before:>8.0%}")
+
+  serializer = TypeSerializer()
+  dict_activities = dict_held(rows)
+  start = time.perf_counter()
+  for activity in dict_activities:
+    {key: serializer.serialize(value) for key, value in dict_item(activity).items()}
+  before = (time.perf_counter() - start) / len(rows) * 1e6
+  slot_activities = slot_held(rows)
+  start = time.perf_counter()
+  for activity in slot_activities:
+    activity.toWireItem("user", "chksum")
+  after = (time.perf_counter() - start) / len(rows) * 1e6
+  print(f"{'rows':>8}{'dict + TypeSerializer us/row':>30}{'toWireItem us/row':>19}")
+  print(f"{len(rows):>8}{before:>30.1f}{after:>19.1f}")
+
+
+if __name__ == "__main__":
+  __main__()
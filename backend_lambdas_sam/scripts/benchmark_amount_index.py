@@ -0,0 +1,79 @@
+import argparse
+import time
+from decimal import Decimal
+
+from benchmark_helpers import add_lambda_paths, mock_activities_table
+
+add_lambda_paths("activities")
+
+from tests.helpers import QueryCountingTable  # noqa: E402
+from activityIndexes import activityIndexKeys  # noqa: E402
+from getActivities import getActivities  # noqa: E402
+from boto3.dynamodb.conditions import Key, Attr  # noqa: E402
+
+# shows that the largest-amount page and amount range pages read scale with
+# the page size, not with the size of the user's history. compares the
+# previous approach (query the whole partition, filter and sort in memory)
+# with the amount index.
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_amount_index.py
+
+USER = "benchmark-user"
+
+
+def fill_history(table, size: int):
+  with table.batch_writer() as batch:
+    for i in range(size):
+      item = {
+        "user": USER,
+        "sk": f"20{10 + i % 14:02d}-{1 + i % 12:02d}-{1 + i % 28:02d}#{i:07d}",
+        "date": f"20{10 + i % 14:02d}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+        "description": f"activity {i}",
+        "category": "benchmark",
+        "amount": Decimal((i * 7919) % 100000) / 100 - 500,
+        "account": "visa",
+      }
+      batch.put_item(Item={**item, **activityIndexKeys(USER, item)})
+
+
+def partition_page(table, size: int, amountMin=None, amountMax=None):
+  # what getActivities did before: page through everything, filter, sort
+  params = {
+    "KeyConditionExpression": Key("user").eq(USER) & Key("sk").between("0000-00-00", "9999-99-99"),
+  }
+  if amountMin is not None and amountMax is not None:
+    params["FilterExpression"] = Attr("amount").between(amountMin, amountMax)
+  response = table.query(**params)
+  items = response["Items"]
+  while response.get("LastEvaluatedKey"):
+    response = table.query(**params, ExclusiveStartKey=response["LastEvaluatedKey"])
+    items.extend(response["Items"])
+  return sorted(items, key=lambda x: x["amount"], reverse=True)[:size]
+
+
+def measure(counting, fn, *args, **kwargs):
+  counting.scanned_count = 0
+  start = time.perf_counter()
+  fn(*args, **kwargs)
+  return counting.scanned_count, (time.perf_counter() - start) * 1000
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--page-size", type=int, default=25)
+  args = parser.parse_args()
+
+  print(f"{'history':>10}{'query':>8}{'scan reads':>13}{'scan ms':>10}{'index reads':>14}{'index ms':>11}")
+  for history in [1000, 5000, 20000]:
+    with mock_activities_table() as table:
+      fill_history(table, history)
+      counting = QueryCountingTable(table)
+      for name, bounds in [("top", {}), ("range", {"amountMin": 100, "amountMax": 150})]:
+        scan_reads, scan_ms = measure(counting, partition_page, counting, args.page_size, **bounds)
+        index_reads, index_ms = measure(
+          counting, getActivities, USER, args.page_size, counting, orderByAmount=True, **bounds)
+        print(f"{history:>10}{name:>8}{scan_reads:>13}{scan_ms:>10.1f}{index_reads:>14}{index_ms:>11.1f}")
+
+
+if __name__ == "__main__":
+  __main__()
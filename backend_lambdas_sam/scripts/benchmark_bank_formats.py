@@ -0,0 +1,92 @@
+import argparse
+import contextlib
+import csv
+import io
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from benchmark_helpers import add_lambda_paths
+
+add_lambda_paths("activities")
+
+from bankFormats import FORMATS  # noqa: E402
+from benchmark_ingest_stream import synthetic_row  # noqa: E402
+from libs import Activity, mask_account_number  # noqa: E402
+
+# rows/s of converting parsed csv rows to activities, per bank format: the
+# previous hand written serializers (strptime + strftime per row) vs the
+# converters compiled from the format specs. csv parsing is done up front
+# and not timed, so only the row conversion is compared.
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_bank_formats.py [--rows 200000]
+
+
+def strptime_rbc(row):
+  if len(row) < 7:
+    return None
+  if not row[6] or row[6] == "0":
+    print("skipping row" + ','.join(row))
+    return None
+  return Activity(
+    account=f"{mask_account_number(row[1])}-{row[0]}",
+    date=datetime.strptime(row[2], "%m/%d/%Y").strftime("%Y-%m-%d"),
+    description=row[5],
+    category=row[4],
+    amount=0 - Decimal(row[6]),
+  )
+
+
+def strptime_cap1(row):
+  if len(row) < 6:
+    return None
+  return Activity(
+    account=row[2],
+    date=datetime.strptime(row[0], "%Y-%m-%d").strftime("%Y-%m-%d"),
+    description=row[3],
+    category=row[4],
+    amount=Decimal(row[5]) if row[5] else 0 - Decimal(row[6]),
+  )
+
+
+def strptime_td(row):
+  return Activity(
+    date=datetime.strptime(row[0], "%m/%d/%Y").strftime("%Y-%m-%d"),
+    account='td',
+    description=row[1],
+    amount=Decimal(row[2]) if row[2] else 0 - Decimal(row[3]),
+  )
+
+
+STRPTIME = {"rbc": strptime_rbc, "cap1": strptime_cap1, "td": strptime_td}
+
+
+def rows_per_second(convert, rows) -> float:
+  start = time.perf_counter()
+  with contextlib.redirect_stdout(io.StringIO()):
+    for row in rows:
+      convert(row)
+  return len(rows) / (time.perf_counter() - start)
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--rows", type=int, default=200000)
+  parser.add_argument("--formats", nargs="+", default=["rbc", "cap1", "td"])
+  args = parser.parse_args()
+
+  print(f"{'format':>7}{'rows':>10}{'strptime rows/s':>18}{'compiled rows/s':>18}{'speedup':>10}")
+  for file_format in args.formats:
+    rows = list(csv.reader(synthetic_row(file_format, i) for i in range(args.rows)))
+    for row in rows[:100]:
+      # both produce the same activity
+      expected, got = STRPTIME[file_format](row), FORMATS[file_format].convert(row)
+      assert (expected.account, expected.date, expected.amount, expected.description, expected.category) == \
+        (got.account, got.date, got.amount, got.description, got.category), row
+    before = rows_per_second(STRPTIME[file_format], rows)
+    after = rows_per_second(FORMATS[file_format].convert, rows)
+    print(f"{file_format:>7}{len(rows):>10}{before:>18.0f}{after:>18.0f}{after / before:>9.1f}x")
+
+
+if __name__ == "__main__":
+  __main__()
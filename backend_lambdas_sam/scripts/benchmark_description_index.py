@@ -0,0 +1,93 @@
+import argparse
+import time
+
+from benchmark_helpers import add_lambda_paths, mock_activities_table
+
+add_lambda_paths("activities")
+
+from tests.helpers import QueryCountingTable  # noqa: E402
+from activityIndexes import activityIndexKeys  # noqa: E402
+from descriptionIndex import indexActivity  # noqa: E402
+from getActivities import getActivities  # noqa: E402
+from boto3.dynamodb.conditions import Key, Attr  # noqa: E402
+
+# items read and latency of a description search (a typed word, a typeahead
+# prefix and a two word query) over a large synthetic history. compares the
+# previous approach (query the whole partition with a contains FilterExpression)
+# with the description token index. posting list entries are keys-only items
+# a few bytes long, so compare the reads columns; moto filters the whole
+# partition in python for every query, its latency says little here.
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_description_index.py
+
+USER = "benchmark-user"
+MERCHANTS = [
+  "SAFEWAY", "PETRO CANADA", "LONDON DRUGS", "SAVE ON FOODS", "IMPARK", "RAMEN DANBO ROBSON",
+  "AMAZON MKTPLACE", "SHOPPERS DRUG MART", "COMPASS VANCOUVER", "SPOTIFY", "NETFLIX", "UBER TRIP",
+]
+QUERIES = ["robson", "rob", "london drugs"]
+
+
+def fill_history(table, size: int):
+  with table.batch_writer() as batch:
+    for i in range(size):
+      # a store number per merchant, so most tokens are rare
+      description = f"{MERCHANTS[i % len(MERCHANTS)]} #{i % 997:04d}"
+      item = {
+        "user": USER,
+        "sk": f"20{10 + i % 14:02d}-{1 + i % 12:02d}-{1 + i % 28:02d}#{i:07d}",
+        "date": f"20{10 + i % 14:02d}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+        "description": description,
+        "search_term": description.lower(),
+        "category": "benchmark",
+        "amount": 10,
+        "account": "visa",
+      }
+      batch.put_item(Item={**item, **activityIndexKeys(USER, item)})
+      indexActivity(batch, USER, item["sk"], newDescription=description)
+
+
+def contains_page(table, text: str, size: int):
+  # what getActivities did before: page through everything, filter
+  params = {
+    "KeyConditionExpression": Key("user").eq(USER) & Key("sk").between("0000-00-00", "9999-99-99"),
+    "FilterExpression": Attr("search_term").contains(text.lower()),
+    "ScanIndexForward": False,
+  }
+  response = table.query(**params)
+  items = response["Items"]
+  while response.get("LastEvaluatedKey"):
+    response = table.query(**params, ExclusiveStartKey=response["LastEvaluatedKey"])
+    items.extend(response["Items"])
+  return items[:size]
+
+
+def measure(counting, fn, *args, **kwargs):
+  counting.scanned_count = 0
+  start = time.perf_counter()
+  fn(*args, **kwargs)
+  return counting.scanned_count, (time.perf_counter() - start) * 1000
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--history", type=int, default=50000)
+  parser.add_argument("--page-size", type=int, default=25)
+  args = parser.parse_args()
+
+  with mock_activities_table() as table:
+    start = time.perf_counter()
+    fill_history(table, args.history)
+    print(f"indexed {args.history} activities in {time.perf_counter() - start:.1f}s")
+    counting = QueryCountingTable(table)
+
+    # index reads are posting list entries, the page itself is one batch_get_item
+    print(f"{'query':>15}{'scan reads':>13}{'scan ms':>10}{'index reads':>14}{'index ms':>11}")
+    for text in QUERIES:
+      scan_reads, scan_ms = measure(counting, contains_page, counting, text, args.page_size)
+      index_reads, index_ms = measure(counting, getActivities, USER, args.page_size, counting, description=text)
+      print(f"{text:>15}{scan_reads:>13}{scan_ms:>10.1f}{index_reads:>14}{index_ms:>11.1f}")
+
+
+if __name__ == "__main__":
+  __main__()
@@ -0,0 +1,70 @@
+import argparse
+import random
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from benchmark_helpers import add_lambda_paths
+
+add_lambda_paths("activities")
+
+from libs import Activity, DuplicateIndex, isDuplicate  # noqa: E402
+
+# duplicate detection for an upload preview: the previous pairwise scan
+# (every uploaded row against every existing activity) vs the hash index,
+# exact and fuzzy. the pairwise scan is timed on a sample of uploaded rows
+# and extrapolated once it would take more than a few seconds.
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_duplicate_index.py
+
+PAIRWISE_SAMPLE = 200
+
+
+def synthetic_activities(size: int, seed: int):
+  rng = random.Random(seed)
+  start = date(2023, 1, 1)
+  return [Activity(
+    account="visa",
+    date=(start + timedelta(days=rng.randint(0, 364))).isoformat(),
+    amount=Decimal(rng.randint(100, 20000)) / 100,
+    description=f"MERCHANT #{rng.randint(0, 500)}",
+    sk=f"{seed}-{i}",
+  ) for i in range(size)]
+
+
+def pairwise_seconds(existing, uploaded):
+  sample = uploaded[:PAIRWISE_SAMPLE]
+  start = time.perf_counter()
+  for item in sample:
+    [other.sk for other in existing if isDuplicate(other, item)]
+  return (time.perf_counter() - start) * len(uploaded) / len(sample)
+
+
+def index_seconds(existing, uploaded, fuzzyDays: int):
+  start = time.perf_counter()
+  index = DuplicateIndex(existing, fuzzyDays)
+  for item in uploaded:
+    index.find(item)
+  return time.perf_counter() - start
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 50000])
+  parser.add_argument("--fuzzy-days", type=int, default=3)
+  args = parser.parse_args()
+
+  print(f"{'existing x uploaded':>22}{'pairwise s':>13}{'index s':>10}{'fuzzy index s':>16}")
+  for size in args.sizes:
+    existing = synthetic_activities(size, 1)
+    # a re-upload: half the rows are already stored
+    uploaded = existing[:size // 2] + synthetic_activities(size - size // 2, 2)
+    pairwise = pairwise_seconds(existing, uploaded)
+    exact = index_seconds(existing, uploaded, 0)
+    fuzzy = index_seconds(existing, uploaded, args.fuzzy_days)
+    estimated = "~" if len(uploaded) > PAIRWISE_SAMPLE else ""
+    print(f"{f'{size} x {size}':>22}{estimated + f'{pairwise:.2f}':>13}{exact:>10.3f}{fuzzy:>16.3f}")
+
+
+if __name__ == "__main__":
+  __main__()
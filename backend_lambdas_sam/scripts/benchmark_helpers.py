@@ -0,0 +1,32 @@
+import os
+import sys
+from contextlib import contextmanager
+
+# shared setup for the benchmark scripts that run lambda code against a
+# moto table. needs the test requirements (pip install -r tests/requirements.txt)
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYERS = ["auth_layer", "ActivitiesTableLayer"]
+
+
+def add_lambda_paths(*lambda_dirs):
+  """ puts the layers and the given lambda code dirs on the path, like the lambda runtime does """
+  for path in [ROOT_DIR] + [os.path.join(ROOT_DIR, "lambdas", name) for name in LAYERS + list(lambda_dirs)]:
+    if path not in sys.path:
+      sys.path.append(path)
+
+
+@contextmanager
+def mock_activities_table():
+  """ yields a moto activities table with the same indexes as template.yaml """
+  import boto3
+  from moto import mock_aws
+  from tests.helpers import TestHelpers
+
+  os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+  os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+  os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+  os.environ.setdefault("ACTIVITIES_TABLE", "activities")
+  with mock_aws():
+    dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
+    yield TestHelpers.create_activities_table(dynamodb)
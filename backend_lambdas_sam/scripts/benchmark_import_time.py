@@ -0,0 +1,81 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# measures `python -X importtime` for each lambda handler module (plus the
+# per-route modules of the activities lambda) with the layers on the path,
+# the same way the lambda runtime sees them, and fails if a module goes over
+# its budget.
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_import_time.py
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambdas")
+LAYERS = ["auth_layer", "ActivitiesTableLayer"]
+
+# (lambda code dir, module) -> cumulative import time budget in milliseconds
+IMPORT_BUDGETS_MS = {
+  ("activities", "app"): 250,
+  ("activities", "getActivities"): 300,
+  ("activities", "postActivities"): 300,
+  ("activities", "deleteActivities"): 300,
+  ("activities", "patchActivity"): 300,
+  ("activities", "uploadJobs"): 300,
+  ("activities", "ingestWorker"): 350,
+  ("activityInsights", "app"): 350,
+  ("activitiesStreams", "app"): 300,
+  ("mappings", "app"): 350,
+  ("monthlyCheck", "app"): 300,
+  ("deleted", "app"): 350,
+  ("fileCheck", "app"): 350,
+  ("wishlist", "app"): 350,
+}
+
+
+def measure_import_ms(lambda_dir: str, module: str) -> float:
+  code_dir = os.path.join(LAMBDAS_DIR, lambda_dir)
+  env = {
+    **os.environ,
+    "PYTHONPATH": os.pathsep.join([code_dir] + [os.path.join(LAMBDAS_DIR, layer) for layer in LAYERS]),
+  }
+  result = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+    cwd=code_dir,
+    env=env,
+    capture_output=True,
+    text=True,
+  )
+  if result.returncode != 0:
+    raise RuntimeError(f"failed to import {lambda_dir}/{module}: {result.stderr.splitlines()[-1:]}")
+  for line in reversed(result.stderr.splitlines()):
+    # import time: self [us] | cumulative | imported package
+    parts = [part.strip() for part in line.split("|")]
+    if len(parts) == 3 and parts[2] == module:
+      return int(parts[1]) / 1000
+  raise RuntimeError(f"no importtime entry for {lambda_dir}/{module}")
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--runs", type=int, default=5, help="runs per module, the median is reported")
+  parser.add_argument("--scale", type=float, default=1.0, help="multiplier applied to every budget")
+  args = parser.parse_args()
+
+  over_budget = []
+  print(f"{'module':<40}{'median ms':>12}{'budget ms':>12}")
+  for (lambda_dir, module), budget in IMPORT_BUDGETS_MS.items():
+    median = statistics.median(measure_import_ms(lambda_dir, module) for _ in range(args.runs))
+    budget = budget * args.scale
+    name = f"{lambda_dir}/{module}"
+    print(f"{name:<40}{median:>12.1f}{budget:>12.1f}{'  OVER BUDGET' if median > budget else ''}")
+    if median > budget:
+      over_budget.append(name)
+
+  if over_budget:
+    print(f"modules over import budget: {', '.join(over_budget)}")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  __main__()
@@ -0,0 +1,138 @@
+import argparse
+import csv
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from benchmark_helpers import add_lambda_paths
+
+add_lambda_paths("activities")
+
+# peak memory and throughput of parsing an upload and handing every row to
+# the batch writer, for the previous approach (splitlines, build every
+# Activity, then write) and the streaming pipeline. writes go to a sink that
+# drops them, so only parsing, serialization and mapping are measured. each
+# run is its own process so ru_maxrss is not shared between runs.
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_ingest_stream.py [--sizes 10000 100000 1000000]
+
+HEADERS = {
+  "rbc": '"Account Type","Account Number","Transaction Date","Cheque Number","Description 1","Description 2","CAD$","USD$"',
+  "cap1": "Transaction Date,Posted Date,Card No.,Description,Category,Debit,Credit",
+  "td": None,
+}
+
+
+def synthetic_row(file_format: str, i: int) -> str:
+  day = date(2010, 1, 1) + timedelta(days=i % 5000)
+  amount = f"{(i * 7919) % 100000 / 100:.2f}"
+  if file_format == "rbc":
+    return f'Savings,07702-5084629,{day.month}/{day.day}/{day.year},,"PURCHASE {i % 997}","store {i % 31}",-{amount},,'
+  if file_format == "cap1":
+    return f"{day.isoformat()},{day.isoformat()},0733,MERCHANT #{i % 997},Dining,{amount},"
+  return f"{day.month:02d}/{day.day:02d}/{day.year},MERCHANT #{i % 997},{amount},,1000.00"
+
+
+def write_file(file_format: str, size: int) -> str:
+  handle, path = tempfile.mkstemp(suffix=f"-{file_format}.csv")
+  with os.fdopen(handle, "w") as f:
+    if HEADERS[file_format]:
+      f.write(HEADERS[file_format] + "\n")
+    for i in range(size):
+      f.write(synthetic_row(file_format, i) + "\n")
+  return path
+
+
+class NullBatch:
+  def __init__(self):
+    self.count = 0
+
+  def put_item(self, Item):
+    self.count += 1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+def list_pipeline(body, file_format, matcher, batch):
+  # what postActivities did before
+  from activityIndexes import activityIndexKeys
+  from bankFormats import FORMATS
+  rows = csv.reader(body.splitlines(), delimiter=',')
+  items = []
+  for index, row in enumerate(rows):
+    if index == 0 and file_format in ("rbc", "cap1"):
+      continue
+    item = FORMATS[file_format].convert(row)
+    if item:
+      items.append(item)
+  for item in items:
+    item.applyMappings(matcher)
+  for item in items:
+    itemDict = item.toDict()
+    batch.put_item(Item={**itemDict, **activityIndexKeys("user", itemDict), "amount": item.amount})
+
+
+def stream_pipeline(body, file_format, matcher, batch):
+  import postActivities
+  dates = postActivities.DateRange()
+  for item in dates.track(postActivities.iterItemsFromBody(body, file_format)):
+    item.applyMappings(matcher)
+    batch.put_item(Item=item.toWireItem("user", "chksum"))
+
+
+def run_one(path: str, file_format: str, mode: str):
+  import contextlib
+  import io
+  from mappingMatcher import MappingMatcher
+  import postActivities  # noqa: F401 import cost is not part of the run
+  with open(path) as f:
+    body = f.read()
+  baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  batch = NullBatch()
+  matcher = MappingMatcher([{"description": "MERCHANT #1", "category": "mapped"}])
+  start = time.perf_counter()
+  # skipped rows print a line each, keep that out of the timing
+  with contextlib.redirect_stdout(io.StringIO()):
+    (list_pipeline if mode == "list" else stream_pipeline)(body, file_format, matcher, batch)
+  elapsed = time.perf_counter() - start
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in KiB on linux
+  print(f"{batch.count} {elapsed} {(peak - baseline) / 1024} {len(body) / 1024 / 1024}")
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+  parser.add_argument("--formats", nargs="+", default=["rbc", "cap1", "td"])
+  parser.add_argument("--run", nargs=3, metavar=("PATH", "FORMAT", "MODE"), help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.run:
+    run_one(*args.run)
+    return
+
+  print(f"{'format':>7}{'rows':>10}{'file MiB':>10}{'mode':>8}{'rows/s':>12}{'peak RSS over body MiB':>25}")
+  for file_format in args.formats:
+    for size in args.sizes:
+      path = write_file(file_format, size)
+      try:
+        for mode in ["list", "stream"]:
+          output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run", path, file_format, mode],
+            check=True, capture_output=True, text=True).stdout.split()
+          rows, elapsed, peak, file_mib = int(output[0]), float(output[1]), float(output[2]), float(output[3])
+          print(f"{file_format:>7}{size:>10}{file_mib:>10.1f}{mode:>8}{rows / elapsed:>12.0f}{peak:>25.1f}")
+      finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+  __main__()
@@ -0,0 +1,66 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambdas", "ActivitiesTableLayer"))
+
+from mappingMatcher import MappingMatcher  # noqa: E402
+
+# compares the compiled mapping matcher with the list comprehension that
+# applyMappings used before, at 10/100/1000 mappings
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_mapping_matcher.py
+
+MERCHANTS = ["SAFEWAY", "SAVE ON FOODS", "PETRO CANADA", "RAMEN DANBO", "LONDON DRUGS", "IMPARK",
+             "T&T SUPERMARKET", "STARBUCKS", "AMAZON.CA", "SHOPPERS DRUG MART", "COMPASS VENDING"]
+
+
+def generate_mappings(rng: random.Random, count: int):
+  return [{
+    "description": f"{rng.choice(MERCHANTS)} #{i:04d}",
+    "category": f"category{i % 20}",
+  } for i in range(count)]
+
+
+def generate_descriptions(rng: random.Random, count: int, distinct: int):
+  pool = [f"{rng.choice(MERCHANTS)} #{rng.randint(0, 1999):04d} VANCOUVER BC" for _ in range(distinct)]
+  return [rng.choice(pool) for _ in range(count)]
+
+
+def list_comprehension(mappings, descriptions):
+  return [[mapping for mapping in mappings if mapping["description"] in desc] for desc in descriptions]
+
+
+def compiled(mappings, descriptions):
+  matcher = MappingMatcher(mappings)
+  return [matcher.match(desc) for desc in descriptions]
+
+
+def timed(fn, *args):
+  start = time.perf_counter()
+  result = fn(*args)
+  return result, (time.perf_counter() - start) * 1000
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--activities", type=int, default=20000)
+  parser.add_argument("--distinct", type=int, default=5000, help="distinct descriptions among the activities")
+  args = parser.parse_args()
+
+  rng = random.Random(0)
+  descriptions = generate_descriptions(rng, args.activities, args.distinct)
+  print(f"{args.activities} activities, {args.distinct} distinct descriptions")
+  print(f"{'mappings':>10}{'list comp ms':>16}{'matcher ms':>14}{'speedup':>10}")
+  for count in [10, 100, 1000]:
+    mappings = generate_mappings(rng, count)
+    expected, baseline_ms = timed(list_comprehension, mappings, descriptions)
+    actual, matcher_ms = timed(compiled, mappings, descriptions)
+    assert actual == expected, "matcher results differ from list comprehension"
+    print(f"{count:>10}{baseline_ms:>16.1f}{matcher_ms:>14.1f}{baseline_ms / matcher_ms:>9.1f}x")
+
+
+if __name__ == "__main__":
+  __main__()
@@ -0,0 +1,83 @@
+import argparse
+import time
+from types import SimpleNamespace
+
+from benchmark_helpers import add_lambda_paths, mock_activities_table
+
+add_lambda_paths()
+
+from lambdas.monthlyCheck import app  # noqa: E402
+
+# wall time of monthlyCheck's full table read (scan_table: parallel scan,
+# results partitioned by user) at 1 to 16 segments over a moto table.
+# moto scans in process and walks the whole table for every page, all under
+# the GIL, so it can't serve segments in parallel the way DynamoDB does.
+# every page is therefore scanned from moto once, untimed, and replayed in
+# the timed runs after waiting --latency-ms, which stands in for the DynamoDB
+# round trip. --page-size stands in for the 1MB page limit.
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_monthly_check_scan.py [--users 200] [--latency-ms 20]
+
+
+class ReplayClient:
+  """ moto's scan pages, recorded on the first call and replayed with a fixed latency """
+
+  def __init__(self, client, latency: float):
+    self._client = client
+    self.latency = latency
+    self.recording = True
+    self._pages = {}
+
+  def scan(self, **kwargs):
+    key = (kwargs["Segment"], kwargs["TotalSegments"], str(kwargs.get("ExclusiveStartKey")))
+    if self.recording:
+      self._pages[key] = self._client.scan(**kwargs)
+    else:
+      time.sleep(self.latency)
+    return self._pages[key]
+
+
+def fill_table(table, users: int, activities: int):
+  with table.batch_writer() as batch:
+    for user in range(users):
+      for i in range(3):
+        batch.put_item(Item={"user": f"user{user}", "sk": f"mapping#MERCHANT {i}",
+                             "description": f"MERCHANT {i}", "category": f"category {i}"})
+      for i in range(activities):
+        day = f"2022-{1 + i % 12:02d}-{1 + i % 28:02d}"
+        batch.put_item(Item={"user": f"user{user}", "sk": f"{day}#{i:05d}", "date": day,
+                             "description": f"MERCHANT {i % 7}", "category": "benchmark", "amount": 10})
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--users", type=int, default=200)
+  parser.add_argument("--activities", type=int, default=100, help="activities per user")
+  parser.add_argument("--latency-ms", type=float, default=20)
+  parser.add_argument("--page-size", type=int, default=500)
+  parser.add_argument("--segments", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+  args = parser.parse_args()
+
+  with mock_activities_table() as table:
+    fill_table(table, args.users, args.activities)
+    items = args.users * (args.activities + 3)
+    client = ReplayClient(table.meta.client, args.latency_ms / 1000)
+    app.table = SimpleNamespace(name=table.name, meta=SimpleNamespace(client=client))
+    for segments in args.segments:
+      app.scan_table(total_segments=segments, max_rows=items * 2, page_size=args.page_size)
+    client.recording = False
+
+    print(f"{items} items, {args.latency_ms:.0f}ms per page, {args.page_size} items per page")
+    print(f"{'segments':>9}{'seconds':>10}{'items/s':>10}{'speedup':>9}")
+    baseline = None
+    for segments in args.segments:
+      start = time.perf_counter()
+      by_user, complete = app.scan_table(total_segments=segments, max_rows=items * 2, page_size=args.page_size)
+      elapsed = time.perf_counter() - start
+      assert complete and sum(len(found["activities"]) + len(found["mappings"]) for found in by_user.values()) == items
+      baseline = baseline or elapsed
+      print(f"{segments:>9}{elapsed:>10.2f}{items / elapsed:>10.0f}{baseline / elapsed:>8.1f}x")
+
+
+if __name__ == "__main__":
+  __main__()
@@ -0,0 +1,112 @@
+import argparse
+import time
+import uuid
+from datetime import date, timedelta
+from decimal import Decimal
+
+from benchmark_helpers import add_lambda_paths, mock_activities_table
+
+add_lambda_paths()
+
+from tests.helpers import QueryCountingTable  # noqa: E402
+from lambdas.activitiesStreams import app  # noqa: E402
+from boto3.dynamodb.conditions import Key, Attr  # noqa: E402
+
+# related activity detection for one stream batch of new activities (an
+# upload): the previous per record lookup (two filtered queries over the
+# record's +-7 day window, one put_item per link) vs the batched one (merged
+# windows, one projected query each, links matched in memory and written
+# with the batch writer). both find the same links.
+#
+# usage (from backend_lambdas_sam): python scripts/benchmark_stream_related.py [--batch 500]
+
+USER = "benchmark-user"
+START = date(2022, 1, 1)
+
+
+def amount(i: int) -> Decimal:
+  # few distinct amounts, so there are duplicates and opposites to find
+  return Decimal((i * 7919) % 300 - 150) / 4
+
+
+def fill_history(table, size: int, days: int):
+  with table.batch_writer() as batch:
+    for i in range(size):
+      day = (START + timedelta(days=i % days)).isoformat()
+      batch.put_item(Item={"user": USER, "sk": f"{day}#{i:07d}", "date": day, "amount": amount(i),
+                           "description": "benchmark", "category": "benchmark"})
+
+
+def stream_batch(table, size: int, days: int) -> list:
+  # the upload's activities are in the table by the time the stream runs
+  records = []
+  with table.batch_writer() as batch:
+    for i in range(size):
+      day = (START + timedelta(days=i * days // size)).isoformat()
+      sk = f"{day}#new{i:05d}"
+      batch.put_item(Item={"user": USER, "sk": sk, "date": day, "amount": amount(i + 13),
+                           "description": "benchmark", "category": "benchmark"})
+      records.append({"eventName": "INSERT", "dynamodb": {
+        "Keys": {"sk": {"S": sk}, "user": {"S": USER}},
+        "NewImage": {"sk": {"S": sk}, "date": {"S": day}, "amount": {"N": str(amount(i + 13))}},
+      }})
+  return records
+
+
+def per_record_related(table, records) -> set:
+  # what activitiesStreams did before, for every INSERT
+  links = set()
+  for record in records:
+    sk = record["dynamodb"]["Keys"]["sk"]["S"]
+    value = Decimal(record["dynamodb"]["NewImage"]["amount"]["N"])
+    begin, end = app.related_window(record)
+    for kind, match in [("duplicate", value), ("opposite", -value)]:
+      response = table.query(
+        KeyConditionExpression=Key("user").eq(USER) & Key("sk").between(begin, end),
+        FilterExpression=Attr("amount").eq(match))
+      for item in response["Items"]:
+        if item["sk"] != sk:
+          table.put_item(Item={"user": USER, "sk": "related_activity#" + str(uuid.uuid4()),
+                               "related": item["sk"], "activity": sk,
+                               "opposite": kind == "opposite", "duplicate": kind == "duplicate"})
+          links.add((sk, item["sk"], kind))
+  return links
+
+
+def batched_related(table, records) -> set:
+  app.table = table
+  related = app.process_related_activities(records)
+  return {(item["activity"], item["related"], "opposite" if item["opposite"] else "duplicate") for item in related}
+
+
+def measure(counting, fn, records):
+  counting.query_count = counting.scanned_count = 0
+  start = time.perf_counter()
+  links = fn(counting, records)
+  return links, counting.query_count, counting.scanned_count, time.perf_counter() - start
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--history", type=int, default=5000)
+  parser.add_argument("--batch", type=int, default=500)
+  parser.add_argument("--days", type=int, default=60, help="days the stream batch spans")
+  args = parser.parse_args()
+
+  with mock_activities_table() as table:
+    fill_history(table, args.history, 3 * 365)
+    records = stream_batch(table, args.batch, args.days)
+    counting = QueryCountingTable(table)
+
+    before = measure(counting, per_record_related, records)
+    after = measure(counting, batched_related, records)
+    assert before[0] == after[0], "both approaches find the same links"
+
+    print(f"{args.batch} new activities, {len(after[0])} related links")
+    print(f"{'approach':>12}{'queries':>10}{'items read':>12}{'records/s':>12}")
+    for name, (_, queries, reads, elapsed) in [("per record", before), ("batched", after)]:
+      print(f"{name:>12}{queries:>10}{reads:>12}{len(records) / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+  __main__()
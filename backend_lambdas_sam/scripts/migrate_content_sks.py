@@ -0,0 +1,131 @@
+import argparse
+import os
+import sys
+from collections import defaultdict
+
+import boto3
+import botocore.exceptions
+from boto3.dynamodb.conditions import Attr, Key
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambdas", "ActivitiesTableLayer"))
+
+from activityIndexes import INDEX_KEY_ATTRIBUTES  # noqa: E402
+from contentKeys import MOVED_FROM, MOVED_TO, RELATED_ACTIVITY_PREFIX, OccurrenceCounter, isContentSk, relatedActivitySk  # noqa: E402
+
+# one time migration: activities ingested before content derived sort keys
+# have a "{date}{uuid}" sk, so re-ingesting their statements would add them
+# a second time. this moves every such activity to the sk ingestion gives the
+# same row today, numbering identical rows per uploaded file (chksum).
+#
+# an activity whose new sk is already taken is a duplicate from an earlier
+# overlapping upload. it is left in place and counted, --drop-duplicates soft
+# deletes it the same way DELETE /activities does.
+# related_activity items are pointed at the new sks and re-keyed by
+# (activity, related, kind) the way the stream keys them, which also merges
+# links that were stored twice.
+#
+# the stream sees every move as an INSERT of the new sk and a REMOVE of the
+# old one. the copy is written with moved_from (removed right after) and the
+# original gets moved_to before it is deleted, so the stream leaves moves out
+# of insights and doesn't look for related activities again; it only moves
+# their description index tokens. a move is four writes instead of two.
+#
+# usage: python scripts/migrate_content_sks.py --table <activities table name> [--dry-run] [--drop-duplicates]
+
+
+def scanUuidActivities(table) -> dict:
+  params = {
+    "FilterExpression": Attr("sk").begins_with("1") | Attr("sk").begins_with("2"),
+  }
+  byUser = defaultdict(list)
+  response = table.scan(**params)
+  while True:
+    for item in response["Items"]:
+      if not isContentSk(item["sk"]):
+        byUser[item["user"]].append(item)
+    if not response.get("LastEvaluatedKey"):
+      break
+    response = table.scan(**params, ExclusiveStartKey=response["LastEvaluatedKey"])
+  return byUser
+
+
+def moveItem(table, item: dict, newSk: str) -> bool:
+  """ copies the item to newSk and deletes the old one, False if newSk is taken """
+  try:
+    table.put_item(Item={**item, "sk": newSk, MOVED_FROM: item["sk"]}, ConditionExpression=Attr("sk").not_exists())
+  except botocore.exceptions.ClientError as error:
+    if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+      raise
+    return False
+  table.update_item(Key={"user": item["user"], "sk": newSk}, UpdateExpression="remove #moved",
+                    ExpressionAttributeNames={"#moved": MOVED_FROM})
+  table.update_item(Key={"user": item["user"], "sk": item["sk"]}, UpdateExpression="set #moved = :sk",
+                    ExpressionAttributeNames={"#moved": MOVED_TO}, ExpressionAttributeValues={":sk": newSk})
+  table.delete_item(Key={"user": item["user"], "sk": item["sk"]})
+  return True
+
+
+def softDelete(table, item: dict):
+  table.put_item(Item={**{key: value for key, value in item.items() if key not in INDEX_KEY_ATTRIBUTES},
+                       "sk": f"deleted#{item['sk']}"})
+  table.delete_item(Key={"user": item["user"], "sk": item["sk"]})
+
+
+def repointRelated(table, user: str, moved: dict) -> int:
+  params = {
+    "KeyConditionExpression": Key("user").eq(user) & Key("sk").begins_with(RELATED_ACTIVITY_PREFIX),
+  }
+  updated = 0
+  response = table.query(**params)
+  while True:
+    for item in response["Items"]:
+      related = moved.get(item.get("related"), item.get("related"))
+      activity = moved.get(item.get("activity"), item.get("activity"))
+      sk = relatedActivitySk(activity, related, "opposite" if item.get("opposite") else "duplicate")
+      if sk == item["sk"]:
+        continue
+      # a link that is already stored under sk is overwritten with the same values
+      table.put_item(Item={**item, "sk": sk, "related": related, "activity": activity})
+      table.delete_item(Key={"user": user, "sk": item["sk"]})
+      updated += 1
+    if not response.get("LastEvaluatedKey"):
+      break
+    response = table.query(**params, ExclusiveStartKey=response["LastEvaluatedKey"])
+  return updated
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--table", required=True)
+  parser.add_argument("--dry-run", action="store_true")
+  parser.add_argument("--drop-duplicates", action="store_true")
+  args = parser.parse_args()
+
+  table = boto3.resource("dynamodb").Table(args.table)
+  migrated = duplicates = related = 0
+  for user, items in scanUuidActivities(table).items():
+    # the same numbering ingestion gives the rows of each file
+    counters = defaultdict(OccurrenceCounter)
+    moved = {}
+    for item in sorted(items, key=lambda item: item["sk"]):
+      newSk = counters[item.get("chksum", "")].sk(
+        item.get("account", ""), item["date"], item["amount"], item.get("description", ""))
+      if args.dry_run:
+        migrated += 1
+        continue
+      if moveItem(table, item, newSk):
+        moved[item["sk"]] = newSk
+        migrated += 1
+        continue
+      duplicates += 1
+      if args.drop_duplicates:
+        softDelete(table, item)
+    if not args.dry_run:
+      related += repointRelated(table, user, moved)
+  print(f"{'would migrate' if args.dry_run else 'migrated'} {migrated} activities, "
+        f"{duplicates} duplicates {'soft deleted' if args.drop_duplicates else 'left in place'}, "
+        f"{related} related activities updated")
+
+
+if __name__ == "__main__":
+  __main__()
@@ -0,0 +1,50 @@
+import argparse
+import os
+import sys
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambdas", "ActivitiesTableLayer"))
+
+from monthlyInsights import INSIGHTS_PREFIX, convertInsights  # noqa: E402
+
+# one time migration: insights#{month} items used to keep their category
+# totals as a JSON string, the stream now ADDs to a `categories` map. this
+# rewrites every string left into the map. an item the stream changed in the
+# meantime is skipped (the stream converts the ones it touches itself).
+#
+# usage: python scripts/migrate_insights_map.py --table <activities table name> [--dry-run]
+
+
+def scanStringInsights(table):
+  params = {
+    "FilterExpression": Attr("sk").begins_with(INSIGHTS_PREFIX) & Attr("categories").attribute_type("S"),
+  }
+  response = table.scan(**params)
+  while True:
+    yield from response["Items"]
+    if not response.get("LastEvaluatedKey"):
+      break
+    response = table.scan(**params, ExclusiveStartKey=response["LastEvaluatedKey"])
+
+
+def __main__():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--table", required=True)
+  parser.add_argument("--dry-run", action="store_true")
+  args = parser.parse_args()
+
+  table = boto3.resource("dynamodb").Table(args.table)
+  migrated = skipped = 0
+  for item in scanStringInsights(table):
+    if args.dry_run or convertInsights(table, item["user"], item["sk"], item["categories"]):
+      migrated += 1
+    else:
+      skipped += 1
+  print(f"{'would migrate' if args.dry_run else 'migrated'} {migrated} insights items, "
+        f"{skipped} changed meanwhile and skipped")
+
+
+if __name__ == "__main__":
+  __main__()
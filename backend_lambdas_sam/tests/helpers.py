@@ -12,6 +12,54 @@ def _query_string_to_dict(query_string):
 
 
 class TestHelpers:
+    @staticmethod
+    def create_activities_table(dynamodb, table_name="activities"):
+        """ creates the activities table with the same keys and indexes as template.yaml """
+        return dynamodb.create_table(
+            TableName=table_name,
+            KeySchema=[
+                {"AttributeName": "user", "KeyType": "HASH"},
+                {"AttributeName": "sk", "KeyType": "RANGE"}
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "user", "AttributeType": "S"},
+                {"AttributeName": "sk", "AttributeType": "S"},
+                {"AttributeName": "review_key", "AttributeType": "S"},
+                {"AttributeName": "account_key", "AttributeType": "S"},
+                {"AttributeName": "amount_key", "AttributeType": "S"},
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    "IndexName": "ReviewIndex",
+                    "KeySchema": [
+                        {"AttributeName": "review_key", "KeyType": "HASH"},
+                        {"AttributeName": "sk", "KeyType": "RANGE"}
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                    "ProvisionedThroughput": {"ReadCapacityUnits": 5, "WriteCapacityUnits": 5},
+                },
+                {
+                    "IndexName": "AccountIndex",
+                    "KeySchema": [
+                        {"AttributeName": "account_key", "KeyType": "HASH"},
+                        {"AttributeName": "sk", "KeyType": "RANGE"}
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                    "ProvisionedThroughput": {"ReadCapacityUnits": 5, "WriteCapacityUnits": 5},
+                },
+                {
+                    "IndexName": "AmountIndex",
+                    "KeySchema": [
+                        {"AttributeName": "user", "KeyType": "HASH"},
+                        {"AttributeName": "amount_key", "KeyType": "RANGE"}
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                    "ProvisionedThroughput": {"ReadCapacityUnits": 5, "WriteCapacityUnits": 5},
+                },
+            ],
+            ProvisionedThroughput={"ReadCapacityUnits": 5, "WriteCapacityUnits": 5},
+        )
+
     @staticmethod
     def get_base_event(user_id, method, path, queryString, body=None):
         return {
@@ -44,3 +92,21 @@ class TestHelpers:
                 "authorization": user_id
             },
         }
+
+
+class QueryCountingTable:
+    """ wraps a dynamodb table resource and counts the items every query reads """
+
+    def __init__(self, table):
+        self._table = table
+        self.query_count = 0
+        self.scanned_count = 0
+
+    def query(self, **kwargs):
+        response = self._table.query(**kwargs)
+        self.query_count += 1
+        self.scanned_count += response.get("ScannedCount", 0)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._table, name)
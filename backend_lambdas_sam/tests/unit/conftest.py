@@ -1,9 +1,38 @@
 import os
+import threading
 import pytest
 from moto import mock_aws
 import boto3
+from mappingCache import mapping_cache
+from tests.helpers import TestHelpers
 # All shared fixtures for unit tests
 
+@pytest.fixture(autouse=True)
+def clear_mapping_cache():
+    """Every test gets a new table, so mappings cached by an earlier test must not leak."""
+    mapping_cache.clear()
+    yield
+
+_moto_dynamodb_lock = threading.Lock()
+
+
+@pytest.fixture(autouse=True)
+def serialize_moto_dynamodb(monkeypatch):
+    """
+    moto isn't thread safe: TransactWriteItems deep copies every table while
+    the code under test writes from other threads. DynamoDB serves those
+    calls concurrently, in tests they run one at a time.
+    """
+    from moto.dynamodb.responses import DynamoHandler
+    call_action = DynamoHandler.call_action
+
+    def locked_call_action(self, *args, **kwargs):
+        with _moto_dynamodb_lock:
+            return call_action(self, *args, **kwargs)
+
+    monkeypatch.setattr(DynamoHandler, "call_action", locked_call_action)
+    yield
+
 @pytest.fixture(scope="function")
 def aws_credentials():
     """Mocked AWS Credentials for moto."""
@@ -18,18 +47,7 @@ def activities_table(aws_credentials):
     """ Creates a dynamodb table for testing purposes"""
     with mock_aws():
         dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
-        table = dynamodb.create_table(
-            TableName="activities",
-            KeySchema=[
-                {"AttributeName": "user", "KeyType": "HASH"},
-                {"AttributeName": "sk", "KeyType": "RANGE"}
-            ],
-            AttributeDefinitions=[
-                {"AttributeName": "user", "AttributeType": "S"},
-                {"AttributeName": "sk", "AttributeType": "S"},
-            ],
-            ProvisionedThroughput={"ReadCapacityUnits": 5, "WriteCapacityUnits": 5},
-        )
+        table = TestHelpers.create_activities_table(dynamodb)
         table.meta.client.get_waiter("table_exists").wait(TableName="activities")
         yield table
 
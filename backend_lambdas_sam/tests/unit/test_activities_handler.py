@@ -1,9 +1,15 @@
 import pytest
 import json
+import botocore
+from decimal import Decimal
 from lambdas.activities import app
 from datetime import datetime, timedelta
 from boto3.dynamodb.conditions import Key
-from tests.helpers import TestHelpers
+from tests.helpers import TestHelpers, QueryCountingTable
+from activityMappings import recategorizeActivities
+from mappingMatcher import MappingMatcher
+from activityIndexes import amountKey, activityIndexKeys, reviewKey
+from descriptionIndex import indexActivity
 
 @pytest.fixture()
 def user_id():
@@ -143,8 +149,13 @@ def mock_activities(user_id):
             "date": (base_date - timedelta(days=i)).strftime("%Y-%m-%d"),
             "description": f"test activity {i}",
             "category": "test_odd" if i % 2 != 0 else "test_even",
+            "base_category": "test_odd" if i % 2 != 0 else "test_even",
+            "dirty": False,
+            "predicted": [],
+            "review_key": reviewKey(user_id, False),
             "amount": 10 + i,
             "account": "acct_1_visa" if i % 2 != 0 else "acct_2_visa",
+            "account_key": f"{user_id}#acct_1_visa" if i % 2 != 0 else f"{user_id}#acct_2_visa",
             "search_term": f"test activity {i}"
         }
         for i in range(10)
@@ -159,6 +170,7 @@ def mock_activities_with_different_amount(user_id):
         "description": "test activity",
         "category": "test_cat",
         "amount": value,
+        "amount_key": amountKey(value),
         "search_term": "test activity"
     } for value in amounts]
 
@@ -195,6 +207,51 @@ def mock_activities_with_descriptions(user_id):
     }]
 
 
+@pytest.mark.parametrize("body", [
+    "a,b\nc,d\n",
+    "a,b\r\nc,d\r\n",
+    "a,b\nc,d",
+    "a,b\n\nc,d\n",
+    "",
+])
+def test_iter_lines_matches_splitlines(body):
+    from postActivities import iterLines
+    assert list(iterLines(body)) == body.splitlines()
+
+
+def test_post_activities_streams_rows_into_writes(activities_table, s3, user_id, monkeypatch):
+    import postActivities
+    parsed = []
+    written_before_parsed = []
+
+    class RecordingWriter(postActivities.ConcurrentBatchWriter):
+        def put_item(self, Item):
+            written_before_parsed.append(len(parsed))
+            return super().put_item(Item=Item)
+
+    monkeypatch.setattr(postActivities, "ConcurrentBatchWriter", RecordingWriter)
+
+    original = postActivities.iterItemsFromBody
+
+    def recording_items(body, file_format):
+        for item in original(body, file_format):
+            parsed.append(item.sk)
+            yield item
+
+    monkeypatch.setattr(postActivities, "iterItemsFromBody", recording_items)
+    rows = "\n".join(f"2023-02-{1 + i % 28:02d},2023-02-27,0733,SHOP {i},Dining,{i}.50," for i in range(100))
+    body = "Transaction Date,Posted Date,Card No.,Description,Category,Debit,Credit\n" + rows
+    ret = postActivities.postActivities(user_id, "cap1", body, activities_table, s3, False)
+
+    assert ret["statusCode"] == 200
+    # every row is handed to the writer as soon as it is parsed
+    assert written_before_parsed == list(range(1, 101))
+    chksum = activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").begins_with("chksum#"))["Items"][0]
+    assert chksum["start_date"] == "2023-02-01"
+    assert chksum["end_date"] == "2023-02-28"
+
+
 def test_post_activities_cap1_preview(activities_table, s3, user_id, apigw_event_post_cap1_preview):
     app.s3 = s3
     app.activities_table = activities_table
@@ -239,6 +296,94 @@ def test_post_activities_cap1_preview(activities_table, s3, user_id, apigw_event
     assert len(chksum_response["Items"]) == 0
 
 
+def test_post_activities_preview_duplicates(activities_table, s3, user_id, cap1_file_raw):
+    activities_table.put_item(Item={
+        "user": user_id,
+        "sk": "2023-02-25#existing",
+        "date": "2023-02-25",
+        "account": "0733",
+        "description": "RAMEN DANBO ROBSON",
+        "category": "Dining",
+        "amount": Decimal("20.47"),
+    })
+    activities_table.put_item(Item={
+        "user": user_id,
+        "sk": "2023-02-22#posted_late",
+        "date": "2023-02-22",
+        "account": "0733",
+        "description": "Safeway 4931",
+        "category": "Merchandise",
+        "amount": Decimal("26.73"),
+    })
+
+    def preview(query):
+        ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "POST", "/activity", query, cap1_file_raw), "")
+        assert ret["statusCode"] == 200
+        return {item["description"]: item["duplicate_to"] for item in json.loads(ret["body"])["data"]["items"]}
+
+    assert preview("format=cap1&type=preview") == {
+        "RAMEN DANBO ROBSON": ["2023-02-25#existing"],
+        "SAFEWAY #4931": [],
+    }
+    assert preview("format=cap1&type=preview&duplicateDays=3") == {
+        "RAMEN DANBO ROBSON": ["2023-02-25#existing"],
+        "SAFEWAY #4931": ["2023-02-22#posted_late"],
+    }
+    # clamped to MAX_DUPLICATE_DAYS
+    assert preview("format=cap1&type=preview&duplicateDays=100000000") == {
+        "RAMEN DANBO ROBSON": ["2023-02-25#existing"],
+        "SAFEWAY #4931": ["2023-02-22#posted_late"],
+    }
+    for days in ["abc", "-1", "1.5"]:
+        ret = app.lambda_handler(TestHelpers.get_base_event(
+            user_id, "POST", "/activity", f"format=cap1&type=preview&duplicateDays={days}", cap1_file_raw), "")
+        assert ret["statusCode"] == 400
+
+
+def test_month_shards():
+    from postActivities import monthShards
+    assert monthShards("2023-11-15", "2024-01-03") == [
+        ("2024-01-01", "2024-01-03~"),
+        ("2023-12-01", "2023-12-31~"),
+        ("2023-11-15", "2023-11-31~"),
+    ]
+    assert monthShards("2023-11-15", "2023-11-15") == [("2023-11-15", "2023-11-15~")]
+
+
+def test_get_existing_items_reads_every_page_of_every_month(activities_table, user_id):
+    from postActivities import getExistingItems
+    with activities_table.batch_writer() as batch:
+        for month in range(1, 13):
+            for i in range(20):
+                batch.put_item(Item={
+                    "user": user_id,
+                    "sk": f"2023-{month:02d}-{1 + i % 28:02d}#{i}",
+                    "date": f"2023-{month:02d}-{1 + i % 28:02d}",
+                    "account": "visa",
+                    "description": f"activity {i}",
+                    "category": "test",
+                    "amount": Decimal(i),
+                })
+        # more than one 1 MB page in a single month
+        for i in range(300):
+            batch.put_item(Item={
+                "user": user_id,
+                "sk": f"2023-06-15#big{i}",
+                "date": "2023-06-15",
+                "account": "visa",
+                "description": "x" * 4000,
+                "category": "test",
+                "amount": Decimal(1),
+            })
+
+    items = getExistingItems(activities_table, user_id, "2023-01-01", "2023-12-31")
+    assert len(items) == 12 * 20 + 300
+    assert len({item.sk for item in items}) == len(items)
+    # newest first, like the single query it replaces
+    assert [item.date for item in items] == sorted([item.date for item in items], reverse=True)
+    assert all(item.account == "visa" for item in items)
+
+
 def test_post_activities_td_preview(activities_table, s3, user_id, apigw_event_post_td_preview):
     app.s3 = s3
     app.activities_table = activities_table
@@ -301,6 +446,69 @@ def test_post_activities_cap1(activities_table, s3, user_id, apigw_event_post_ca
     assert item["start_date"] == "2023-02-24"
     assert item["end_date"] == "2023-02-25"
 
+def test_post_activities_repeat_upload_short_circuits(activities_table, s3, user_id, apigw_event_post_cap1, cap1_file_raw, monkeypatch):
+    import hashlib
+    import postActivities
+    app.s3 = s3
+    app.activities_table = activities_table
+    ret = app.lambda_handler(apigw_event_post_cap1, "")
+    assert ret["statusCode"] == 200
+
+    chksum = hashlib.md5(cap1_file_raw.encode('utf-8')).hexdigest()
+    assert postActivities.fileChecksum(cap1_file_raw) == chksum
+    chksum_item = activities_table.get_item(Key={"user": user_id, "sk": f"chksum#{chksum}"})["Item"]
+    assert chksum_item["checksum"] == chksum
+    assert chksum_item["file"] == f"{user_id}/cap1/{chksum}.csv.gz"
+
+    # the same file again is rejected before it is parsed or stored
+    def fail(*args):
+        raise AssertionError("repeat upload must not be parsed or uploaded")
+    monkeypatch.setattr(postActivities, "iterItemsFromBody", fail)
+    monkeypatch.setattr(postActivities, "storeUpload", fail)
+    ret = app.lambda_handler(apigw_event_post_cap1, "")
+    assert ret["statusCode"] == 200
+    assert json.loads(ret["body"]) == "skipping duplicate file"
+    assert len(list(s3.Bucket('test-bucket').objects.filter(Prefix=f"{user_id}/cap1/"))) == 1
+
+
+def test_post_activities_overlapping_statements_are_idempotent(activities_table, s3, user_id):
+    import postActivities
+    from contentKeys import contentSk
+    header = "Transaction Date,Posted Date,Card No.,Description,Category,Debit,Credit\n"
+    january = header + "2023-01-20,2023-01-21,0733,COFFEE,Dining,4.50,\n2023-01-20,2023-01-21,0733,COFFEE,Dining,4.50,\n2023-01-05,2023-01-06,0733,RENT,Housing,1000,\n"
+    # overlaps january on the 20th, with both coffees
+    overlap = header + "2023-02-02,2023-02-03,0733,GROCERY,Merchandise,50,\n2023-01-20,2023-01-21,0733,COFFEE,Dining,4.5,\n2023-01-20,2023-01-21,0733,COFFEE,Dining,4.50,\n"
+    assert postActivities.postActivities(user_id, "cap1", january, activities_table, s3, False)["statusCode"] == 200
+    activities_table.update_item(
+        Key={"user": user_id, "sk": contentSk("0733", "2023-01-20", "4.50", "COFFEE")},
+        UpdateExpression="set category = :c",
+        ExpressionAttributeValues={":c": "Coffee"})
+    assert postActivities.postActivities(user_id, "cap1", overlap, activities_table, s3, False)["statusCode"] == 200
+
+    items = activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").between("0000-00-00", "9999-99-99"))["Items"]
+    assert sorted(item["description"] for item in items) == ["COFFEE", "COFFEE", "GROCERY", "RENT"]
+    # rows that were already stored are not overwritten
+    edited = activities_table.get_item(Key={"user": user_id, "sk": contentSk("0733", "2023-01-20", "4.50", "COFFEE")})["Item"]
+    assert edited["category"] == "Coffee"
+
+
+def test_post_activities_retry_after_partial_failure(activities_table, s3, user_id, cap1_file_raw, monkeypatch):
+    import postActivities
+
+    def fail(*args):
+        raise botocore.exceptions.ClientError({"Error": {"Code": "InternalServerError"}}, "PutItem")
+    # rows were written, but the upload failed before the checksum item
+    monkeypatch.setattr(postActivities, "putChecksum", fail)
+    assert postActivities.postActivities(user_id, "cap1", cap1_file_raw, activities_table, s3, False)["statusCode"] == 500
+    monkeypatch.undo()
+    assert postActivities.postActivities(user_id, "cap1", cap1_file_raw, activities_table, s3, False)["statusCode"] == 200
+
+    items = activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").between("0000-00-00", "9999-99-99"))["Items"]
+    assert len(items) == 2
+
+
 def test_post_activities_rbc(activities_table, s3, user_id, apigw_event_post_rbc):
     app.s3 = s3
     app.activities_table = activities_table
@@ -413,6 +621,8 @@ def test_get_activities_dirty_flag(activities_table, apigw_event_get_dirty_activ
         "description": "test activity 1",
         "category": "test_odd_mapped",
     })
+    # what the stream does after a mapping is written
+    recategorizeActivities(activities_table, "test-user-id", ["test activity 1"])
 
     ret = app.lambda_handler(apigw_event_get_dirty_activities, "")
 
@@ -436,6 +646,7 @@ def test_get_activities_dirty_flag_false(activities_table, apigw_event_get_non_d
         "description": "test activity 1",
         "category": "test_odd_mapped",
     })
+    recategorizeActivities(activities_table, "test-user-id", ["test activity 1"])
 
     ret = app.lambda_handler(apigw_event_get_non_dirty_activities, "")
 
@@ -448,6 +659,52 @@ def test_get_activities_dirty_flag_false(activities_table, apigw_event_get_non_d
     assert not any([item for item in data["data"] if item["description"] == "test activity 1"])
     assert not any([item for item in data["data"] if item["dirty"] == True])
 
+def test_get_activities_dirty_flag_honors_size(activities_table, user_id, mock_activities):
+    for item in mock_activities:
+        activities_table.put_item(Item=item)
+    activities_table.put_item(Item={
+        "user": user_id,
+        "sk": "mapping#test activity",
+        "description": "test activity",
+        "category": "test_mapped",
+    })
+    recategorizeActivities(activities_table, user_id, ["test activity"])
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "GET", "/activity", "isDirty=true&size=3"), "")
+    data = json.loads(ret["body"])
+    assert data["count"] == 3
+    assert [item["sk"] for item in data["data"]] == ["2020-01-010", "2019-12-311", "2019-12-302"]
+    assert data["LastEvaluatedKey"]["sk"] == "2019-12-302"
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(
+        user_id, "GET", "/activity", f"isDirty=true&size=3&nextDate={data['LastEvaluatedKey']['sk']}"), "")
+    data = json.loads(ret["body"])
+    assert [item["sk"] for item in data["data"]] == ["2019-12-293", "2019-12-284", "2019-12-275"]
+
+
+def test_post_activities_stores_mapping_results(activities_table, s3, user_id, apigw_event_post_cap1):
+    app.s3 = s3
+    app.activities_table = activities_table
+    activities_table.put_item(Item={
+        "user": user_id,
+        "sk": "mapping#RAMEN DANBO",
+        "description": "RAMEN DANBO",
+        "category": "Ramen",
+    })
+    ret = app.lambda_handler(apigw_event_post_cap1, "")
+    assert ret["statusCode"] == 200
+
+    items = activities_table.query(
+        IndexName="ReviewIndex",
+        KeyConditionExpression=Key("review_key").eq(f"{user_id}#dirty")
+    )["Items"]
+    assert len(items) == 1
+    assert items[0]["description"] == "RAMEN DANBO ROBSON"
+    assert items[0]["category"] == "Ramen"
+    assert items[0]["base_category"] == "Dining"
+    assert items[0]["predicted"] == ["Ramen"]
+
+
 def test_delete_activities(
         activities_table,
         user_id,
@@ -471,6 +728,21 @@ def test_delete_activities(
     assert deleted["Count"] == 1
     assert deleted["Items"][0]["sk"] == "deleted#2019-12-266"
 
+
+def test_deleted_activity_leaves_amount_index(activities_table, user_id, mock_activities):
+    for item in mock_activities:
+        activities_table.put_item(Item={**item, **activityIndexKeys(user_id, item)})
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "DELETE", "/activity", "sk=2019-12-239"), "")
+    assert ret["statusCode"] == 200
+    deleted = activities_table.get_item(Key={"user": user_id, "sk": "deleted#2019-12-239"})["Item"]
+    assert not set(deleted) & {"review_key", "account_key", "amount_key"}
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "GET", "/activity", "orderByAmount=true&size=3"), "")
+    data = json.loads(ret["body"])
+    # the largest amount was deleted
+    assert [item["sk"] for item in data["data"]] == ["2019-12-248", "2019-12-257", "2019-12-266"]
+
 def test_get_activities_by_category(
         activities_table,
         apigw_event_get_by_category_size_5,
@@ -608,6 +880,37 @@ def test_get_activities_by_account(activities_table, apigw_event_get_by_account,
     assert all([item["account"] == "acct_1_visa" for item in data["data"]])
 
 
+def test_get_activities_by_account_reads_one_page(activities_table, user_id):
+    # long history on another account, the account index should never touch it
+    for i in range(200):
+        account = "acct_1_visa" if i < 20 else "acct_2_visa"
+        activities_table.put_item(Item={
+            "user": user_id,
+            "sk": f"2020-01-01#{i:03d}",
+            "date": "2020-01-01",
+            "description": f"test activity {i}",
+            "category": "test",
+            "amount": 10,
+            "account": account,
+            "account_key": f"{user_id}#{account}",
+        })
+    counting_table = QueryCountingTable(activities_table)
+    app.activities_table = counting_table
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "GET", "/activity", "account=acct_1_visa&size=5"), "")
+    data = json.loads(ret["body"])
+    assert data["count"] == 5
+    assert [item["sk"] for item in data["data"]] == [f"2020-01-01#{i:03d}" for i in range(19, 14, -1)]
+    assert counting_table.scanned_count == 5
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(
+        user_id, "GET", "/activity", f"account=acct_1_visa&size=5&nextDate={data['LastEvaluatedKey']['sk']}"), "")
+    data = json.loads(ret["body"])
+    assert [item["sk"] for item in data["data"]] == [f"2020-01-01#{i:03d}" for i in range(14, 9, -1)]
+    assert counting_table.scanned_count == 10
+    app.activities_table = activities_table
+
+
 def test_get_activities_by_amount_upper_lower(activities_table, apigw_get_activities_base, mock_activities_with_different_amount):
 
     for items in mock_activities_with_different_amount:
@@ -647,9 +950,157 @@ def test_get_activities_by_amount_upper_lower(activities_table, apigw_get_activi
     assert all([int(item["amount"]) >= 20 and int(item["amount"]) <= 40 for item in data["data"]])
 
 
+def test_amount_key_sorts_like_amount():
+    amounts = ["-4000", "-10.5", "-0.01", "0", "0.01", "1.10", "10", "33.9", "54.03", "1000000"]
+    assert sorted(amounts, key=amountKey) == amounts
+    assert sorted(amountKey(amount) for amount in amounts) == [amountKey(amount) for amount in amounts]
+
+
+def test_get_activities_order_by_amount(activities_table, user_id):
+    for i in range(50):
+        activities_table.put_item(Item={
+            "user": user_id,
+            "sk": f"2020-01-{1 + i % 28:02d}#{i:03d}",
+            "date": f"2020-01-{1 + i % 28:02d}",
+            "description": f"test activity {i}",
+            "category": "test",
+            # amounts are not in sk order
+            "amount": (i * 37) % 50 - 25,
+            "amount_key": amountKey((i * 37) % 50 - 25),
+        })
+    counting_table = QueryCountingTable(activities_table)
+    app.activities_table = counting_table
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "GET", "/activity", "orderByAmount=true&size=5"), "")
+    data = json.loads(ret["body"])
+    assert [int(item["amount"]) for item in data["data"]] == [24, 23, 22, 21, 20]
+    assert counting_table.scanned_count == 5
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(
+        user_id, "GET", "/activity", f"orderByAmount=true&size=5&nextDate={data['LastEvaluatedKey']['sk']}"), "")
+    data = json.loads(ret["body"])
+    assert [int(item["amount"]) for item in data["data"]] == [19, 18, 17, 16, 15]
+    assert counting_table.scanned_count == 10
+    app.activities_table = activities_table
+
+
+def test_get_activities_by_amount_range_reads_one_page(activities_table, user_id):
+    for i in range(200):
+        activities_table.put_item(Item={
+            "user": user_id,
+            "sk": f"2020-01-01#{i:03d}",
+            "date": "2020-01-01",
+            "description": f"test activity {i}",
+            "category": "test",
+            "amount": i,
+            "amount_key": amountKey(i),
+        })
+    counting_table = QueryCountingTable(activities_table)
+    app.activities_table = counting_table
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(
+        user_id, "GET", "/activity", "amountMin=100&amountMax=150&orderByAmount=true&size=5"), "")
+    data = json.loads(ret["body"])
+    assert [int(item["amount"]) for item in data["data"]] == [150, 149, 148, 147, 146]
+    assert counting_table.scanned_count == 5
+    app.activities_table = activities_table
+
+
+def test_get_activities_by_amount_range_keeps_date_order(activities_table, user_id):
+    for i in range(20):
+        activities_table.put_item(Item={
+            "user": user_id,
+            "sk": f"2020-01-{1 + i:02d}#{i:03d}",
+            "date": f"2020-01-{1 + i:02d}",
+            "description": f"test activity {i}",
+            "category": "test",
+            # amounts are not in sk order
+            "amount": (i * 7) % 20,
+            "amount_key": amountKey((i * 7) % 20),
+        })
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "GET", "/activity", "amountMin=5&amountMax=14"), "")
+    data = json.loads(ret["body"])
+    sks = [item["sk"] for item in data["data"]]
+    assert sks == sorted(sks, reverse=True)
+    assert sorted(int(item["amount"]) for item in data["data"]) == list(range(5, 15))
+
+
+@pytest.fixture()
+def mock_activities_over_years(user_id):
+    # 5 activities a day for a year
+    base_date = datetime(2021, 1, 1)
+    items = []
+    for day in range(365):
+        date = (base_date + timedelta(days=day)).strftime("%Y-%m-%d")
+        for i in range(5):
+            description = "SAFEWAY #2345" if i == 0 else f"test activity {i}"
+            item = {
+                "user": user_id,
+                "sk": f"{date}#{i}",
+                "date": date,
+                "description": description,
+                "search_term": description.lower(),
+                "category": "test",
+                "amount": 10 + i,
+                "account": "acct_1_visa" if i % 2 == 0 else "acct_2_visa",
+                "dirty": False,
+            }
+            items.append({**item, **activityIndexKeys(user_id, item)})
+    return items
+
+
+@pytest.mark.parametrize("query", [
+    "",
+    "description=safeway 2345",
+    "account=acct_1_visa",
+    "isDirty=false",
+    "amountMin=12&amountMax=13",
+    "orderByAmount=true",
+])
+def test_get_activities_date_range_reads_only_the_range(activities_table, user_id, mock_activities_over_years, query):
+    with activities_table.batch_writer() as batch:
+        for item in mock_activities_over_years:
+            batch.put_item(Item=item)
+            indexActivity(batch, user_id, item["sk"], newDescription=item["description"])
+    counting_table = QueryCountingTable(activities_table)
+    app.activities_table = counting_table
+
+    def get(query_string):
+        counting_table.scanned_count = 0
+        ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "GET", "/activity", query_string), "")
+        assert ret["statusCode"] == 200
+        # 155 activities in the range, nothing from the other 11 months is read
+        assert counting_table.scanned_count <= 155
+        return json.loads(ret["body"])
+
+    data = get(f"{query}&startDate=2021-03-01&endDate=2021-03-31&size=20")
+    seen = data["data"]
+    # later pages only send the cursor, it carries the range
+    while data["LastEvaluatedKey"]:
+        data = get(f"{query}&size=20&cursor={data['LastEvaluatedKey']['cursor']}")
+        seen.extend(data["data"])
+
+    assert len(seen) > 0
+    assert all("2021-03-01" <= item["date"] <= "2021-03-31" for item in seen)
+    # the whole end date is included
+    assert "2021-03-31" in {item["date"] for item in seen}
+    assert len({item["sk"] for item in seen}) == len(seen)
+    if "orderByAmount" in query:
+        amounts = [Decimal(item["amount"]) for item in seen]
+        assert amounts == sorted(amounts, reverse=True)
+    app.activities_table = activities_table
+
+
+def test_get_activities_invalid_cursor(activities_table, user_id):
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "GET", "/activity", "cursor=notacursor"), "")
+    assert ret["statusCode"] == 400
+
+
 def test_get_activities_by_description(activities_table, apigw_get_activities_base, mock_activities_with_descriptions):
     for items in mock_activities_with_descriptions:
         activities_table.put_item(Item=items)
+        indexActivity(activities_table, items["user"], items["sk"], newDescription=items["description"])
 
     # first should match everything that starts with key
     resposne_match_start = app.lambda_handler({
@@ -692,6 +1143,42 @@ def test_get_activities_by_description(activities_table, apigw_get_activities_ba
     assert data["count"] == 1
     assert data["data"][0]["sk"] == "2020-01-01#1"
 
+def test_get_activities_by_description_prefix_reads_one_page(activities_table, user_id):
+    for i in range(100):
+        item = {
+            "user": user_id,
+            "sk": f"2020-01-01#{i:03d}",
+            "date": "2020-01-01",
+            "description": f"SAFEWAY #{i:03d}" if i % 10 == 0 else f"PETRO CANADA {i}",
+            "category": "test",
+            "amount": i,
+            "account": "acct_1_visa" if i % 20 == 0 else "acct_2_visa",
+        }
+        activities_table.put_item(Item=item)
+        indexActivity(activities_table, user_id, item["sk"], newDescription=item["description"])
+    counting_table = QueryCountingTable(activities_table)
+    app.activities_table = counting_table
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "GET", "/activity", "description=safe&size=3"), "")
+    data = json.loads(ret["body"])
+    assert [item["sk"] for item in data["data"]] == ["2020-01-01#090", "2020-01-01#080", "2020-01-01#070"]
+    # only the posting list of the prefix is read, not the partition
+    assert counting_table.scanned_count == 10
+
+    ret = app.lambda_handler(TestHelpers.get_base_event(
+        user_id, "GET", "/activity", f"description=safe&size=3&nextDate={data['LastEvaluatedKey']['sk']}"), "")
+    data = json.loads(ret["body"])
+    assert [item["sk"] for item in data["data"]] == ["2020-01-01#060", "2020-01-01#050", "2020-01-01#040"]
+
+    # remaining conditions are applied to the matches
+    ret = app.lambda_handler(TestHelpers.get_base_event(
+        user_id, "GET", "/activity", "description=safeway&account=acct_1_visa&amountMin=30"), "")
+    data = json.loads(ret["body"])
+    assert [item["sk"] for item in data["data"]] == ["2020-01-01#080", "2020-01-01#060", "2020-01-01#040"]
+    assert data["LastEvaluatedKey"] == {}
+    app.activities_table = activities_table
+
+
 def test_get_activities_with_mappings(activities_table, apigw_get_activities_base, mock_activities_with_descriptions):
     for items in mock_activities_with_descriptions:
         activities_table.put_item(Item=items)
@@ -748,3 +1235,70 @@ def test_patch_activity(user_id, activities_table, apigw_event_patch_activity, m
         ProjectionExpression="category"
     )
     assert getItemResponse["Item"]["category"] == "NewCategory"
+
+
+def test_patch_activity_keeps_mapping_state_and_index_keys(user_id, activities_table):
+    item = {
+        "user": user_id,
+        "sk": "2020-01-01#1",
+        "date": "2020-01-01",
+        "description": "RAMEN DANBO",
+        "search_term": "ramen danbo",
+        "account": "visa",
+        "amount": Decimal("20.47"),
+        "category": "Ramen",
+        "base_category": "Dining",
+        "dirty": True,
+        "predicted": ["Ramen"],
+    }
+    activities_table.put_item(Item={**item, **activityIndexKeys(user_id, item)})
+
+    body = json.dumps({"category": "Lunch", "account": "amex", "amount": "-12.50", "description": "DANBO"})
+    response = app.lambda_handler(TestHelpers.get_base_event(user_id, "PATCH", "/activity", "sk=2020-01-01#1", body=body), "")
+    assert response["statusCode"] == 200
+
+    stored = activities_table.get_item(Key={"user": user_id, "sk": "2020-01-01#1"})["Item"]
+    assert (stored["category"], stored["account"], stored["amount"], stored["search_term"]) == ("Lunch", "amex", Decimal("-12.5"), "danbo")
+    assert (stored["base_category"], stored["dirty"], stored["predicted"]) == ("Lunch", True, ["Ramen"])
+
+    def index_sks(index, key, value):
+        return [found["sk"] for found in activities_table.query(
+            IndexName=index, KeyConditionExpression=Key(key).eq(value))["Items"]]
+
+    assert index_sks("ReviewIndex", "review_key", f"{user_id}#dirty") == ["2020-01-01#1"]
+    assert index_sks("AccountIndex", "account_key", f"{user_id}#amex") == ["2020-01-01#1"]
+    assert index_sks("AccountIndex", "account_key", f"{user_id}#visa") == []
+    assert [found["sk"] for found in activities_table.query(
+        IndexName="AmountIndex",
+        KeyConditionExpression=Key("user").eq(user_id) & Key("amount_key").eq(amountKey("-12.50")))["Items"]] == ["2020-01-01#1"]
+
+
+def test_patched_category_survives_recategorizing(user_id, activities_table):
+    item = {
+        "user": user_id,
+        "sk": "2020-01-01#1",
+        "date": "2020-01-01",
+        "description": "SAFEWAY GAS",
+        "account": "visa",
+        "amount": Decimal(40),
+        "category": "Shops",
+        "base_category": "Shops",
+        "dirty": False,
+        "predicted": [],
+    }
+    activities_table.put_item(Item={**item, **activityIndexKeys(user_id, item)})
+    body = json.dumps({"category": "Fuel"})
+    response = app.lambda_handler(TestHelpers.get_base_event(user_id, "PATCH", "/activity", "sk=2020-01-01#1", body=body), "")
+    assert response["statusCode"] == 200
+
+    # a "SAFEWAY" mapping was removed, no mapping matches the activity any more
+    assert recategorizeActivities(activities_table, user_id, ["SAFEWAY"], MappingMatcher([])) == (0, None)
+    stored = activities_table.get_item(Key={"user": user_id, "sk": "2020-01-01#1"})["Item"]
+    assert (stored["category"], stored["dirty"]) == ("Fuel", False)
+
+    # a matching mapping still wins, and removing it brings the manual category back
+    matcher = MappingMatcher([{"description": "SAFEWAY", "category": "Groceries"}])
+    recategorizeActivities(activities_table, user_id, ["SAFEWAY"], matcher)
+    assert activities_table.get_item(Key={"user": user_id, "sk": "2020-01-01#1"})["Item"]["category"] == "Groceries"
+    recategorizeActivities(activities_table, user_id, ["SAFEWAY"], MappingMatcher([]))
+    assert activities_table.get_item(Key={"user": user_id, "sk": "2020-01-01#1"})["Item"]["category"] == "Fuel"
@@ -4,6 +4,10 @@ from lambdas.activitiesStreams import app
 from datetime import datetime, timedelta
 import boto3
 from boto3.dynamodb.conditions import Key
+from decimal import Decimal
+import monthlyInsights
+from mappingMatcher import MappingMatcher
+from tests.helpers import QueryCountingTable
 
 
 @pytest.fixture()
@@ -15,7 +19,7 @@ def user_id():
 def apigw_event_new_mapping(user_id):
     return {
         "Records": [{
-            "eventID": "f8a4fc12b206d371ee7a6491b27e4af4",
+            "eventID": "f8a4fc12b206d371ee7a6491b27e4a01",
             "eventName": "INSERT",
             "eventVersion": "1.1",
             "eventSource": "aws:dynamodb",
@@ -58,7 +62,7 @@ def apigw_event_new_mapping(user_id):
 def apigw_event_new_activities(user_id):
     return {
         "Records": [{
-            "eventID": "f8a4fc12b206d371ee7a6491b27e4af4",
+            "eventID": "f8a4fc12b206d371ee7a6491b27e4a02",
             "eventName": "INSERT",
             "eventVersion": "1.1",
             "eventSource": "aws:dynamodb",
@@ -97,7 +101,7 @@ def apigw_event_new_activities(user_id):
             },
             "eventSourceARN": "arn:aws:dynamodb:us-east-1:962861289619:table/backendLambdasSam-ActivitiesTable-37ZDBRHT7AY3/stream/2023-04-05T20:16:32.035"
         }, {
-            "eventID": "f8a4fc12b206d371ee7a6491b27e4af4",
+            "eventID": "f8a4fc12b206d371ee7a6491b27e4a03",
             "eventName": "INSERT",
             "eventVersion": "1.1",
             "eventSource": "aws:dynamodb",
@@ -136,7 +140,7 @@ def apigw_event_new_activities(user_id):
             },
             "eventSourceARN": "arn:aws:dynamodb:us-east-1:962861289619:table/backendLambdasSam-ActivitiesTable-37ZDBRHT7AY3/stream/2023-04-05T20:16:32.035"
         }, {
-            "eventID": "f8a4fc12b206d371ee7a6491b27e4af4",
+            "eventID": "f8a4fc12b206d371ee7a6491b27e4a04",
             "eventName": "INSERT",
             "eventVersion": "1.1",
             "eventSource": "aws:dynamodb",
@@ -182,7 +186,7 @@ def apigw_event_new_activities(user_id):
 def apigw_event_delete_activities(user_id):
     return {
         "Records": [{
-            "eventID": "f8a4fc12b206d371ee7a6491b27e4af4",
+            "eventID": "f8a4fc12b206d371ee7a6491b27e4a05",
             "eventName": "REMOVE",
             "eventVersion": "1.1",
             "eventSource": "aws:dynamodb",
@@ -221,7 +225,7 @@ def apigw_event_delete_activities(user_id):
             },
             "eventSourceARN": "arn:aws:dynamodb:us-east-1:962861289619:table/backendLambdasSam-ActivitiesTable-37ZDBRHT7AY3/stream/2023-04-05T20:16:32.035"
         }, {
-            "eventID": "f8a4fc12b206d371ee7a6491b27e4af4",
+            "eventID": "f8a4fc12b206d371ee7a6491b27e4a06",
             "eventName": "REMOVE",
             "eventVersion": "1.1",
             "eventSource": "aws:dynamodb",
@@ -267,7 +271,7 @@ def apigw_event_delete_activities(user_id):
 def apigw_event_modify_activities(user_id):
     return {
         "Records": [{
-            "eventID": "f8a4fc12b206d371ee7a6491b27e4af4",
+            "eventID": "f8a4fc12b206d371ee7a6491b27e4a07",
             "eventName": "MODIFY",
             "eventVersion": "1.1",
             "eventSource": "aws:dynamodb",
@@ -333,6 +337,7 @@ def apigw_event_modify_activities(user_id):
 def api_gw_event_new_related_activities(user_id):
     return {
         "Records": [{
+            "eventID": "related-1",
             "eventName": "INSERT",
             "dynamodb": {
                 "Keys": {
@@ -366,6 +371,7 @@ def api_gw_event_new_related_activities(user_id):
                 "StreamViewType": "NEW_IMAGE"
             },
         }, {
+            "eventID": "related-2",
             "eventName": "INSERT",
             "dynamodb": {
                 "Keys": {
@@ -479,7 +485,7 @@ def test_new_update_delete_activities(activities_table, apigw_event_new_activiti
 
     app.table = activities_table
     ret = app.lambda_handler(apigw_event_new_activities, "")
-    assert ret["statusCode"] == 200
+    assert ret == {"batchItemFailures": []}
     # check that the activities insights are created or updated
     all_insights = activities_table.query(
         KeyConditionExpression=Key("user").eq(
@@ -497,18 +503,18 @@ def test_new_update_delete_activities(activities_table, apigw_event_new_activiti
     assert all_insights[1] == {
         "user": user_id,
         "sk": f"insights#2022-11",
-        "categories": json.dumps({
+        "categories": {
             "some_existing_category": 15,
             "some_new_category": 10,
-        }),
+        },
         "date": "2022-11",
     }
     assert all_insights[2] == {
         "user": user_id,
         "sk": f"insights#2022-12",
-        "categories": json.dumps({
+        "categories": {
             "some_existing_category": 10
-        }),
+        },
         "date": "2022-12",
     }
 
@@ -519,7 +525,7 @@ def test_delete_activities(activities_table, apigw_event_delete_activities, user
 
     app.table = activities_table
     ret = app.lambda_handler(apigw_event_delete_activities, "")
-    assert ret["statusCode"] == 200
+    assert ret == {"batchItemFailures": []}
     # check that the activities insights are created or updated
     all_insights = activities_table.query(
         KeyConditionExpression=Key("user").eq(
@@ -529,17 +535,17 @@ def test_delete_activities(activities_table, apigw_event_delete_activities, user
     assert all_insights[0] == {
         "user": user_id,
         "sk": f"insights#2022-10",
-        "categories": json.dumps({
+        "categories": {
             "delete_categories": 0
-        }),
+        },
         "date": "2022-10",
     }
     assert all_insights[1] == {
         "user": user_id,
         "sk": f"insights#2022-11",
-        "categories": json.dumps({
+        "categories": {
             "some_existing_category": 1,
-        }),
+        },
         "date": "2022-11",
     }
 
@@ -550,7 +556,7 @@ def test_modify_activities(activities_table, apigw_event_modify_activities, user
 
     app.table = activities_table
     ret = app.lambda_handler(apigw_event_modify_activities, "")
-    assert ret["statusCode"] == 200
+    assert ret == {"batchItemFailures": []}
     # check that the activities insights are created or updated
     all_insights = activities_table.query(
         KeyConditionExpression=Key("user").eq(
@@ -568,10 +574,10 @@ def test_modify_activities(activities_table, apigw_event_modify_activities, user
     assert all_insights[1] == {
         "user": user_id,
         "sk": f"insights#2022-11",
-        "categories": json.dumps({
+        "categories": {
             "some_existing_category": 0,
             "some_new_category": 5,
-        }),
+        },
         "date": "2022-11",
     }
 
@@ -589,10 +595,310 @@ def test_new_related_activities(
 
     app.table = activities_table
     ret = app.lambda_handler(api_gw_event_new_related_activities, "")
-    assert ret["statusCode"] == 200
+    assert ret == {"batchItemFailures": []}
 
     related_activities = activities_table.query(
         KeyConditionExpression=Key("user").eq(
             user_id) & Key("sk").begins_with("related_activity#")
     )["Items"]
     assert len(related_activities) == 2
+
+
+def test_activities_keep_description_index(activities_table, user_id):
+    app.table = activities_table
+
+    def record(event_name, old_description=None, new_description=None):
+        images = {}
+        for name, description in [("OldImage", old_description), ("NewImage", new_description)]:
+            if description is not None:
+                images[name] = {
+                    "sk": {"S": "2022-11-01#1"},
+                    "date": {"S": "2022-11-01"},
+                    "description": {"S": description},
+                    "category": {"S": "Grocery"},
+                    "amount": {"N": "10"},
+                    "user": {"S": user_id},
+                }
+        return {"Records": [{
+            "eventID": event_name,
+            "eventName": event_name,
+            "dynamodb": {
+                "Keys": {"sk": {"S": "2022-11-01#1"}, "user": {"S": user_id}},
+                **images,
+            },
+        }]}
+
+    def tokens():
+        return [item["sk"] for item in activities_table.query(
+            KeyConditionExpression=Key("user").eq(user_id) & Key("sk").begins_with("token#"))["Items"]]
+
+    app.lambda_handler(record("INSERT", new_description="SAFEWAY #2345"), "")
+    assert tokens() == ["token#2345#2022-11-01#1", "token#safeway#2022-11-01#1"]
+
+    app.lambda_handler(record("MODIFY", "SAFEWAY #2345", "SAFEWAY GAS"), "")
+    assert tokens() == ["token#gas#2022-11-01#1", "token#safeway#2022-11-01#1"]
+
+    app.lambda_handler(record("REMOVE", old_description="SAFEWAY GAS"), "")
+    assert tokens() == []
+
+
+def test_related_activities_one_query_per_merged_window(activities_table, user_id):
+    def insert(sk, amount):
+        return {
+            "eventID": sk,
+            "eventName": "INSERT",
+            "dynamodb": {
+                "Keys": {"sk": {"S": sk}, "user": {"S": user_id}},
+                "NewImage": {
+                    "sk": {"S": sk},
+                    "date": {"S": sk[:10]},
+                    "description": {"S": "transfer"},
+                    "category": {"S": "transfer"},
+                    "amount": {"N": amount},
+                    "user": {"S": user_id},
+                },
+            },
+        }
+
+    records = [insert("2022-11-01#a", "20"), insert("2022-11-04#b", "-20"),
+               insert("2022-11-06#c", "20.00"), insert("2023-03-01#d", "20")]
+    for record in records:
+        activities_table.put_item(Item={
+            "user": user_id, "sk": record["dynamodb"]["Keys"]["sk"]["S"],
+            "amount": Decimal(record["dynamodb"]["NewImage"]["amount"]["N"])})
+
+    app.table = QueryCountingTable(activities_table)
+    ret = app.lambda_handler({"Records": records}, "")
+    assert ret == {"batchItemFailures": []}
+    # the three november windows overlap, march is its own
+    assert app.table.query_count == 2
+
+    related = activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").begins_with("related_activity#")
+    )["Items"]
+    assert sorted((item["activity"], item["related"], item["duplicate"], item["opposite"]) for item in related) == [
+        ("2022-11-01#a", "2022-11-04#b", False, True),
+        ("2022-11-01#a", "2022-11-06#c", True, False),
+        ("2022-11-04#b", "2022-11-01#a", False, True),
+        ("2022-11-04#b", "2022-11-06#c", False, True),
+        ("2022-11-06#c", "2022-11-01#a", True, False),
+        ("2022-11-06#c", "2022-11-04#b", False, True),
+    ]
+
+
+def test_related_activities_include_both_ends_of_the_window(activities_table, user_id):
+    sk = "2022-11-08#new"
+    record = {
+        "eventID": sk,
+        "eventName": "INSERT",
+        "dynamodb": {
+            "Keys": {"sk": {"S": sk}, "user": {"S": user_id}},
+            "NewImage": {
+                "sk": {"S": sk},
+                "date": {"S": "2022-11-08"},
+                "description": {"S": "transfer"},
+                "category": {"S": "transfer"},
+                "amount": {"N": "20"},
+                "user": {"S": user_id},
+            },
+        },
+    }
+    # seven days either side of the new activity, and one day beyond
+    for other in ["2022-10-31#old", "2022-11-01#first", sk, "2022-11-15#last", "2022-11-16#late"]:
+        activities_table.put_item(Item={"user": user_id, "sk": other, "amount": Decimal(20)})
+
+    app.table = activities_table
+    assert app.lambda_handler({"Records": [record]}, "") == {"batchItemFailures": []}
+    related = activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").begins_with("related_activity#")
+    )["Items"]
+    assert sorted(item["related"] for item in related) == ["2022-11-01#first", "2022-11-15#last"]
+
+
+def test_retried_batch_reports_failures_and_counts_once(activities_table, apigw_event_new_activities, user_id, monkeypatch):
+    app.table = activities_table
+    records = apigw_event_new_activities["Records"]
+    for sequence, record in enumerate(records):
+        record["dynamodb"]["SequenceNumber"] = str(100 + sequence)
+
+    # december fails, only its record is reported
+    add_insights_once = monthlyInsights.addInsightsOnce
+
+    def failing_december(activities_table, user, month, events, *args):
+        if month == "2022-12":
+            raise RuntimeError("throttled")
+        return add_insights_once(activities_table, user, month, events, *args)
+
+    monkeypatch.setattr(monthlyInsights, "addInsightsOnce", failing_december)
+    assert app.lambda_handler(apigw_event_new_activities, "") == {"batchItemFailures": [{"itemIdentifier": "102"}]}
+    monkeypatch.undo()
+
+    # lambda delivers the whole batch again, november is not counted twice
+    assert app.lambda_handler(apigw_event_new_activities, "") == {"batchItemFailures": []}
+    all_insights = activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").begins_with("insights#")
+    )["Items"]
+    assert {item["sk"]: item["categories"] for item in all_insights} == {
+        "insights#2022-11": {"some_existing_category": 10, "some_new_category": 10},
+        "insights#2022-12": {"some_existing_category": 10},
+    }
+
+
+def test_unreadable_records_fail_alone(activities_table, user_id):
+    app.table = activities_table
+
+    def remove(sequence, event_id, image):
+        return {"eventID": event_id, "eventName": "REMOVE", "dynamodb": {
+            "Keys": {"sk": {"S": f"2022-11-0{sequence}#x"}, "user": {"S": user_id}},
+            "OldImage": image, "SequenceNumber": str(sequence)}}
+
+    image = {"date": {"S": "2022-11-01"}, "category": {"S": "Food"}, "amount": {"N": "10"}}
+    event = {"Records": [
+        remove(1, "with-amount", image),
+        remove(2, "no-amount", {"date": {"S": "2022-11-01"}, "category": {"S": "Food"}}),
+        remove(3, None, image),
+    ]}
+    del event["Records"][2]["eventID"]
+
+    assert app.lambda_handler(event, "") == {"batchItemFailures": [{"itemIdentifier": "2"}, {"itemIdentifier": "3"}]}
+    insights = activities_table.get_item(Key={"user": user_id, "sk": "insights#2022-11"})["Item"]
+    assert insights["categories"] == {"Food": -10}
+
+
+def test_moved_activity_keeps_insights_and_links(activities_table, user_id):
+    app.table = activities_table
+    image = {"date": {"S": "2022-11-01"}, "category": {"S": "Food"}, "amount": {"N": "10"},
+             "description": {"S": "SAFEWAY"}}
+    activities_table.put_item(Item={"user": user_id, "sk": "2022-11-01#twin", "amount": Decimal(10)})
+    event = {"Records": [
+        {"eventID": "insert", "eventName": "INSERT", "dynamodb": {
+            "Keys": {"sk": {"S": "2022-11-01#new"}, "user": {"S": user_id}},
+            "NewImage": {**image, "moved_from": {"S": "2022-11-01old"}}}},
+        {"eventID": "remove", "eventName": "REMOVE", "dynamodb": {
+            "Keys": {"sk": {"S": "2022-11-01old"}, "user": {"S": user_id}},
+            "OldImage": {**image, "moved_to": {"S": "2022-11-01#new"}}}},
+    ]}
+
+    assert app.lambda_handler(event, "") == {"batchItemFailures": []}
+    items = [item["sk"] for item in activities_table.query(KeyConditionExpression=Key("user").eq(user_id))["Items"]]
+    # only the description index follows the move
+    assert items == ["2022-11-01#twin", "token#safeway#2022-11-01#new"]
+
+
+def stream_event_source():
+    import os
+    import yaml
+
+    class TemplateLoader(yaml.SafeLoader):
+        pass
+
+    # !GetAtt, !Ref, ... are kept as their plain values
+    TemplateLoader.add_multi_constructor("!", lambda loader, tag, node: (
+        loader.construct_scalar(node) if isinstance(node, yaml.ScalarNode) else loader.construct_sequence(node)))
+    path = os.path.join(os.path.dirname(__file__), "..", "..", "template.yaml")
+    with open(path) as template:
+        resources = yaml.load(template, Loader=TemplateLoader)["Resources"]
+    return resources["ActivitiesTableStreamProcessor"]["Properties"]["Events"]["ProcessNewActivitiesOrMappings"]["Properties"]
+
+
+def test_unreadable_record_is_retried_a_bounded_number_of_times(activities_table, user_id):
+    source = stream_event_source()
+    assert "ReportBatchItemFailures" in source["FunctionResponseTypes"]
+    assert source["BisectBatchOnFunctionError"] is True
+    assert source["DestinationConfig"]["OnFailure"]["Type"] == "SQS"
+    max_retries = source["MaximumRetryAttempts"]
+    assert 0 <= max_retries <= 10
+
+    app.table = activities_table
+    image = {"date": {"S": "2022-11-01"}, "category": {"S": "Food"}, "amount": {"N": "10"}}
+    records = [{"eventID": f"event-{i}", "eventName": "REMOVE", "dynamodb": {
+        "Keys": {"sk": {"S": f"2022-11-01#{i}"}, "user": {"S": user_id}},
+        # the category has no "S" value
+        "OldImage": {**image, "category": {"NULL": True}} if i == 1 else image,
+        "SequenceNumber": str(i)}} for i in range(3)]
+
+    # what lambda does: retry from the first reported record on, at most
+    # MaximumRetryAttempts times, then the record goes to the failure queue
+    # and the shard moves past it
+    reported, batch, attempts = [], records, 0
+    while batch:
+        failures = app.lambda_handler({"Records": batch}, "")["batchItemFailures"]
+        reported += [failure["itemIdentifier"] for failure in failures]
+        if not failures:
+            break
+        first = next(i for i, record in enumerate(batch)
+                     if record["dynamodb"]["SequenceNumber"] == failures[0]["itemIdentifier"])
+        if attempts == max_retries:
+            batch = batch[first + 1:]
+            attempts = 0
+        else:
+            batch = batch[first:]
+            attempts += 1
+    assert reported == ["1"] * (max_retries + 1)
+    # the records around the bad one are counted once
+    insights = activities_table.get_item(Key={"user": user_id, "sk": "insights#2022-11"})["Item"]
+    assert insights["categories"] == {"Food": -20}
+
+
+class FakeContext:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def get_remaining_time_in_millis(self):
+        self.seconds -= 1
+        return self.seconds * 1000
+
+
+def test_recategorizing_stops_inside_a_page(activities_table, user_id, monkeypatch):
+    import activityMappings
+    monkeypatch.setattr(activityMappings, "RECATEGORIZE_WORKERS", 2)
+    for i in range(10):
+        activities_table.put_item(Item={
+            "user": user_id, "sk": f"2022-11-{i + 1:02d}#{i}", "date": f"2022-11-{i + 1:02d}",
+            "description": "SAFEWAY", "category": "Shops", "base_category": "Shops", "dirty": False,
+            "predicted": [], "review_key": f"{user_id}#clean", "amount": 10})
+    matcher = MappingMatcher([{"description": "SAFEWAY", "category": "Groceries"}])
+
+    # out of time after the first round of two updates, resumes at the third item
+    updated, next_sk = activityMappings.recategorizeActivities(
+        activities_table, user_id, ["SAFEWAY"], matcher, timeLeft=lambda: 0)
+    assert (updated, next_sk) == (2, "2022-11-03#2")
+    updated, next_sk = activityMappings.recategorizeActivities(
+        activities_table, user_id, ["SAFEWAY"], matcher, startSk=next_sk)
+    assert (updated, next_sk) == (8, None)
+
+
+def test_mapping_change_recategorizes_affected_activities_in_chunks(activities_table, user_id, monkeypatch):
+    import activityMappings
+    monkeypatch.setattr(activityMappings, "RECATEGORIZE_PAGE_SIZE", 4)
+    for i in range(10):
+        description = "SAFEWAY #12" if i % 3 == 0 else f"STORE {i}"
+        activities_table.put_item(Item={
+            "user": user_id, "sk": f"2022-11-{i + 1:02d}#{i}", "date": f"2022-11-{i + 1:02d}",
+            "description": description, "category": "Shops", "base_category": "Shops", "dirty": False,
+            "predicted": [], "review_key": f"{user_id}#clean", "amount": 10})
+    activities_table.put_item(Item={"user": user_id, "sk": "mapping#SAFEWAY", "description": "SAFEWAY", "category": "Groceries"})
+    event = {"Records": [{
+        "eventID": "mapping-insert",
+        "eventName": "INSERT",
+        "dynamodb": {
+            "Keys": {"sk": {"S": "mapping#SAFEWAY"}, "user": {"S": user_id}},
+            "NewImage": {"description": {"S": "SAFEWAY"}, "category": {"S": "Groceries"}},
+            "SequenceNumber": "300",
+        },
+    }]}
+    counting = app.table = QueryCountingTable(activities_table)
+
+    # out of time after the first page: checkpointed and retried
+    assert app.lambda_handler(event, FakeContext(1)) == {"batchItemFailures": [{"itemIdentifier": "300"}]}
+    checkpoint = activities_table.get_item(Key={"user": user_id, "sk": "recategorize#mapping-insert"})["Item"]
+    assert checkpoint["next"] == "2022-11-04#3"
+    assert app.lambda_handler(event, FakeContext(100)) == {"batchItemFailures": []}
+    assert "Item" not in activities_table.get_item(Key={"user": user_id, "sk": "recategorize#mapping-insert"})
+    # the mapping item on both runs, one page, then the rest from the checkpoint on
+    assert counting.scanned_count == 2 + 4 + 7
+
+    categories = {item["sk"]: (item["category"], item["dirty"]) for item in activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").begins_with("2022-11"))["Items"]}
+    assert categories == {
+        f"2022-11-{i + 1:02d}#{i}": ("Groceries", True) if i % 3 == 0 else ("Shops", False) for i in range(10)}
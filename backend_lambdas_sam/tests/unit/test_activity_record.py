@@ -0,0 +1,41 @@
+import json
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeSerializer
+from activityRecord import ActivityRecord
+from mappingMatcher import MappingMatcher
+
+
+def record(**kwargs):
+    return ActivityRecord(**{"account": "0733", "date": "2023-02-25", "amount": Decimal("20.47"),
+                             "description": "RAMEN DANBO", "category": "Dining", **kwargs})
+
+
+def test_record_has_no_instance_dict():
+    activity = record()
+    assert not hasattr(activity, "__dict__")
+    assert activity.search_term == "ramen danbo"
+    assert record(description="").search_term == "other"
+
+
+def test_sk_is_generated_once_when_read():
+    activity = record()
+    assert activity.sk.startswith("2023-02-25")
+    assert activity.sk == activity.sk
+    activity.sk = "2023-02-25#1"
+    assert activity.toDict()["sk"] == "2023-02-25#1"
+
+
+def test_wire_item_matches_serialized_item():
+    serializer = TypeSerializer()
+    for activity in [record(sk="2023-02-25#1"), record(sk="2023-02-25#2", description="SAFEWAY", category=None)]:
+        activity.applyMappings(MappingMatcher([{"description": "SAFEWAY", "category": "Groceries"}]))
+        expected = {key: serializer.serialize(value) for key, value in activity.toItem("user", "chksum").items()}
+        assert activity.toWireItem("user", "chksum") == expected
+
+
+def test_json_matches_dumped_dict():
+    activity = record(sk="2023-02-25#1")
+    activity.applyMappings(MappingMatcher([{"description": "RAMEN", "category": "Ramen"}]))
+    assert activity.toJson(duplicate_to=["2023-02-25#0"]) == json.dumps({**activity.toDict(), "duplicate_to": ["2023-02-25#0"]})
+    assert json.loads(record(sk="2023-02-25#2", description='say "hi"').toJson())["description"] == 'say "hi"'
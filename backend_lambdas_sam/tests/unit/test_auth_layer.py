@@ -0,0 +1,142 @@
+import json
+import time
+import pytest
+import jwt
+from jwt.algorithms import RSAAlgorithm
+from cryptography.hazmat.primitives.asymmetric import rsa
+import auth_layer
+
+JWKS_URL = "https://test.auth0.com/.well-known/jwks.json"
+AUDIENCES = ["https://my.finance-app.com/Test"]
+
+
+def _generate_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk["kid"] = kid
+    return private_key, jwk
+
+
+def _sign(private_key, kid, sub="test-user-id", exp=None):
+    claims = {"sub": sub, "aud": AUDIENCES[0]}
+    if exp is not None:
+        claims["exp"] = exp
+    return jwt.encode(
+        claims,
+        private_key,
+        algorithm="RS256",
+        headers={"kid": kid}
+    )
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    auth_layer.clear_jwks_cache()
+    auth_layer.clear_token_cache()
+    yield
+    auth_layer.clear_jwks_cache()
+    auth_layer.clear_token_cache()
+
+
+@pytest.fixture()
+def key_1():
+    return _generate_key("key-1")
+
+
+@pytest.fixture()
+def key_2():
+    return _generate_key("key-2")
+
+
+def test_jwks_fetched_once_for_repeated_tokens(requests_mock, key_1):
+    private_key, jwk = key_1
+    requests_mock.get(JWKS_URL, json={"keys": [jwk]})
+    token = _sign(private_key, "key-1")
+
+    for _ in range(3):
+        decoded = auth_layer.verify_token_with_jwks(token, JWKS_URL, AUDIENCES)
+        assert decoded["sub"] == "test-user-id"
+
+    assert requests_mock.call_count == 1
+    assert auth_layer.jwks_cache_stats["hits"] == 2
+    assert auth_layer.jwks_cache_stats["misses"] == 1
+
+
+def test_jwks_selects_key_by_kid(requests_mock, key_1, key_2):
+    requests_mock.get(JWKS_URL, json={"keys": [key_1[1], key_2[1]]})
+    token = _sign(key_2[0], "key-2")
+
+    decoded = auth_layer.verify_token_with_jwks(token, JWKS_URL, AUDIENCES)
+    assert decoded["sub"] == "test-user-id"
+
+
+def test_jwks_refetched_for_rotated_kid(requests_mock, monkeypatch, key_1, key_2):
+    monkeypatch.setattr(auth_layer, "JWKS_REFETCH_INTERVAL_SECONDS", 0)
+    requests_mock.get(JWKS_URL, [
+        {"json": {"keys": [key_1[1]]}},
+        {"json": {"keys": [key_1[1], key_2[1]]}},
+    ])
+    auth_layer.verify_token_with_jwks(_sign(key_1[0], "key-1"), JWKS_URL, AUDIENCES)
+
+    decoded = auth_layer.verify_token_with_jwks(_sign(key_2[0], "key-2"), JWKS_URL, AUDIENCES)
+    assert decoded["sub"] == "test-user-id"
+    assert requests_mock.call_count == 2
+
+
+def test_jwks_refetch_rate_limited_for_unknown_kid(requests_mock, key_1, key_2):
+    requests_mock.get(JWKS_URL, json={"keys": [key_1[1]]})
+    auth_layer.verify_token_with_jwks(_sign(key_1[0], "key-1"), JWKS_URL, AUDIENCES)
+
+    bad_token = _sign(key_2[0], "unknown-kid")
+    for _ in range(5):
+        with pytest.raises(ValueError):
+            auth_layer.verify_token_with_jwks(bad_token, JWKS_URL, AUDIENCES)
+
+    assert requests_mock.call_count == 1
+    assert auth_layer.jwks_cache_stats["misses"] == 6
+
+
+def test_verified_token_cached_until_exp(requests_mock, monkeypatch, key_1):
+    private_key, jwk = key_1
+    requests_mock.get(JWKS_URL, json={"keys": [jwk]})
+    exp = int(time.time()) + 60
+    token = _sign(private_key, "key-1", exp=exp)
+
+    for _ in range(3):
+        assert auth_layer.verify_token_cached(token, JWKS_URL, AUDIENCES) == "test-user-id"
+    assert auth_layer.token_cache_stats["hits"] == 2
+    assert auth_layer.token_cache_stats["misses"] == 1
+
+    # once exp is reached the entry is dropped and the token verified again
+    monkeypatch.setattr(auth_layer.time, "time", lambda: exp)
+    assert auth_layer.verify_token_cached(token, JWKS_URL, AUDIENCES) == "test-user-id"
+    assert auth_layer.token_cache_stats["expired"] == 1
+    assert auth_layer.token_cache_stats["misses"] == 2
+
+
+def test_verified_token_cache_is_bounded(requests_mock, monkeypatch, key_1):
+    monkeypatch.setattr(auth_layer, "TOKEN_CACHE_SIZE", 2)
+    private_key, jwk = key_1
+    requests_mock.get(JWKS_URL, json={"keys": [jwk]})
+    exp = int(time.time()) + 60
+
+    for i in range(3):
+        auth_layer.verify_token_cached(_sign(private_key, "key-1", f"user-{i}", exp), JWKS_URL, AUDIENCES)
+
+    assert len(auth_layer._token_cache) == 2
+    assert auth_layer.token_cache_stats["evicted"] == 1
+
+
+def test_verified_token_evicted_on_key_rotation(requests_mock, monkeypatch, key_1, key_2):
+    monkeypatch.setattr(auth_layer, "JWKS_REFETCH_INTERVAL_SECONDS", 0)
+    requests_mock.get(JWKS_URL, [
+        {"json": {"keys": [key_1[1]]}},
+        {"json": {"keys": [key_2[1]]}},
+    ])
+    exp = int(time.time()) + 60
+    auth_layer.verify_token_cached(_sign(key_1[0], "key-1", exp=exp), JWKS_URL, AUDIENCES)
+    assert len(auth_layer._token_cache) == 1
+
+    auth_layer.verify_token_cached(_sign(key_2[0], "key-2", exp=exp), JWKS_URL, AUDIENCES)
+    assert len(auth_layer._token_cache) == 1
+    assert auth_layer.token_cache_stats["evicted"] == 1
@@ -0,0 +1,89 @@
+import json
+from decimal import Decimal
+
+import pytest
+from boto3.dynamodb.conditions import Key
+
+from bankFormats import FORMATS, FormatSpec, compileDate, sniffFormat
+from tests.helpers import TestHelpers
+from lambdas.activities import app
+
+
+def fields(activity):
+    return (activity.account, activity.date, activity.amount, activity.description, activity.category)
+
+
+def test_rbc_rows():
+    convert = FORMATS["rbc"].convert
+    assert fields(convert(["Savings", "07702-5084629", "7/5/2023", "", "FIND&SAVE FROM PDA", "test desc", "69.00", "", ""])) == \
+        ("4629-Savings", "2023-07-05", Decimal("-69.00"), "test desc", "FIND&SAVE FROM PDA")
+    assert fields(convert(["Savings", "07702-5084629", "12/25/2023", "", "PURCHASE", "", "-5.5", "", ""]))[1:3] == \
+        ("2023-12-25", Decimal("5.5"))
+    # no CAD amount
+    assert convert(["Savings", "07702-4526828", "6/1/2023", "", "DEPOSIT INTEREST", "", "", "1.09", ""]) is None
+    assert convert(["Savings", "07702-4526828", "6/1/2023"]) is None
+
+
+def test_cap1_rows():
+    convert = FORMATS["cap1"].convert
+    assert fields(convert(["2023-02-25", "2023-02-27", "0733", "RAMEN DANBO ROBSON", "Dining", "20.47", ""])) == \
+        ("0733", "2023-02-25", Decimal("20.47"), "RAMEN DANBO ROBSON", "Dining")
+    assert convert(["2023-02-25", "2023-02-27", "0733", "PAYMENT", "Payment", "", "100.00"]).amount == Decimal("-100.00")
+    with pytest.raises(ValueError):
+        convert(["02/25/2023", "2023-02-27", "0733", "RAMEN", "Dining", "20.47", ""])
+
+
+def test_td_rows():
+    convert = FORMATS["td"].convert
+    assert fields(convert(["11/17/2024", "SAVE ON FOODS #2225", "23.48", "", ""])) == \
+        ("td", "2024-11-17", Decimal("23.48"), "SAVE ON FOODS #2225", "SAVE ON FOODS #2225")
+    assert convert(["11/18/2024", "PAYMENT - THANK YOU", "", "1000.00", ""]).amount == Decimal("-1000.00")
+    assert convert([]) is None
+    with pytest.raises(ValueError):
+        convert(["02/30/2024", "SAVE ON FOODS #2225", "23.48", "", ""])
+
+
+def test_compile_date_validates():
+    parse = compileDate("%d.%m.%Y")
+    assert parse("5.7.2023") == "2023-07-05"
+    with pytest.raises(ValueError):
+        parse("13.13.2023")
+    with pytest.raises(ValueError):
+        parse("31.4.2023")
+    assert parse("29.2.2024") == "2024-02-29"
+    with pytest.raises(ValueError):
+        parse("29.2.2023")
+    with pytest.raises(ValueError):
+        compileDate("%Y-%m")
+
+
+def test_new_format_is_one_spec():
+    spec = FormatSpec(name="example", date=1, dateLayout="%d/%m/%Y", account="example", description=2, amount=0)
+    assert fields(spec.convert(["-3.10", "31/01/2024", "BUS"])) == ("example", "2024-01-31", Decimal("-3.10"), "BUS", "BUS")
+
+
+@pytest.mark.parametrize("line, file_format", [
+    ('"Account Type","Account Number","Transaction Date","Cheque Number","Description 1","Description 2","CAD$","USD$"', "rbc"),
+    ("\ufeffTransaction Date,Posted Date,Card No.,Description,Category,Debit,Credit", "cap1"),
+    ("11/18/2024,PAYMENT - THANK YOU,,1000.00,", "td"),
+    ("Date,Amount", None),
+    ("", None),
+])
+def test_sniff_format(line, file_format):
+    assert sniffFormat(line) == file_format
+
+
+def test_post_activities_without_format_is_sniffed(activities_table, s3):
+    app.s3 = s3
+    app.activities_table = activities_table
+    body = "11/18/2024,PAYMENT - THANK YOU,,1000.00,\n11/17/2024,SAVE ON FOODS #2225,23.48,,\n"
+    ret = app.lambda_handler(TestHelpers.get_base_event("test-user-id", "POST", "/activities", "", body), "")
+    assert ret["statusCode"] == 200
+    assert json.loads(ret["body"])["data"]["s3_key"].startswith("test-user-id/td/")
+    assert activities_table.query(
+        KeyConditionExpression=Key("user").eq("test-user-id") & Key("sk").between("0000-00-00", "9999-99-99"))["Count"] == 2
+
+    ret = app.lambda_handler(TestHelpers.get_base_event("test-user-id", "POST", "/activities", "", "Date,Amount\n"), "")
+    assert ret["statusCode"] == 400
+    ret = app.lambda_handler(TestHelpers.get_base_event("test-user-id", "POST", "/activities", "format=bank", body), "")
+    assert ret["statusCode"] == 400
@@ -0,0 +1,117 @@
+import threading
+import time
+
+import botocore.exceptions
+import pytest
+from boto3.dynamodb.conditions import Key
+from batchWriter import ConcurrentBatchWriter, BatchWriteError, RateController
+
+
+class FlakyClient:
+    """ throttles the first call and leaves part of the next batches unprocessed """
+
+    def __init__(self, unprocessedBatches=2):
+        self.unprocessedBatches = unprocessedBatches
+        self.calls = 0
+        self.written = {}
+        self.lock = threading.Lock()
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity):
+        with self.lock:
+            self.calls += 1
+            if self.calls == 1:
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "ProvisionedThroughputExceededException"}}, "BatchWriteItem")
+            requests = RequestItems["fake"]
+            unprocessed = []
+            if self.unprocessedBatches and len(requests) > 1:
+                self.unprocessedBatches -= 1
+                requests, unprocessed = requests[:1], requests[1:]
+            for request in requests:
+                item = request["PutRequest"]["Item"]
+                self.written[item["sk"]] = item
+            return {
+                "UnprocessedItems": {"fake": unprocessed} if unprocessed else {},
+                "ConsumedCapacity": [{"TableName": "fake", "CapacityUnits": float(len(requests))}],
+            }
+
+
+class FakeTable:
+    name = "fake"
+
+    def __init__(self, client):
+        class Meta:
+            pass
+        self.meta = Meta()
+        self.meta.client = client
+
+
+def test_retries_throttles_and_unprocessed_items():
+    client = FlakyClient()
+    with ConcurrentBatchWriter(FakeTable(client), workers=3, rate=100000, backoffBase=0.001) as batch:
+        for i in range(200):
+            batch.put_item(Item={"user": "u", "sk": f"2020-01-01#{i}"})
+    assert sorted(client.written) == sorted(f"2020-01-01#{i}" for i in range(200))
+    report = batch.stats.report()
+    assert report["items"] == 200
+    assert report["throttles"] == 3
+    assert report["retries"] == 3
+    assert report["consumed_wcu"] == 200
+
+
+def test_gives_up_after_max_attempts():
+    client = FlakyClient(unprocessedBatches=100)
+    with pytest.raises(BatchWriteError):
+        with ConcurrentBatchWriter(FakeTable(client), workers=1, rate=100000, maxAttempts=3, backoffBase=0.001) as batch:
+            for i in range(25):
+                batch.put_item(Item={"user": "u", "sk": f"2020-01-01#{i}"})
+
+
+def test_rate_controller_is_aimd():
+    controller = RateController(10, minRate=1, maxRate=12, increase=1, paced=True)
+    controller.onSuccess()
+    controller.onSuccess()
+    controller.onSuccess()
+    assert controller.rate == 12
+    controller.onThrottle()
+    assert controller.rate == 6
+    for _ in range(5):
+        controller.onThrottle()
+    assert controller.rate == 1
+
+
+def test_rate_controller_paces_from_the_first_throttle():
+    controller = RateController(10, decrease=0.5)
+    start = time.monotonic()
+    for _ in range(100):
+        controller.acquire(25)
+    assert time.monotonic() - start < 0.5
+    time.sleep(0.1)
+    controller.onThrottle()
+    assert controller.paced
+    # half of what was sent before it, well over the starting rate
+    assert 10 < controller.rate <= 2500 * 0.5 / 0.1
+
+
+@pytest.mark.parametrize("putIfAbsent", [False, True])
+def test_unthrottled_writes_are_not_paced(activities_table, putIfAbsent):
+    # a synchronous POST /activities has the 3 second function timeout,
+    # pacing from BATCH_WRITE_RATE would take 5 seconds here
+    start = time.monotonic()
+    with ConcurrentBatchWriter(activities_table, putIfAbsent=putIfAbsent) as batch:
+        for i in range(500):
+            batch.put_item(Item={"user": "u", "sk": f"2020-01-01#{i}", "amount": 1})
+    assert time.monotonic() - start < 2.5
+    assert batch.stats.report()["throttles"] == 0
+    assert activities_table.query(KeyConditionExpression=Key("user").eq("u"), Select="COUNT")["Count"] == 500
+
+
+def test_last_write_to_a_key_wins(activities_table):
+    with ConcurrentBatchWriter(activities_table, workers=2) as batch:
+        for i in range(60):
+            batch.put_item(Item={"user": "u", "sk": f"2020-01-01#{i}", "amount": 1})
+        batch.put_item(Item={"user": "u", "sk": "2020-01-01#59", "amount": 2})
+        batch.delete_item(Key={"user": "u", "sk": "2020-01-01#58"})
+    items = activities_table.query(KeyConditionExpression=Key("user").eq("u"))["Items"]
+    assert len(items) == 59
+    assert {item["sk"]: item["amount"] for item in items}["2020-01-01#59"] == 2
@@ -0,0 +1,31 @@
+from decimal import Decimal
+from contentKeys import contentSk, isContentSk, OccurrenceCounter, relatedActivitySk
+
+
+def test_content_sk_is_stable_and_sorts_by_date():
+    sk = contentSk("0733", "2023-02-25", Decimal("20.47"), "RAMEN")
+    assert sk.startswith("2023-02-25#")
+    assert isContentSk(sk)
+    assert not isContentSk("2023-02-25" + "0d8b3c1e-6a55-4bb0-9e1c-0f3c2d1f5a11")
+    assert contentSk("0733", "2023-02-25", "20.470", "RAMEN") == sk
+    assert contentSk("0733", "2023-02-25", 20.47, "RAMEN") == sk
+    assert contentSk("0734", "2023-02-25", "20.47", "RAMEN") != sk
+    assert contentSk("0733", "2023-02-25", "-20.47", "RAMEN") != sk
+
+
+def test_identical_rows_get_their_own_keys_in_order():
+    first = OccurrenceCounter()
+    second = OccurrenceCounter()
+    rows = [("0733", "2023-02-25", "4.50", "COFFEE")] * 3 + [("0733", "2023-02-25", "4.50", "TEA")]
+    sks = [first.sk(*row) for row in rows]
+    assert len(set(sks)) == 4
+    assert sks[0] == contentSk(*rows[0])
+    assert sks == [second.sk(*row) for row in rows]
+
+
+def test_related_activity_sk_is_one_per_link():
+    sk = relatedActivitySk("2023-02-25#a", "2023-02-26#b", "duplicate")
+    assert sk.startswith("related_activity#")
+    assert relatedActivitySk("2023-02-25#a", "2023-02-26#b", "duplicate") == sk
+    assert relatedActivitySk("2023-02-26#b", "2023-02-25#a", "duplicate") != sk
+    assert relatedActivitySk("2023-02-25#a", "2023-02-26#b", "opposite") != sk
@@ -0,0 +1,106 @@
+import pytest
+from boto3.dynamodb.conditions import Key
+import descriptionIndex
+from descriptionIndex import (
+    BatchGetError, tokenize, indexActivity, searchActivitySks, descriptionMatches, batchGetActivities)
+
+
+@pytest.fixture()
+def user_id():
+    return "test-user-id"
+
+
+def index(activities_table, user_id, activities):
+    for sk, description in activities.items():
+        activities_table.put_item(Item={"user": user_id, "sk": sk, "description": description, "amount": 1})
+        indexActivity(activities_table, user_id, sk, newDescription=description)
+
+
+def test_tokenize():
+    assert tokenize("SAFEWAY #2345 Safeway") == ["safeway", "2345"]
+    assert tokenize("FIND&SAVE FROM PDA") == ["find", "save", "from", "pda"]
+    assert tokenize("") == []
+    assert tokenize(None) == []
+
+
+def test_search_intersects_tokens_and_matches_last_as_prefix(activities_table, user_id):
+    index(activities_table, user_id, {
+        "2020-01-01#1": "SAFEWAY #2345",
+        "2020-01-02#2": "SAFEWAY #3456",
+        "2020-01-03#3": "LONDON DRUGS #2345",
+        "2020-01-04#4": "SAVE ON FOODS",
+    })
+
+    assert searchActivitySks(activities_table, user_id, "safeway") == ["2020-01-02#2", "2020-01-01#1"]
+    # whole tokens narrow the candidates, the prefix is checked on the items
+    assert searchActivitySks(activities_table, user_id, "SAFEWAY #2345") == ["2020-01-02#2", "2020-01-01#1"]
+    assert descriptionMatches("SAFEWAY #2345", "SAFEWAY #2345")
+    assert not descriptionMatches("SAFEWAY #2345", "SAFEWAY #3456")
+    # posting lists of whole tokens are bounded by date
+    assert searchActivitySks(activities_table, user_id, "safeway 2", "2020-01-02", "2020-01-02~") == ["2020-01-02#2"]
+    assert searchActivitySks(activities_table, user_id, "sa", "2020-01-02", "2020-01-04~") == ["2020-01-04#4", "2020-01-02#2"]
+    # typeahead
+    assert searchActivitySks(activities_table, user_id, "sa") == ["2020-01-04#4", "2020-01-02#2", "2020-01-01#1"]
+    assert searchActivitySks(activities_table, user_id, "london dr") == ["2020-01-03#3"]
+    # only the last token is a prefix
+    assert searchActivitySks(activities_table, user_id, "safe 2345") == []
+    assert searchActivitySks(activities_table, user_id, "#") is None
+
+
+def test_index_follows_description_changes(activities_table, user_id):
+    index(activities_table, user_id, {"2020-01-01#1": "SAFEWAY #2345"})
+
+    indexActivity(activities_table, user_id, "2020-01-01#1", "SAFEWAY #2345", "SAFEWAY GAS")
+    assert searchActivitySks(activities_table, user_id, "2345") == []
+    assert searchActivitySks(activities_table, user_id, "gas") == ["2020-01-01#1"]
+
+    indexActivity(activities_table, user_id, "2020-01-01#1", oldDescription="SAFEWAY GAS")
+    tokens = activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").begins_with("token#"))["Items"]
+    assert tokens == []
+
+
+def test_batch_get_keeps_order_across_requests(activities_table, user_id):
+    sks = [f"2020-01-01#{i:03d}" for i in range(250)]
+    with activities_table.batch_writer() as batch:
+        for sk in sks:
+            batch.put_item(Item={"user": user_id, "sk": sk, "amount": 1})
+
+    wanted = list(reversed(sks)) + ["2020-01-01#missing"]
+    assert [item["sk"] for item in batchGetActivities(activities_table, user_id, wanted)] == list(reversed(sks))
+
+
+class ThrottledTable:
+    """ leaves the keys of the first `throttled` batch_get_item calls unprocessed """
+
+    def __init__(self, activities_table, throttled):
+        self.name = activities_table.name
+        self.meta = self
+        self.client = self
+        self._client = activities_table.meta.client
+        self.throttled = throttled
+        self.calls = 0
+
+    def batch_get_item(self, RequestItems):
+        self.calls += 1
+        if self.calls <= self.throttled:
+            return {"Responses": {}, "UnprocessedKeys": RequestItems}
+        return self._client.batch_get_item(RequestItems=RequestItems)
+
+
+def test_batch_get_backs_off_on_unprocessed_keys(activities_table, user_id, monkeypatch):
+    activities_table.put_item(Item={"user": user_id, "sk": "2020-01-01#1", "amount": 1})
+    sleeps = []
+    monkeypatch.setattr(descriptionIndex.time, "sleep", sleeps.append)
+
+    table = ThrottledTable(activities_table, throttled=3)
+    assert [item["sk"] for item in batchGetActivities(table, user_id, ["2020-01-01#1"])] == ["2020-01-01#1"]
+    assert table.calls == 4
+    assert len(sleeps) == 3
+    assert all(0 <= sleep <= 0.05 * 2 ** attempt for attempt, sleep in enumerate(sleeps))
+
+    # a table that never catches up fails instead of retrying forever
+    table = ThrottledTable(activities_table, throttled=100)
+    with pytest.raises(BatchGetError):
+        batchGetActivities(table, user_id, ["2020-01-01#1"], maxAttempts=5)
+    assert table.calls == 5
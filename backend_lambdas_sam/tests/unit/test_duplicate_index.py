@@ -0,0 +1,51 @@
+import random
+from decimal import Decimal
+from libs import Activity, DuplicateIndex, isDuplicate
+
+
+def activity(sk, date, amount, description):
+    return Activity(account="visa", date=date, amount=Decimal(amount), description=description, sk=sk)
+
+
+def test_exact_matches_same_tuple_only():
+    index = DuplicateIndex([
+        activity("a", "2023-02-25", "20.47", "RAMEN DANBO ROBSON"),
+        activity("b", "2023-02-25", "20.47", "RAMEN DANBO ROBSON"),
+        activity("c", "2023-02-26", "20.47", "RAMEN DANBO ROBSON"),
+        activity("d", "2023-02-25", "20.48", "RAMEN DANBO ROBSON"),
+    ])
+    assert index.find(activity("new", "2023-02-25", "20.470", "RAMEN DANBO ROBSON")) == ["a", "b"]
+    assert index.find(activity("new", "2023-02-25", "20.47", "Ramen Danbo Robson")) == []
+
+
+def test_fuzzy_matches_nearby_days_and_normalized_description():
+    index = DuplicateIndex([
+        activity("a", "2023-02-25", "20.47", "RAMEN DANBO ROBSON"),
+        activity("b", "2023-02-27", "20.47", "Ramen Danbo  Robson!"),
+        activity("c", "2023-03-01", "20.47", "RAMEN DANBO ROBSON"),
+        activity("d", "2023-02-26", "20.47", "RAMEN DANBO"),
+    ], fuzzyDays=2)
+    assert index.find(activity("new", "2023-02-25", "20.47", "RAMEN DANBO ROBSON")) == ["a", "b"]
+    assert index.find(activity("new", "2023-02-28", "20.47", "ramen danbo robson")) == ["b", "c"]
+
+
+def test_matches_pairwise_reference_on_random_data():
+    rng = random.Random(7)
+    descriptions = ["SAFEWAY #1", "safeway 1", "IMPARK", "LONDON DRUGS"]
+
+    def random_activity(sk):
+        return activity(sk, f"2023-01-{rng.randint(1, 20):02d}", str(rng.randint(1, 5)), rng.choice(descriptions))
+
+    existing = [random_activity(f"e{i}") for i in range(300)]
+    uploaded = [random_activity(f"u{i}") for i in range(300)]
+    index = DuplicateIndex(existing)
+    for item in uploaded:
+        assert index.find(item) == [other.sk for other in existing if isDuplicate(other, item)]
+
+    fuzzy = DuplicateIndex(existing, fuzzyDays=3)
+    for item in uploaded:
+        expected = [other.sk for other in existing if isDuplicate(other, item)]
+        expected += [other.sk for other in existing if other.sk not in expected and other.amount == item.amount
+                     and abs(int(other.date[-2:]) - int(item.date[-2:])) <= 3
+                     and other.description.lower().replace("#", "").replace("  ", " ") == item.description.lower().replace("#", "").replace("  ", " ")]
+        assert sorted(fuzzy.find(item)) == sorted(expected)
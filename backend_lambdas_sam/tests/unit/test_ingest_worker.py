@@ -0,0 +1,162 @@
+import json
+import time
+from urllib.parse import quote_plus
+
+import pytest
+import requests
+from boto3.dynamodb.conditions import Key
+
+from lambdas.activities import app
+import ingestWorker
+from uploadStore import readUpload, uploadKey
+from tests.helpers import TestHelpers
+
+
+@pytest.fixture()
+def user_id():
+    return "test-user-id"
+
+
+@pytest.fixture()
+def cap1_file_raw():
+    return 'Transaction Date,Posted Date,Card No.,Description,Category,Debit,Credit\n2023-02-25,2023-02-27,0733,RAMEN DANBO ROBSON,Dining,20.47,\n2023-02-24,2023-02-27,0733,SAFEWAY #4931,Merchandise,26.73,\n'
+
+
+def upload(user_id, file_body, file_format="cap1"):
+    """ creates an upload job, PUTs the file to its url and returns the job id and the S3 event """
+    query = f"type=upload&format={file_format}" if file_format else "type=upload"
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "POST", "/activities", query), "")
+    assert ret["statusCode"] == 200
+    data = json.loads(ret["body"])["data"]
+    assert requests.put(data["upload_url"], data=file_body.encode("utf-8")).status_code == 200
+    s3_key = f"uploads/{user_id}/{file_format or 'auto'}/{data['job_id']}.csv"
+    event = {
+        "Records": [{
+            "s3": {
+                "bucket": {"name": "test-bucket"},
+                "object": {"key": quote_plus(s3_key)},
+            }
+        }]
+    }
+    return data["job_id"], event
+
+
+def get_job(user_id, job_id):
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "GET", "/activities", f"job={job_id}"), "")
+    assert ret["statusCode"] == 200
+    return json.loads(ret["body"])["data"]
+
+
+def test_presigned_upload_is_ingested(activities_table, s3, user_id, cap1_file_raw):
+    app.s3 = s3
+    app.activities_table = activities_table
+    ingestWorker.s3 = s3
+    ingestWorker.activities_table = activities_table
+
+    job_id, event = upload(user_id, cap1_file_raw)
+    assert get_job(user_id, job_id)["status"] == "waiting_for_upload"
+
+    ingestWorker.lambda_handler(event, "")
+    job = get_job(user_id, job_id)
+    assert job["status"] == "done"
+    assert job["rows_written"] == 2
+    assert job["start_date"] == "2023-02-24"
+    assert job["end_date"] == "2023-02-25"
+
+    activities = activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").between("0000-00-00", "9999-99-99")
+    )["Items"]
+    assert [item["description"] for item in activities] == ["SAFEWAY #4931", "RAMEN DANBO ROBSON"]
+    assert all(item["chksum"] == job["checksum"] for item in activities)
+    chksum_item = activities_table.get_item(Key={"user": user_id, "sk": f"chksum#{job['checksum']}"})["Item"]
+    assert chksum_item["file"] == uploadKey(user_id, "cap1", job["checksum"])
+    # stored gzipped, like files posted through the API
+    assert s3.Object("test-bucket", chksum_item["file"]).get()["Body"].read()[:2] == b"\x1f\x8b"
+    assert readUpload(s3, chksum_item["file"]) == cap1_file_raw
+    # the upload left the prefix the presigned url writes to
+    assert not list(s3.Bucket("test-bucket").objects.filter(Prefix="uploads/"))
+
+    # S3 may deliver the event again, the job is not ingested twice
+    ingestWorker.lambda_handler(event, "")
+    assert activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").between("0000-00-00", "9999-99-99")
+    )["Count"] == 2
+
+    # a second PUT to the same url is dropped
+    s3.Object("test-bucket", f"uploads/{user_id}/cap1/{job_id}.csv").put(Body="2023-03-01,2023-03-02,0733,OTHER,Dining,1.00,\n")
+    ingestWorker.lambda_handler(event, "")
+    assert not list(s3.Bucket("test-bucket").objects.filter(Prefix="uploads/"))
+    assert readUpload(s3, chksum_item["file"]) == cap1_file_raw
+    assert get_job(user_id, job_id)["status"] == "done"
+
+
+def test_presigned_upload_rejects_repeat_file(activities_table, s3, user_id, cap1_file_raw):
+    app.s3 = s3
+    app.activities_table = activities_table
+    ingestWorker.s3 = s3
+    ingestWorker.activities_table = activities_table
+
+    # the same checksum as a file posted through the API
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "POST", "/activities", "format=cap1", cap1_file_raw), "")
+    assert ret["statusCode"] == 200
+
+    job_id, event = upload(user_id, cap1_file_raw)
+    ingestWorker.lambda_handler(event, "")
+    assert get_job(user_id, job_id)["status"] == "duplicate"
+    assert not list(s3.Bucket("test-bucket").objects.filter(Prefix="uploads/"))
+    assert activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").between("0000-00-00", "9999-99-99")
+    )["Count"] == 2
+
+
+def test_presigned_upload_without_format_is_sniffed(activities_table, s3, user_id, cap1_file_raw):
+    app.s3 = s3
+    app.activities_table = activities_table
+    ingestWorker.s3 = s3
+    ingestWorker.activities_table = activities_table
+
+    job_id, event = upload(user_id, cap1_file_raw, None)
+    ingestWorker.lambda_handler(event, "")
+    assert get_job(user_id, job_id)["status"] == "done"
+
+    job_id, event = upload(user_id, "not,a,statement\n", None)
+    ingestWorker.lambda_handler(event, "")
+    job = get_job(user_id, job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "unable to detect the file format"
+    # the file of a failed job is kept
+    assert s3.Object("test-bucket", f"uploads/{user_id}/auto/{job_id}.csv").get()["Body"].read() == b"not,a,statement\n"
+
+
+def test_processing_job_past_its_deadline_is_failed(activities_table, s3, user_id, cap1_file_raw, monkeypatch):
+    app.s3 = s3
+    app.activities_table = activities_table
+    ingestWorker.s3 = s3
+    ingestWorker.activities_table = activities_table
+
+    # the worker is killed at its timeout while writing rows
+    def timed_out(*args, **kwargs):
+        raise SystemExit("Task timed out")
+
+    monkeypatch.setattr(ingestWorker, "writeActivities", timed_out)
+    job_id, event = upload(user_id, cap1_file_raw)
+    with pytest.raises(SystemExit):
+        ingestWorker.lambda_handler(event, "")
+    job = get_job(user_id, job_id)
+    assert job["status"] == "processing"
+    assert job["deadline"] > time.time()
+
+    monkeypatch.setattr(time, "time", lambda: job["deadline"] + 1)
+    job = get_job(user_id, job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "the upload took too long to process, upload it again"
+    assert activities_table.get_item(Key={"user": user_id, "sk": f"job#{job_id}"})["Item"]["status"] == "failed"
+
+
+def test_upload_job_rejects_unknown_format_and_unknown_job_is_404(activities_table, s3, user_id):
+    app.s3 = s3
+    app.activities_table = activities_table
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "POST", "/activities", "type=upload&format=bank"), "")
+    assert ret["statusCode"] == 400
+    ret = app.lambda_handler(TestHelpers.get_base_event(user_id, "GET", "/activities", "job=missing"), "")
+    assert ret["statusCode"] == 404
@@ -0,0 +1,59 @@
+import pytest
+from mappingCache import MappingCache, bumpMappingsVersion
+
+
+@pytest.fixture()
+def user_id():
+    return "test-user-id"
+
+
+@pytest.fixture()
+def mapping_item(user_id):
+    return {
+        "user": user_id,
+        "sk": "mapping#SAFEWAY",
+        "description": "SAFEWAY",
+        "category": "Grocery",
+    }
+
+
+def test_cache_hit_until_version_bumped(activities_table, user_id, mapping_item):
+    cache = MappingCache()
+    activities_table.put_item(Item=mapping_item)
+
+    assert len(cache.getMappings(activities_table, user_id)) == 1
+    matcher = cache.getMatcher(activities_table, user_id)
+    assert cache.getMatcher(activities_table, user_id) is matcher
+    assert cache.stats == {"hits": 2, "misses": 1}
+
+    # a write without a version bump is not seen...
+    activities_table.put_item(Item={**mapping_item, "sk": "mapping#IMPARK", "description": "IMPARK"})
+    assert len(cache.getMappings(activities_table, user_id)) == 1
+
+    # ...until the version changes
+    bumpMappingsVersion(activities_table, user_id)
+    assert len(cache.getMappings(activities_table, user_id)) == 2
+    assert cache.getMatcher(activities_table, user_id) is not matcher
+    assert cache.stats["misses"] == 2
+
+
+def test_cache_expires_after_ttl(activities_table, user_id, mapping_item):
+    cache = MappingCache(ttlSeconds=0)
+    activities_table.put_item(Item=mapping_item)
+
+    cache.getMappings(activities_table, user_id)
+    cache.getMappings(activities_table, user_id)
+    assert cache.stats == {"hits": 0, "misses": 2}
+
+
+def test_cache_is_bounded(activities_table, mapping_item):
+    cache = MappingCache(maxUsers=2)
+    for user in ["user-1", "user-2", "user-3"]:
+        activities_table.put_item(Item={**mapping_item, "user": user})
+        cache.getMappings(activities_table, user)
+
+    # user-1 is least recently used, so it was evicted
+    cache.getMappings(activities_table, "user-1")
+    assert cache.stats == {"hits": 0, "misses": 4}
+    cache.getMappings(activities_table, "user-3")
+    assert cache.stats["hits"] == 1
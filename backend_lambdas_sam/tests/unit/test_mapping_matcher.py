@@ -0,0 +1,58 @@
+import random
+import pytest
+import mappingMatcher
+from mappingMatcher import MappingMatcher
+
+
+def _reference_match(mappings, description):
+    return [mapping for mapping in mappings if mapping["description"] in description]
+
+
+@pytest.fixture(params=[0, 16])
+def linear_scan_max(request, monkeypatch):
+    # run each test through both the automaton and the linear scan
+    monkeypatch.setattr(mappingMatcher, "LINEAR_SCAN_MAX_MAPPINGS", request.param)
+    return request.param
+
+
+@pytest.fixture()
+def overlapping_mappings():
+    return [
+        {"description": "SAFEWAY", "category": "Grocery"},
+        {"description": "SAFEWAY #4931", "category": "Grocery Downtown"},
+        {"description": "WAY", "category": "Way"},
+        {"description": "RAMEN DANBO", "category": "Dining"},
+        {"description": "AMEN", "category": "Church"},
+        {"description": "SAFEWAY", "category": "Duplicate"},
+    ]
+
+
+def test_match_keeps_mapping_order(linear_scan_max, overlapping_mappings):
+    matcher = MappingMatcher(overlapping_mappings)
+
+    matched = matcher.match("SAFEWAY #4931 VANCOUVER")
+    assert [m["category"] for m in matched] == ["Grocery", "Grocery Downtown", "Way", "Duplicate"]
+    assert [m["category"] for m in matcher.match("RAMEN DANBO ROBSON")] == ["Dining", "Church"]
+    assert matcher.match("LONDON DRUGS") == []
+
+
+def test_empty_description_matches_everything(linear_scan_max):
+    mappings = [{"description": "", "category": "All"}, {"description": "PARK", "category": "Parking"}]
+    matcher = MappingMatcher(mappings)
+
+    assert [m["category"] for m in matcher.match("IMPARK")] == ["All", "Parking"]
+    assert [m["category"] for m in matcher.match("")] == ["All"]
+
+
+def test_matches_reference_on_random_data(linear_scan_max):
+    rng = random.Random(42)
+    alphabet = "ABCD #1"
+    mappings = [{
+        "description": "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))),
+        "category": f"category{i}"
+    } for i in range(200)]
+    matcher = MappingMatcher(mappings)
+
+    for _ in range(500):
+        description = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        assert matcher.match(description) == _reference_match(mappings, description)
@@ -1,6 +1,9 @@
 import pytest
 import json
+from boto3.dynamodb.conditions import Attr
 from lambdas.mappings import app
+from lambdas.activitiesStreams import app as stream_app
+from mappingCache import getMappingsVersion
 from tests.helpers import TestHelpers
 """
     Tests mapping handler's get, post, and delete methods
@@ -97,10 +100,11 @@ def test_post_mapping(apigw_event_post, activities_table):
     response = app.lambda_handler(apigw_event_post, "")
     assert response["statusCode"] == 201
 
-    mappings = activities_table.scan()["Items"]
+    mappings = activities_table.scan(FilterExpression=Attr("sk").begins_with("mapping#"))["Items"]
 
     assert len(mappings) == 1
     assert mappings[0]["category"] == "testCategory"
+    assert getMappingsVersion(activities_table, "test-user-id") == 1
 
 def test_post_update_mapping(user_id, apigw_event_post, activities_table):
     activities_table.put_item(
@@ -114,7 +118,7 @@ def test_post_update_mapping(user_id, apigw_event_post, activities_table):
     response = app.lambda_handler(apigw_event_post, "")
     assert response["statusCode"] == 201
 
-    mappings = activities_table.scan()["Items"]
+    mappings = activities_table.scan(FilterExpression=Attr("sk").begins_with("mapping#"))["Items"]
 
     assert len(mappings) == 1
     assert mappings[0]["category"] == "testCategory"
@@ -180,6 +184,59 @@ def test_delete_mapping(apigw_event_delete, activities_table, mock_mappings_item
     response = app.lambda_handler(apigw_event_delete, "")
     assert response["statusCode"] == 200
 
-    mappings = activities_table.scan()["Items"]
+    mappings = activities_table.scan(FilterExpression=Attr("sk").begins_with("mapping#"))["Items"]
 
     assert len(mappings) == 9
+    assert getMappingsVersion(activities_table, "test-user-id") == 1
+
+
+def mapping_stream_event(event_name, user_id, image_name, description, category):
+    # what the activities stream delivers for a mapping# write
+    return {"Records": [{
+        "eventID": f"{event_name}-{description}",
+        "eventName": event_name,
+        "dynamodb": {
+            "Keys": {"sk": {"S": f"mapping#{description}"}, "user": {"S": user_id}},
+            image_name: {
+                "sk": {"S": f"mapping#{description}"},
+                "description": {"S": description},
+                "category": {"S": category},
+                "user": {"S": user_id},
+            },
+        },
+    }]}
+
+
+def test_post_delete_mapping_updates_activities(user_id, apigw_event_post, activities_table):
+    activities_table.put_item(Item={
+        "user": user_id,
+        "sk": "2020-01-01#1",
+        "date": "2020-01-01",
+        "description": "testDescription 1234",
+        "category": "bankCategory",
+        "amount": 10,
+    })
+    stream_app.table = activities_table
+
+    response = app.lambda_handler(apigw_event_post, "")
+    assert response["statusCode"] == 201
+    # activities are re-categorized by the stream, not by the request
+    assert "dirty" not in activities_table.get_item(Key={"user": user_id, "sk": "2020-01-01#1"})["Item"]
+    stream_app.lambda_handler(mapping_stream_event(
+        "INSERT", user_id, "NewImage", "testDescription", "testCategory"), "")
+    activity = activities_table.get_item(Key={"user": user_id, "sk": "2020-01-01#1"})["Item"]
+    assert activity["category"] == "testCategory"
+    assert activity["base_category"] == "bankCategory"
+    assert activity["dirty"] == True
+    assert activity["review_key"] == f"{user_id}#dirty"
+
+    response = app.lambda_handler(TestHelpers.get_base_event(
+        user_id, "DELETE", "/mappings", "id=mapping#testDescription"), "")
+    assert response["statusCode"] == 200
+    stream_app.lambda_handler(mapping_stream_event(
+        "REMOVE", user_id, "OldImage", "testDescription", "testCategory"), "")
+    activity = activities_table.get_item(Key={"user": user_id, "sk": "2020-01-01#1"})["Item"]
+    assert activity["category"] == "bankCategory"
+    assert activity["dirty"] == False
+    assert activity["predicted"] == []
+    assert activity["review_key"] == f"{user_id}#clean"
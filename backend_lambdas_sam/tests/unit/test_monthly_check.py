@@ -88,6 +88,58 @@ def test_lambda_handler(activities_table, mock_insights_data, mock_activities_da
         KeyConditionExpression=Key("user").eq(user_id) & Key("sk").begins_with("insights#")
     )["Items"]
     assert len(insights) == 2
-    jan_categories = json.loads(insights[0]["categories"])
+    jan_categories = insights[0]["categories"]
     assert jan_categories["category1"] == 50
     assert jan_categories["category2"] == 50
+
+
+def test_scan_table_partitions_segments_by_user(activities_table):
+    for user in ["a", "b", "c"]:
+        activities_table.put_item(Item={"user": user, "sk": f"mapping#{user}", "description": user, "category": user})
+        for i in range(20):
+            activities_table.put_item(Item={"user": user, "sk": f"2022-01-{i + 1:02d}", "date": f"2022-01-{i + 1:02d}",
+                                            "description": f"{user}{i}", "category": "c", "amount": 1})
+        activities_table.put_item(Item={"user": user, "sk": "insights#2022-01", "categories": {}})
+
+    app.table = activities_table
+    for segments in [1, 3, 16]:
+        by_user, complete = app.scan_table(total_segments=segments, max_rows=1000, page_size=7)
+        assert complete
+        assert {user: (len(items["mappings"]), len(items["activities"])) for user, items in by_user.items()} == {
+            "a": (1, 20), "b": (1, 20), "c": (1, 20)}
+
+    # stops early once max_rows items were read
+    by_user, complete = app.scan_table(total_segments=1, max_rows=10, page_size=7)
+    assert not complete
+    assert sum(len(items["activities"]) + len(items["mappings"]) for items in by_user.values()) < 63
+
+
+def test_row_budget_counts_only_mappings_and_activities(activities_table):
+    for i in range(20):
+        activities_table.put_item(Item={"user": "a", "sk": f"2022-01-{i + 1:02d}", "date": f"2022-01-{i + 1:02d}",
+                                        "description": f"a{i}", "category": "c", "amount": 1})
+        for token in range(5):
+            activities_table.put_item(Item={"user": "a", "sk": f"token#t{token}#2022-01-{i + 1:02d}"})
+
+    app.table = activities_table
+    by_user, complete = app.scan_table(total_segments=2, max_rows=30, page_size=7)
+    assert complete
+    assert len(by_user["a"]["activities"]) == 20
+
+
+def test_incomplete_scan_leaves_insights_untouched(activities_table, mock_insights_data, mock_activities_data,
+                                                   mock_mappings_data, user_id, monkeypatch):
+    for item in mock_activities_data + mock_mappings_data + mock_insights_data:
+        activities_table.put_item(Item=item)
+    scan_table = app.scan_table
+    monkeypatch.setattr(app, "scan_table", lambda: scan_table(total_segments=1, max_rows=1, page_size=1))
+
+    app.table = activities_table
+    response = app.lambda_handler({}, {})
+
+    assert response["statusCode"] == 200
+    assert activities_table.get_item(Key={"user": user_id, "sk": "2022-01-01#2"})["Item"]["category"] == "category1"
+    insights = activities_table.query(
+        KeyConditionExpression=Key("user").eq(user_id) & Key("sk").begins_with("insights#")
+    )["Items"]
+    assert insights == mock_insights_data
@@ -0,0 +1,71 @@
+import json
+from decimal import Decimal
+
+from monthlyInsights import addAllInsights, addInsights, addInsightsOnce, convertInsights, putInsights
+
+
+def insights(activities_table, month):
+    return activities_table.get_item(Key={"user": "user", "sk": f"insights#{month}"})["Item"]
+
+
+def test_deltas_are_added_to_the_map(activities_table):
+    addInsights(activities_table, "user", "2022-11", {"Dining": Decimal("10.5"), "Gas & Fuel": Decimal(40)})
+    addInsights(activities_table, "user", "2022-11", {"Dining": Decimal(-3), "Rent": Decimal(900)})
+    assert insights(activities_table, "2022-11") == {
+        "user": "user", "sk": "insights#2022-11", "date": "2022-11",
+        "categories": {"Dining": Decimal("7.5"), "Gas & Fuel": 40, "Rent": 900},
+    }
+
+
+def test_empty_categories_are_added_as_uncategorized(activities_table):
+    names = []
+
+    def record_names(params, **kwargs):
+        names.extend(params.get("ExpressionAttributeNames", {}).values())
+        for item in params.get("TransactItems", []):
+            names.extend(item.get("Update", {}).get("ExpressionAttributeNames", {}).values())
+
+    # moto accepts empty attribute names, DynamoDB doesn't
+    activities_table.meta.client.meta.events.register("provide-client-params.dynamodb.*", record_names)
+    addInsights(activities_table, "user", "2022-11", {"": Decimal(5), "Dining": Decimal(1)})
+    assert addAllInsights(activities_table, {"user": {"2022-11": [("event", {"": Decimal(2), None: Decimal(1)})]}}) == set()
+    assert "" not in names and None not in names
+    assert insights(activities_table, "2022-11")["categories"] == {"uncategorized": 8, "Dining": 1}
+
+
+def test_more_categories_than_one_update_holds(activities_table):
+    deltas = {f"category {i}": Decimal(i) for i in range(120)}
+    addInsights(activities_table, "user", "2022-11", deltas)
+    addInsights(activities_table, "user", "2022-11", deltas)
+    assert insights(activities_table, "2022-11")["categories"] == {name: 2 * amount for name, amount in deltas.items()}
+
+
+def test_json_string_items_are_converted(activities_table):
+    legacy = json.dumps({"Dining": 5, "Rent": 1.5})
+    activities_table.put_item(Item={"user": "user", "sk": "insights#2022-10", "categories": legacy, "date": "2022-10"})
+    addAllInsights(activities_table, {"user": {
+        "2022-10": [("event1", {"Dining": Decimal(1)})],
+        "2022-09": [("event2", {"Rent": Decimal(2)})],
+    }})
+    assert insights(activities_table, "2022-10")["categories"] == {"Dining": 6, "Rent": Decimal("1.5")}
+    assert insights(activities_table, "2022-09")["categories"] == {"Rent": 2}
+    # only converts what it was given
+    assert not convertInsights(activities_table, "user", "insights#2022-10", legacy)
+
+
+def test_put_replaces_the_totals(activities_table):
+    addInsights(activities_table, "user", "2022-11", {"Dining": Decimal(10)})
+    putInsights(activities_table, "user", "2022-11", {"Rent": Decimal(900)})
+    assert insights(activities_table, "2022-11")["categories"] == {"Rent": 900}
+
+
+def test_stream_events_are_added_once(activities_table):
+    first = [(f"event{i}", {"Dining": Decimal(1), f"category {i % 3}": Decimal(-1)}) for i in range(30)]
+    addInsightsOnce(activities_table, "user", "2022-11", first)
+    # a retried batch: the first events again, followed by new ones
+    retried = first[10:] + [("event30", {"Dining": Decimal(100)})]
+    assert addAllInsights(activities_table, {"user": {"2022-11": retried}}) == set()
+    assert insights(activities_table, "2022-11")["categories"] == {
+        "Dining": 130, "category 0": -10, "category 1": -10, "category 2": -10}
+    marker = activities_table.get_item(Key={"user": "user", "sk": "stream#event30"})["Item"]
+    assert marker["ttl"] > 0
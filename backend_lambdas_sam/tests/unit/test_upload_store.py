@@ -0,0 +1,40 @@
+import hashlib
+from uploadStore import compressUpload, storeUpload, storeUploadObject, readUpload, uploadKey
+
+
+def test_store_is_content_addressed_and_compressed(s3):
+    body = "Transaction Date,Posted Date,Card No.,Description,Category,Debit,Credit\n" + \
+        "2023-02-25,2023-02-27,0733,RAMEN DANBO ROBSON,Dining,20.47,\n" * 1000
+    chksum = hashlib.md5(body.encode("utf-8")).hexdigest()
+
+    s3_key = storeUpload(s3, "test-user-id", "cap1", body, chksum)
+    assert s3_key == uploadKey("test-user-id", "cap1", chksum)
+    stored = s3.Object("test-bucket", s3_key).get()
+    assert "gzip" in stored["ContentEncoding"]
+    assert stored["ContentLength"] < len(body) / 10
+    etag = stored["ETag"]
+
+    # the same content again is a no-op conditional write
+    assert storeUpload(s3, "test-user-id", "cap1", body, chksum) == s3_key
+    objects = list(s3.Bucket("test-bucket").objects.filter(Prefix="test-user-id/"))
+    assert [obj.key for obj in objects] == [s3_key]
+    assert objects[0].e_tag == etag
+
+    assert readUpload(s3, s3_key) == body
+
+
+def test_read_plain_legacy_upload(s3):
+    s3.Object("test-bucket", "test-user-id/cap1/2023-02-27abc.csv").put(Body="a,b\n")
+    assert readUpload(s3, "test-user-id/cap1/2023-02-27abc.csv") == "a,b\n"
+
+
+def test_stored_object_matches_stored_body(s3):
+    body = "2023-02-25,2023-02-27,0733,RAMEN DANBO ROBSON,Dining,20.47,\n" * 50000
+    chksum = hashlib.md5(body.encode("utf-8")).hexdigest()
+    s3.Object("test-bucket", "uploads/test-user-id/cap1/job.csv").put(Body=body.encode("utf-8"))
+
+    s3_key = storeUploadObject(s3, "test-bucket", "uploads/test-user-id/cap1/job.csv", "test-user-id", "cap1", chksum)
+    assert s3_key == uploadKey("test-user-id", "cap1", chksum)
+    assert readUpload(s3, s3_key) == body
+    # the same bytes as the same file posted through the API
+    assert s3.Object("test-bucket", s3_key).get()["Body"].read() == compressUpload(body)